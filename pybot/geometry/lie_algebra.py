@@ -0,0 +1,303 @@
+"""
+Batched exponential / logarithm maps for SO(3), SE(3) and Sim(3).
+
+All maps are vectorized over the leading axis, and use closed-form
+(Rodrigues-type) expressions with Taylor expansions near the
+identity, instead of generic matrix exponentials / logarithms.
+
+Tangent-space conventions (rotation first):
+    so3: w [N x 3]
+    se3: xi = [w, v] [N x 6]
+    sim3: xi = [w, v, sigma] [N x 7], with scale s = exp(sigma)
+
+Group elements are returned as [N x 3 x 3] rotations (SO(3)),
+[N x 4 x 4] matrices [R t; 0 1] (SE(3)), and [N x 4 x 4] matrices
+[sR t; 0 1] (Sim(3)).
+
+Jacobians follow Barfoot, "State Estimation for Robotics" (Sec 7.1),
+with the left Jacobian J_l satisfying
+    exp(w + dw) ~= exp(J_l(w) dw) exp(w)
+and the right Jacobian J_r(w) = J_l(-w).
+"""
+# Author: Sudeep Pillai <spillai@csail.mit.edu>
+# License: MIT
+
+import numpy as np
+from pybot.geometry.quaternion import quat_from_matrix
+
+# Taylor expansions are used below this angle
+_SMALL_ANGLE = 0.1
+
+def _as_batch(x, dim):
+    x = np.asarray(x, dtype=np.float64)
+    if x.shape[-1] != dim:
+        raise ValueError('Expected [N x {:}] input, provided {:}'.format(dim, x.shape))
+    return x.reshape(-1, dim)
+
+def _coeffs(theta):
+    """
+    Returns the coefficients (for [N] angles theta):
+        c1 = sin(t) / t
+        c2 = (1 - cos(t)) / t^2
+        c3 = (t - sin(t)) / t^3
+        c4 = (t^2 + 2 cos(t) - 2) / (2 t^4)
+        c5 = (2t - 3 sin(t) + t cos(t)) / (2 t^5)
+    """
+    small = theta < _SMALL_ANGLE
+    t = np.where(small, 1.0, theta)
+    t2 = theta * theta
+    st, ct = np.sin(t), np.cos(t)
+    c1 = np.where(small, 1 - t2 / 6 + t2 * t2 / 120, st / t)
+    c2 = np.where(small, 0.5 - t2 / 24 + t2 * t2 / 720, (1 - ct) / t**2)
+    c3 = np.where(small, 1. / 6 - t2 / 120 + t2 * t2 / 5040, (t - st) / t**3)
+    c4 = np.where(small, 1. / 24 - t2 / 720 + t2 * t2 / 40320,
+                  (t**2 + 2 * ct - 2) / (2 * t**4))
+    c5 = np.where(small, 1. / 120 - t2 / 2520 + t2 * t2 / 120960,
+                  (2 * t - 3 * st + t * ct) / (2 * t**5))
+    return c1, c2, c3, c4, c5
+
+def _matmul(A, B):
+    return np.einsum('nij,njk->nik', A, B)
+
+def _matvec(A, v):
+    return np.einsum('nij,nj->ni', A, v)
+
+###############################################################################
+# SO(3)
+
+def so3_hat(w):
+    """ Returns [N x 3 x 3] skew-symmetric matrices of [N x 3] vectors """
+    w = _as_batch(w, 3)
+    W = np.zeros((len(w), 3, 3))
+    W[:,0,1], W[:,0,2] = -w[:,2], w[:,1]
+    W[:,1,0], W[:,1,2] = w[:,2], -w[:,0]
+    W[:,2,0], W[:,2,1] = -w[:,1], w[:,0]
+    return W
+
+def so3_vee(W):
+    """ Returns [N x 3] vectors of [N x 3 x 3] skew-symmetric matrices """
+    W = np.asarray(W, dtype=np.float64).reshape(-1, 3, 3)
+    return np.stack([W[:,2,1], W[:,0,2], W[:,1,0]], axis=1)
+
+def so3_left_jacobian(w):
+    """ Left Jacobian J_l(w) [N x 3 x 3] of SO(3) """
+    w = _as_batch(w, 3)
+    c1, c2, c3, _, _ = _coeffs(np.linalg.norm(w, axis=1))
+    W = so3_hat(w)
+    return np.eye(3) + c2[:,None,None] * W + c3[:,None,None] * _matmul(W, W)
+
+def so3_left_jacobian_inv(w):
+    """ Inverse left Jacobian J_l(w)^-1 [N x 3 x 3] of SO(3) """
+    w = _as_batch(w, 3)
+    theta = np.linalg.norm(w, axis=1)
+    small = theta < _SMALL_ANGLE
+    t = np.where(small, 1.0, theta)
+    t2 = theta * theta
+    c = np.where(small, 1. / 12 + t2 / 720 + t2 * t2 / 30240,
+                 1 / t**2 - (1 + np.cos(t)) / (2 * t * np.sin(t)))
+    W = so3_hat(w)
+    return np.eye(3) - 0.5 * W + c[:,None,None] * _matmul(W, W)
+
+def so3_right_jacobian(w):
+    """ Right Jacobian J_r(w) = J_l(-w) [N x 3 x 3] of SO(3) """
+    return so3_left_jacobian(-_as_batch(w, 3))
+
+def so3_right_jacobian_inv(w):
+    """ Inverse right Jacobian J_r(w)^-1 = J_l(-w)^-1 [N x 3 x 3] of SO(3) """
+    return so3_left_jacobian_inv(-_as_batch(w, 3))
+
+def _so3_jacobian(w, return_jacobian, inverse=False):
+    if return_jacobian == 'left':
+        return so3_left_jacobian_inv(w) if inverse else so3_left_jacobian(w)
+    elif return_jacobian == 'right':
+        return so3_right_jacobian_inv(w) if inverse else so3_right_jacobian(w)
+    raise ValueError('return_jacobian should be one of (None, left, right), '
+                     'provided {:}'.format(return_jacobian))
+
+def so3_exp(w, return_jacobian=None):
+    """
+    Exponential map (Rodrigues) of [N x 3] rotation vectors to
+    [N x 3 x 3] rotations. Optionally (return_jacobian='left'/'right')
+    returns the corresponding [N x 3 x 3] Jacobians as well.
+    """
+    w = _as_batch(w, 3)
+    c1, c2, _, _, _ = _coeffs(np.linalg.norm(w, axis=1))
+    W = so3_hat(w)
+    R = np.eye(3) + c1[:,None,None] * W + c2[:,None,None] * _matmul(W, W)
+    if return_jacobian:
+        return R, _so3_jacobian(w, return_jacobian)
+    return R
+
+def so3_log(R, return_jacobian=None):
+    """
+    Logarithm map of [N x 3 x 3] rotations to [N x 3] rotation vectors,
+    evaluated via the unit quaternion (robust near 0 and pi). Optionally
+    (return_jacobian='left'/'right') returns the inverse Jacobians,
+    i.e. the Jacobians of the logarithm map.
+    """
+    q = quat_from_matrix(np.asarray(R, dtype=np.float64).reshape(-1, 3, 3))
+    v, qw = q[:,:3], q[:,3]
+    n = np.linalg.norm(v, axis=1)
+    small = n < 1e-8
+    ns = np.where(small, 1.0, n)
+    scale = np.where(small, 2. / qw * (1 - n * n / (3 * qw * qw)),
+                     2 * np.arctan2(n, qw) / ns)
+    w = v * scale[:,None]
+    if return_jacobian:
+        return w, _so3_jacobian(w, return_jacobian, inverse=True)
+    return w
+
+###############################################################################
+# SE(3)
+
+def _se3_Q(w, v):
+    """ Returns Q(w, v) [N x 3 x 3], the off-diagonal block of the SE(3) left Jacobian """
+    _, _, c3, c4, c5 = _coeffs(np.linalg.norm(w, axis=1))
+    W, V = so3_hat(w), so3_hat(v)
+    WV, VW = _matmul(W, V), _matmul(V, W)
+    WVW = _matmul(WV, W)
+    WW = _matmul(W, W)
+    return 0.5 * V + \
+        c3[:,None,None] * (WV + VW + WVW) + \
+        c4[:,None,None] * (_matmul(WW, V) + _matmul(V, WW) - 3 * WVW) + \
+        c5[:,None,None] * (_matmul(WVW, W) + _matmul(W, WVW))
+
+def se3_hat(xi):
+    """ Returns [N x 4 x 4] twist matrices of [N x 6] (w, v) vectors """
+    xi = _as_batch(xi, 6)
+    X = np.zeros((len(xi), 4, 4))
+    X[:,:3,:3] = so3_hat(xi[:,:3])
+    X[:,:3,3] = xi[:,3:]
+    return X
+
+def se3_left_jacobian(xi):
+    """ Left Jacobian [N x 6 x 6] of SE(3), for (w, v) ordering """
+    xi = _as_batch(xi, 6)
+    w, v = xi[:,:3], xi[:,3:]
+    J = so3_left_jacobian(w)
+    Jse3 = np.zeros((len(xi), 6, 6))
+    Jse3[:,:3,:3] = J
+    Jse3[:,3:,3:] = J
+    Jse3[:,3:,:3] = _se3_Q(w, v)
+    return Jse3
+
+def se3_left_jacobian_inv(xi):
+    """ Inverse left Jacobian [N x 6 x 6] of SE(3), for (w, v) ordering """
+    xi = _as_batch(xi, 6)
+    w, v = xi[:,:3], xi[:,3:]
+    Jinv = so3_left_jacobian_inv(w)
+    Jse3 = np.zeros((len(xi), 6, 6))
+    Jse3[:,:3,:3] = Jinv
+    Jse3[:,3:,3:] = Jinv
+    Jse3[:,3:,:3] = -_matmul(_matmul(Jinv, _se3_Q(w, v)), Jinv)
+    return Jse3
+
+def se3_right_jacobian(xi):
+    """ Right Jacobian J_r(xi) = J_l(-xi) [N x 6 x 6] of SE(3) """
+    return se3_left_jacobian(-_as_batch(xi, 6))
+
+def se3_right_jacobian_inv(xi):
+    """ Inverse right Jacobian J_r(xi)^-1 = J_l(-xi)^-1 [N x 6 x 6] of SE(3) """
+    return se3_left_jacobian_inv(-_as_batch(xi, 6))
+
+def _se3_jacobian(xi, return_jacobian, inverse=False):
+    if return_jacobian == 'left':
+        return se3_left_jacobian_inv(xi) if inverse else se3_left_jacobian(xi)
+    elif return_jacobian == 'right':
+        return se3_right_jacobian_inv(xi) if inverse else se3_right_jacobian(xi)
+    raise ValueError('return_jacobian should be one of (None, left, right), '
+                     'provided {:}'.format(return_jacobian))
+
+def se3_exp(xi, return_jacobian=None):
+    """
+    Exponential map of [N x 6] twists (w, v) to [N x 4 x 4] rigid
+    transforms [R t; 0 1], with t = J_l(w) v. Optionally
+    (return_jacobian='left'/'right') returns the [N x 6 x 6] Jacobians.
+    """
+    xi = _as_batch(xi, 6)
+    w, v = xi[:,:3], xi[:,3:]
+    T = np.zeros((len(xi), 4, 4))
+    T[:,:3,:3] = so3_exp(w)
+    T[:,:3,3] = _matvec(so3_left_jacobian(w), v)
+    T[:,3,3] = 1
+    if return_jacobian:
+        return T, _se3_jacobian(xi, return_jacobian)
+    return T
+
+def se3_log(T, return_jacobian=None):
+    """
+    Logarithm map of [N x 4 x 4] (or [N x 3 x 4]) rigid transforms to
+    [N x 6] twists (w, v). Optionally (return_jacobian='left'/'right')
+    returns the inverse [N x 6 x 6] Jacobians.
+    """
+    T = np.asarray(T, dtype=np.float64)
+    T = T.reshape((-1,) + T.shape[-2:])
+    w = so3_log(T[:,:3,:3])
+    v = _matvec(so3_left_jacobian_inv(w), T[:,:3,3])
+    xi = np.hstack([w, v])
+    if return_jacobian:
+        return xi, _se3_jacobian(xi, return_jacobian, inverse=True)
+    return xi
+
+###############################################################################
+# Sim(3)
+
+def _sim3_V(w, sigma):
+    """
+    Returns V(w, sigma) [N x 3 x 3] = int_0^1 exp(sigma s) exp(s [w]_x) ds,
+    that maps the Sim(3) tangent translation to the group translation
+    """
+    theta = np.linalg.norm(w, axis=1)
+    c1, c2, c3, _, _ = _coeffs(theta)
+    st = np.fabs(theta) < 1e-8
+    ss = np.fabs(sigma) < 1e-5
+    t = np.where(st, 1.0, theta)
+    s = np.where(ss, 1.0, sigma)
+    es = np.exp(sigma)
+    s2, t2 = sigma * sigma, theta * theta
+
+    # A = int exp(sigma s) ds
+    A = np.where(ss, 1 + sigma / 2 + s2 / 6, (es - 1) / s)
+
+    # B = int exp(sigma s) sin(theta s) / theta ds
+    # C = int exp(sigma s) (1 - cos(theta s)) / theta^2 ds
+    # (with the limits for small sigma and / or small theta)
+    den = np.where(np.bitwise_and(st, ss), 1.0, s2 + t2)
+    B_gen = (es * (sigma * np.sin(t) - t * np.cos(t)) + t) / (t * den)
+    C_gen = (A - (es * (sigma * np.cos(t) + t * np.sin(t)) - sigma) / den) / (t * t)
+    B_t0 = np.where(ss, 0.5 + sigma / 3, ((s - 1) * es + 1) / (s * s))
+    C_t0 = np.where(ss, 1. / 6 + sigma / 8, ((s * s - 2 * s + 2) * es - 2) / (2 * s**3))
+    B = np.where(st, B_t0, np.where(ss, c2 + sigma * c3, B_gen))
+    C = np.where(st, C_t0, np.where(ss, c3, C_gen))
+
+    W = so3_hat(w)
+    return A[:,None,None] * np.eye(3) + B[:,None,None] * W + C[:,None,None] * _matmul(W, W)
+
+def sim3_exp(xi):
+    """
+    Exponential map of [N x 7] vectors (w, v, sigma) to [N x 4 x 4]
+    similarity transforms [sR t; 0 1], with s = exp(sigma)
+    """
+    xi = _as_batch(xi, 7)
+    w, v, sigma = xi[:,:3], xi[:,3:6], xi[:,6]
+    T = np.zeros((len(xi), 4, 4))
+    T[:,:3,:3] = so3_exp(w) * np.exp(sigma)[:,None,None]
+    T[:,:3,3] = _matvec(_sim3_V(w, sigma), v)
+    T[:,3,3] = 1
+    return T
+
+def sim3_log(T):
+    """
+    Logarithm map of [N x 4 x 4] similarity transforms [sR t; 0 1]
+    to [N x 7] vectors (w, v, sigma)
+    """
+    T = np.asarray(T, dtype=np.float64)
+    T = T.reshape((-1,) + T.shape[-2:])
+    sR = T[:,:3,:3]
+    s = np.cbrt(np.linalg.det(sR))
+    w = so3_log(sR / s[:,None,None])
+    sigma = np.log(s)
+    v = np.linalg.solve(_sim3_V(w, sigma), T[:,:3,3][...,None])[...,0]
+    return np.hstack([w, v, sigma[:,None]])
+
+###############################################################################
@@ -8,23 +8,232 @@ import math
 import numpy as np
 import transformations as tf
 
+###############################################################################
+# Batched quaternion kernels (xyzw), vectorized over the leading axes
+
+def quat_normalize(q):
+    """ Normalize [... x 4] quaternions with their L2 norm """
+    q = np.asarray(q, dtype=np.float64)
+    return q / np.linalg.norm(q, axis=-1)[...,np.newaxis]
+
+def quat_conjugate(q):
+    """ Conjugate of [... x 4] quaternions """
+    qc = np.array(q, dtype=np.float64, copy=True)
+    qc[...,:3] *= -1
+    return qc
+
+def quat_multiply(q1, q0):
+    """ Hamilton product q1 * q0 of [... x 4] quaternions (broadcasts) """
+    q1, q0 = np.asarray(q1, dtype=np.float64), np.asarray(q0, dtype=np.float64)
+    x1, y1, z1, w1 = q1[...,0], q1[...,1], q1[...,2], q1[...,3]
+    x0, y0, z0, w0 = q0[...,0], q0[...,1], q0[...,2], q0[...,3]
+    return np.stack([ x1*w0 + y1*z0 - z1*y0 + w1*x0,
+                     -x1*z0 + y1*w0 + z1*x0 + w1*y0,
+                      x1*y0 - y1*x0 + z1*w0 + w1*z0,
+                     -x1*x0 - y1*y0 - z1*z0 + w1*w0], axis=-1)
+
+def quat_rotate(q, v):
+    """
+    Rotate [... x 3] vectors with [... x 4] unit quaternions
+    v' = v + 2w (u x v) + 2 u x (u x v), where q = (u, w)
+
+    The leading axes of q are aligned with the leading axes of v, 
+    so that a single quaternion [4] rotates a point set [N x 3], 
+    [N x 4] quaternions rotate [N x 3] vectors elementwise, and 
+    [M x 4] quaternions rotate M point sets [M x N x 3]. 
+    """
+    q, v = np.asarray(q, dtype=np.float64), np.asarray(v, dtype=np.float64)
+    if 1 < q.ndim < v.ndim: 
+        q = q.reshape(q.shape[:-1] + (1,) * (v.ndim - q.ndim) + (4,))
+    u, w = q[...,:3], q[...,3:4]
+    uv = 2 * np.cross(u, v)
+    return v + w * uv + np.cross(u, uv)
+
+def quat_rotate_rev(q, v):
+    """ Rotate [... x 3] vectors with [... x 4] unit quaternions in reverse """
+    return quat_rotate(quat_conjugate(q), v)
+
+def quat_slerp(q0, q1, w):
+    """
+    Spherical linear interpolation between [... x 4] unit quaternions, 
+    with weights [...] (w=0: q0, w=1: q1), along the shortest path. 
+    Weights outside [0,1] extrapolate along the same great arc. 
+    """
+    q0, q1 = np.asarray(q0, dtype=np.float64), np.asarray(q1, dtype=np.float64)
+    w = np.asarray(w, dtype=np.float64)[...,np.newaxis]
+    d = np.sum(q0 * q1, axis=-1, keepdims=True)
+    q1 = np.where(d < 0, -q1, q1)
+    omega = np.arccos(np.minimum(np.fabs(d), 1.0))
+    so = np.sin(omega)
+
+    # Direct linear interpolation for numerically unstable regions
+    small = so < 1e-6
+    so = np.where(small, 1.0, so)
+    a = np.where(small, 1 - w, np.sin((1 - w) * omega) / so)
+    b = np.where(small, w, np.sin(w * omega) / so)
+    return quat_normalize(a * q0 + b * q1)
+
+def quat_to_matrix(q):
+    """ Returns [... x 3 x 3] rotation matrices from [... x 4] unit quaternions """
+    q = np.asarray(q, dtype=np.float64)
+    x, y, z, w = q[...,0], q[...,1], q[...,2], q[...,3]
+    xx, yy, zz = x*x, y*y, z*z
+    xy, xz, yz = x*y, x*z, y*z
+    wx, wy, wz = w*x, w*y, w*z
+    R = np.empty(q.shape[:-1] + (3,3), dtype=np.float64)
+    R[...,0,0], R[...,0,1], R[...,0,2] = 1 - 2*(yy + zz), 2*(xy - wz), 2*(xz + wy)
+    R[...,1,0], R[...,1,1], R[...,1,2] = 2*(xy + wz), 1 - 2*(xx + zz), 2*(yz - wx)
+    R[...,2,0], R[...,2,1], R[...,2,2] = 2*(xz - wy), 2*(yz + wx), 1 - 2*(xx + yy)
+    return R
+
+def quat_from_matrix(R):
+    """
+    Returns [... x 4] unit quaternions (w >= 0) from [... x 3 x 3]
+    (or [... x 4 x 4]) rotation matrices. Uses Shepperd's method,
+    picking the numerically largest of (w, x, y, z) to divide by.
+    """
+    R = np.asarray(R, dtype=np.float64)[...,:3,:3]
+    shape = R.shape[:-2]
+    R = R.reshape(-1,3,3)
+    m00, m01, m02 = R[:,0,0], R[:,0,1], R[:,0,2]
+    m10, m11, m12 = R[:,1,0], R[:,1,1], R[:,1,2]
+    m20, m21, m22 = R[:,2,0], R[:,2,1], R[:,2,2]
+
+    # Candidates (w, x, y, z dominant), and the dominant case per rotation
+    tr = np.stack([m00 + m11 + m22, m00 - m11 - m22,
+                   m11 - m00 - m22, m22 - m00 - m11], axis=0)
+    k = np.argmax(tr, axis=0)
+    s = 2 * np.sqrt(np.maximum(1 + tr, 1e-12))
+    Q = np.stack([
+        np.stack([(m21 - m12), (m02 - m20), (m10 - m01), s[0] * s[0] / 4], axis=-1) / s[0][:,np.newaxis],
+        np.stack([s[1] * s[1] / 4, (m01 + m10), (m02 + m20), (m21 - m12)], axis=-1) / s[1][:,np.newaxis],
+        np.stack([(m01 + m10), s[2] * s[2] / 4, (m12 + m21), (m02 - m20)], axis=-1) / s[2][:,np.newaxis],
+        np.stack([(m02 + m20), (m12 + m21), s[3] * s[3] / 4, (m10 - m01)], axis=-1) / s[3][:,np.newaxis]
+    ], axis=0)
+    q = Q[k, np.arange(len(k))]
+    q *= np.where(q[:,3] < 0, -1., 1.)[:,np.newaxis]
+    return quat_normalize(q).reshape(shape + (4,))
+
+def _euler_axes(axes):
+    """ Returns the (firstaxis, parity, repetition, frame) tuple of an axis sequence """
+    try:
+        return tf._AXES2TUPLE[axes.lower()]
+    except (AttributeError, KeyError):
+        _ = tf._TUPLE2AXES[axes]
+        return axes
+
+def quat_to_euler(q, axes='rxyz'):
+    """ Returns [... x 3] Euler angles of [... x 4] unit quaternions (see tf.euler_from_matrix) """
+    firstaxis, parity, repetition, frame = _euler_axes(axes)
+    i = firstaxis
+    j = tf._NEXT_AXIS[i+parity]
+    k = tf._NEXT_AXIS[i-parity+1]
+
+    M = quat_to_matrix(q)
+    if repetition:
+        sy = np.sqrt(M[...,i,j]*M[...,i,j] + M[...,i,k]*M[...,i,k])
+        valid = sy > tf._EPS
+        ax = np.where(valid, np.arctan2(M[...,i,j], M[...,i,k]), np.arctan2(-M[...,j,k], M[...,j,j]))
+        ay = np.arctan2(sy, M[...,i,i])
+        az = np.where(valid, np.arctan2(M[...,j,i], -M[...,k,i]), 0.0)
+    else:
+        cy = np.sqrt(M[...,i,i]*M[...,i,i] + M[...,j,i]*M[...,j,i])
+        valid = cy > tf._EPS
+        ax = np.where(valid, np.arctan2(M[...,k,j], M[...,k,k]), np.arctan2(-M[...,j,k], M[...,j,j]))
+        ay = np.arctan2(-M[...,k,i], cy)
+        az = np.where(valid, np.arctan2(M[...,j,i], M[...,i,i]), 0.0)
+
+    if parity:
+        ax, ay, az = -ax, -ay, -az
+    if frame:
+        ax, az = az, ax
+    return np.stack([ax, ay, az], axis=-1)
+
+def quat_from_euler(ai, aj, ak, axes='rxyz'):
+    """ Returns [... x 4] quaternions from [...] Euler angles (see tf.quaternion_from_euler) """
+    firstaxis, parity, repetition, frame = _euler_axes(axes)
+    i = firstaxis
+    j = tf._NEXT_AXIS[i+parity]
+    k = tf._NEXT_AXIS[i-parity+1]
+
+    ai, aj, ak = np.broadcast_arrays(*[np.asarray(a, dtype=np.float64) for a in (ai, aj, ak)])
+    if frame:
+        ai, ak = ak, ai
+    if parity:
+        aj = -aj
+
+    ci, si = np.cos(ai / 2), np.sin(ai / 2)
+    cj, sj = np.cos(aj / 2), np.sin(aj / 2)
+    ck, sk = np.cos(ak / 2), np.sin(ak / 2)
+    cc, cs = ci*ck, ci*sk
+    sc, ss = si*ck, si*sk
+
+    q = np.empty(ai.shape + (4,), dtype=np.float64)
+    if repetition:
+        q[...,i] = cj*(cs + sc)
+        q[...,j] = sj*(cc + ss)
+        q[...,k] = sj*(cs - sc)
+        q[...,3] = cj*(cc - ss)
+    else:
+        q[...,i] = cj*sc - sj*cs
+        q[...,j] = cj*ss + sj*cc
+        q[...,k] = cj*cs - sj*sc
+        q[...,3] = cj*cc + sj*ss
+    if parity:
+        q[...,j] *= -1
+    return q
+
+def quat_to_angle_axis(q):
+    """ Returns angles [...] and unit axes [... x 3] of [... x 4] unit quaternions """
+    q = np.asarray(q, dtype=np.float64)
+    halftheta = np.arccos(np.clip(q[...,3], -1, 1))
+    s = np.sin(halftheta)
+    small = np.fabs(halftheta) < 1e-12
+    axis = np.where(small[...,np.newaxis], [0., 0., 1.],
+                    q[...,:3] / np.where(small, 1.0, s)[...,np.newaxis])
+    return np.where(small, 0.0, halftheta * 2), axis
+
+def quat_from_angle_axis(theta, axis):
+    """ Returns [... x 4] unit quaternions from angles [...] and axes [... x 3] """
+    theta, axis = np.asarray(theta, dtype=np.float64), np.asarray(axis, dtype=np.float64)
+    norm = np.linalg.norm(axis, axis=-1)
+    t = np.where(norm == 0, 0.0, np.sin(theta / 2) / np.where(norm == 0, 1.0, norm))
+    return np.concatenate([axis * t[...,np.newaxis], 
+                           np.cos(np.where(norm == 0, 0.0, theta) / 2)[...,np.newaxis]], axis=-1)
+
 ###############################################################################
 class Quaternion(object):
     """
     Generic Quaternion class
        : (qx, qy, qz, qw)
+
+    q is immutable, i.e. read-only and cannot be re-assigned 
+    (RigidTransform caches matrices derived from it), operations 
+    return new quaternions
     
     """
     def __init__ (self, q=[0,0,0,1]):
         if isinstance(q, Quaternion): 
-            self.q = q.q.copy()
-        else:
-            try: 
-                self.q = np.array(q, np.float64)
-            except:
-                raise TypeError("Quaternion can not be initialized from {:}".format(type(q)))
-        
+            q = q.q
+        try: 
+            self._set(np.array(q, np.float64))
+        except (TypeError, ValueError):
+            raise TypeError("Quaternion can not be initialized from {:}".format(type(q)))
         self.normalize()
+
+    def _set(self, q): 
+        self.q_ = q
+        self.q_.flags.writeable = False
+
+    @property
+    def q(self): 
+        return self.q_
+
+    def __getstate__(self): 
+        return dict(q=self.q_)
+
+    def __setstate__(self, state): 
+        self._set(np.array(state['q'], np.float64))
     
     def __repr__ (self):
         return '%s' % self.q
@@ -47,7 +256,7 @@ class Quaternion(object):
         """ Check validity of unit-quaternion norm """
         norm = self.norm()
         if abs(norm - 1) > 1e-6:
-            self.q /= norm
+            self._set(self.q_ / norm)
 
     def norm(self): 
         return np.linalg.norm(self.q)
@@ -64,36 +273,13 @@ class Quaternion(object):
         return Quaternion(tf.quaternion_conjugate(self.q))
 
     def rotate(self, v):
-        """ Rotate a vector with this quaternion in reverse """
-        qx, qy, qz, qw = self.q
-
-        ab  =  qw*qx
-        ac  =  qw*qy
-        ad  =  qw*qz
-        nbb = -qx*qx
-        bc  =  qx*qy
-        bd  =  qx*qz
-        ncc = -qy*qy
-        cd  =  qy*qz
-        ndd = -qz*qz
-
-        return np.array((2*( (ncc + ndd)*v[0] + (bc -  ad)*v[1] + (ac + bd)*v[2] ) + v[0],
-                         2*( (ad +  bc)*v[0] + (nbb + ndd)*v[1] + (cd - ab)*v[2] ) + v[1],
-                         2*( (bd -  ac)*v[0] + (ab +  cd)*v[1] + (nbb + ncc)*v[2] ) + v[2]))
-
-    def rotate_rev (self, vector):
-        """ Rotate a vector with this quaternion in reverse """
-        qx, qy, qz, qw = q
-        b = np.array((0, v[0], v[1], v[2]))
-        a = np.array((b[0]*qw - b[1]*qx - b[2]*qy - b[3]*qz,
-             b[0]*qx + b[1]*qw + b[2]*qz - b[3]*qy,
-             b[0]*qy - b[1]*qz + b[2]*qw + b[3]*qx,
-             b[0]*qz + b[1]*qy - b[2]*qx + b[3]*qw))
-        b[0] = qw
-        b[1:] = -q[:3]
-        return np.array((b[0]*a[1] + b[1]*a[0] + b[2]*a[3] - b[3]*a[2],
-                         b[0]*a[2] - b[1]*a[3] + b[2]*a[0] + b[3]*a[1],
-                         b[0]*a[3] + b[1]*a[2] - b[2]*a[1] + b[3]*a[0]))
+        """ Rotate a vector [3] (or point set [N x 3]) with this quaternion """
+        return quat_rotate(self.q, v)
+
+    def rotate_rev(self, v):
+        """ Rotate a vector [3] (or point set [N x 3]) with this quaternion in reverse """
+        return quat_rotate_rev(self.q, v)
+
     def interpolate(self, other, this_weight):
         q0, q1 = np.roll(self.q, shift=1), np.roll(other.q, shift=1)
         u = 1 - this_weight
@@ -194,7 +380,7 @@ class Quaternion(object):
     @property
     def R(self): 
         """ Returns 3x3 transformation matrix """ 
-        return self.to_matrix()[:3,:3]
+        return quat_to_matrix(self.q)
 
     @property
     def x(self): 
@@ -227,6 +413,185 @@ class Quaternion(object):
 
 
 
+###############################################################################
+class QuaternionArray(object):
+    """
+    Array of quaternions backed by a contiguous [N x 4] array
+       : (qx, qy, qz, qw)
+
+    Operations are elementwise over N (see Quaternion), and 
+    broadcast against single Quaternions. 
+    """
+    __slots__ = ['q']
+
+    def __init__(self, q=[[0,0,0,1]]):
+        if isinstance(q, (Quaternion, QuaternionArray)):
+            q = q.q
+        try:
+            q = np.array(q, dtype=np.float64, ndmin=2)
+        except:
+            raise TypeError("QuaternionArray can not be initialized from {:}".format(type(q)))
+        if q.ndim != 2 or q.shape[1] != 4:
+            raise ValueError('QuaternionArray expects [N x 4] (xyzw), provided {:}'.format(q.shape))
+        self.q = quat_normalize(q)
+
+    @classmethod
+    def _from_array(cls, q):
+        """ Wrap an (already normalized) [N x 4] array without copies """
+        a = cls.__new__(cls)
+        a.q = q
+        return a
+
+    def __repr__(self):
+        return 'QuaternionArray: %i quaternions' % len(self)
+
+    def __len__(self):
+        return len(self.q)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return Quaternion(self.q[idx])
+        return QuaternionArray._from_array(self.q[idx])
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    # Basic operations
+
+    def __mul__(self, other):
+        """ Multiply (Hamilton product) quaternions elementwise with others """
+        if isinstance(other, float):
+            return QuaternionArray._from_array(self.q * other)
+        elif isinstance(other, (Quaternion, QuaternionArray)):
+            return QuaternionArray._from_array(quat_multiply(self.q, other.q))
+        else:
+            raise TypeError('QuaternionArray multiply error')
+
+    def normalize(self):
+        """ Normalize to unit-quaternions (in place) """
+        self.q = quat_normalize(self.q)
+
+    def norm(self):
+        return np.linalg.norm(self.q, axis=1)
+
+    def dot(self, other):
+        return np.sum(self.q * other.q, axis=-1)
+
+    def inverse(self):
+        """ Invert rotations assuming unit quaternions """
+        return QuaternionArray._from_array(quat_conjugate(self.q))
+
+    def conjugate(self):
+        """ Quaternion conjugates """
+        return QuaternionArray._from_array(quat_conjugate(self.q))
+
+    def rotate(self, v):
+        """ Rotate vectors [N x 3] (or N point sets [N x M x 3]) """
+        return quat_rotate(self.q, v)
+
+    def rotate_rev(self, v):
+        """ Rotate vectors [N x 3] (or N point sets [N x M x 3]) in reverse """
+        return quat_rotate_rev(self.q, v)
+
+    def slerp(self, other, w):
+        """ Spherical linear interpolation with weights w [N] (w=0: self, w=1: other) """
+        return QuaternionArray._from_array(quat_slerp(self.q, other.q, w))
+
+    # To conversions
+
+    def to_wxyz(self):
+        return np.roll(self.q, shift=1, axis=1)
+
+    def to_xyzw(self):
+        """ Return (x,y,z,w) representation """
+        return self.q
+
+    def to_rpy(self, axes='rxyz'):
+        """ Return [N x 3] Euler angles with XYZ convention """
+        return quat_to_euler(self.q, axes=axes)
+
+    def to_angle_axis(self):
+        """ Return angles [N], and axes [N x 3] """
+        return quat_to_angle_axis(self.q)
+
+    def to_matrix(self):
+        """ Returns [N x 3 x 3] rotation matrices """
+        return quat_to_matrix(self.q)
+
+    def to_list(self):
+        """ Returns a list of Quaternions """
+        return [Quaternion(q) for q in self.q]
+
+    # From conversions
+
+    @classmethod
+    def from_wxyz(cls, q):
+        return cls(np.roll(q, shift=-1, axis=-1))
+
+    @classmethod
+    def from_xyzw(cls, q):
+        return cls(q)
+
+    @classmethod
+    def from_matrix(cls, matrix):
+        """ From [N x 3 x 3] (or [N x 4 x 4]) rotation matrices (Shepperd's method) """
+        return cls._from_array(quat_from_matrix(np.asarray(matrix).reshape((-1,) + np.shape(matrix)[-2:])))
+
+    @classmethod
+    def from_rpy(cls, roll, pitch, yaw, axes='rxyz'):
+        """ Construct QuaternionArray from [N] Euler angles """
+        return cls(quat_from_euler(roll, pitch, yaw, axes=axes))
+
+    @classmethod
+    def from_angle_axis(cls, theta, axis):
+        """ Construct QuaternionArray from angles [N] and axes [N x 3] """
+        return cls(quat_from_angle_axis(theta, axis))
+
+    @classmethod
+    def from_list(cls, quats):
+        """ From a list of Quaternions """
+        return cls(np.vstack([q.q for q in quats]))
+
+    @classmethod
+    def identity(cls, n=1):
+        return cls._from_array(np.tile([0.,0.,0.,1.], (n,1)))
+
+    # Properties
+
+    @property
+    def R(self):
+        """ Returns [N x 3 x 3] rotation matrices """
+        return self.to_matrix()
+
+    @property
+    def x(self):
+        return self.q[:,0]
+
+    @property
+    def y(self):
+        return self.q[:,1]
+
+    @property
+    def z(self):
+        return self.q[:,2]
+
+    @property
+    def w(self):
+        return self.q[:,3]
+
+    @property
+    def wxyz(self):
+        return self.to_wxyz()
+
+    @property
+    def xyzw(self):
+        return self.to_xyzw()
+
+    @property
+    def rpy(self):
+        return self.to_rpy()
+
 ###############################################################################
 if __name__ == "__main__":
     import random
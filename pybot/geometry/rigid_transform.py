@@ -6,7 +6,9 @@ General-purpose class for rigid-body transformations.
 
 import numpy as np
 import transformations as tf
-from pybot.geometry.quaternion import Quaternion
+from pybot.geometry.quaternion import Quaternion, QuaternionArray, quat_normalize, quat_conjugate, \
+    quat_multiply, quat_rotate, quat_slerp, quat_to_matrix, quat_from_matrix
+from pybot.geometry.lie_algebra import se3_exp, se3_log
 
 ###############################################################################
 def normalize_vec(v): 
@@ -98,6 +100,11 @@ class RigidTransform(object):
     
     quat: Quaternion/Rotation (xyzw)
     tvec: Translation (xyz)
+
+    The rotation matrix R and the homogenous matrix are lazily
+    computed, cached and read-only. tvec is read-only as well, and 
+    quat is immutable; re-assigning quat or tvec invalidates the 
+    cached matrices.
     
     """
     def __init__(self, xyzw=[0.,0.,0.,1.], tvec=[0.,0.,0.]):
@@ -105,6 +112,43 @@ class RigidTransform(object):
         self.quat = Quaternion(xyzw)
         self.tvec = np.array(tvec)
 
+    def _invalidate(self): 
+        """ Drop cached matrices, called whenever quat or tvec is set """
+        self.R_, self.matrix_ = None, None
+
+    def __getstate__(self): 
+        """ Pickled without the cached matrices (as quat, tvec) """
+        state = dict(self.__dict__)
+        for key in ['R_', 'matrix_']: 
+            state.pop(key, None)
+        state['quat'], state['tvec'] = state.pop('quat_'), state.pop('tvec_')
+        return state
+
+    def __setstate__(self, state): 
+        state = dict(state)
+        quat, tvec = state.pop('quat'), state.pop('tvec')
+        self.__dict__.update(state)
+        self.quat, self.tvec = quat, tvec
+
+    @property
+    def quat(self): 
+        return self.quat_
+
+    @quat.setter
+    def quat(self, q): 
+        self.quat_ = q if isinstance(q, Quaternion) else Quaternion(q)
+        self._invalidate()
+
+    @property
+    def tvec(self): 
+        return self.tvec_
+
+    @tvec.setter
+    def tvec(self, t): 
+        self.tvec_ = np.array(t)
+        self.tvec_.flags.writeable = False
+        self._invalidate()
+
     def __repr__(self):
         return 'rpy (rxyz): %s tvec: %s' % \
             (np.array_str(self.quat.to_rpy(axes='rxyz'), precision=2, suppress_small=True), 
@@ -122,9 +166,11 @@ class RigidTransform(object):
         """
         if isinstance(other, RigidTransform):
             return self.oplus(other)
+        elif isinstance(other, RigidTransformArray): 
+            # Composed by RigidTransformArray.__rmul__
+            return NotImplemented
         else:          
-            X = np.hstack([other, np.ones((len(other),1))]).T
-            return (np.dot(self.matrix, X).T)[:,:3]
+            return np.dot(other, self.R.T) + self.tvec
 
     def __rmul__(self, other): 
         raise NotImplementedError('Right multiply not implemented yet!')                    
@@ -154,21 +200,19 @@ class RigidTransform(object):
         return self * p_tr
 
     def rotate_vec(self, v): 
-        if v.ndim == 2: 
-            return np.vstack(map(lambda v_: self.quat.rotate(v_), v))
-        else: 
-            assert(v.ndim == 1 or (v.ndim == 2 and v.shape[0] == 1))
-            return self.quat.rotate(v)
+        """ Rotate a vector [3] (or point set [N x 3]) """
+        return np.dot(v, self.R.T)
 
 
     def interpolate(self, other, w): 
         """
-        LERP interpolation on rotation, and linear interpolation on position 
+        SLERP interpolation on rotation, and linear interpolation on position 
+        (w=0: self, w=1: other)
         Other approaches: 
         https://www.cvl.isy.liu.se/education/graduate/geometry-for-computer-vision-2014/geometry2014/lecture7.pdf
         """
         assert(w >= 0 and w <= 1.0)
-        return self.from_Rt(self.rotation.interpolate(other.rotation, w).R, self.t + w * (other.t - self.t))
+        return RigidTransform(quat_slerp(self.quat.q, other.quat.q, w), self.t + w * (other.t - self.t))
 
         # return self.from_Rt(self.R * expm3(w * logm(self.R.T * other.R)), self.t + w * (other.t - self.t))
         # return self.from_matrix(self.matrix * expm(w * logm((self.inverse() * other).matrix)))
@@ -190,14 +234,14 @@ class RigidTransform(object):
 
     def to_matrix(self):
         """ Returns a 4x4 homogenous matrix of the form [R t; 0 1] """
-        result = self.quat.to_matrix()
+        result = np.eye(4)
+        result[:3, :3] = self.R
         result[:3, 3] = self.tvec
         return result
 
     def to_Rt(self):
         """ Returns rotation R, and translational vector t """
-        T = self.to_matrix()
-        return T[:3,:3].copy(), T[:3,3].copy()
+        return self.R.copy(), np.array(self.tvec, dtype=np.float64).ravel()
 
     def to_rpyxyz(self, axes='rxyz'):
         r, p, y = self.quat.to_rpy(axes=axes)
@@ -241,7 +285,11 @@ class RigidTransform(object):
 
     @property
     def R(self): 
-        return self.quat.R
+        """ Returns cached (read-only) 3x3 rotation matrix """
+        if self.R_ is None: 
+            self.R_ = quat_to_matrix(self.quat.q)
+            self.R_.flags.writeable = False
+        return self.R_
 
     @property
     def t(self): 
@@ -265,6 +313,231 @@ class RigidTransform(object):
 
     @property
     def matrix(self): 
+        """ Returns cached (read-only) 4x4 homogenous matrix """
+        if self.matrix_ is None: 
+            self.matrix_ = self.to_matrix()
+            self.matrix_.flags.writeable = False
+        return self.matrix_
+
+###############################################################################
+class RigidTransformArray(object):
+    """
+    Batched SE(3) rigid transforms backed by contiguous [N x 4]
+    quaternion and [N x 3] translation arrays. Operations are
+    elementwise over N, and broadcast against single RigidTransforms.
+
+    xyzw: Quaternions/Rotations [N x 4] (xyzw)
+    tvec: Translations [N x 3] (xyz)
+
+    """
+    def __init__(self, xyzw=[[0.,0.,0.,1.]], tvec=[[0.,0.,0.]]):
+        """ Initialize a RigidTransformArray with [N x 4] Quaternions and [N x 3] Positions """
+        self.q_ = quat_normalize(np.array(xyzw, dtype=np.float64, ndmin=2))
+        self.t_ = np.array(tvec, dtype=np.float64, ndmin=2)
+        if self.q_.shape[1:] != (4,) or self.t_.shape[1:] != (3,) or \
+           len(self.q_) != len(self.t_):
+            raise ValueError('RigidTransformArray expects [N x 4] xyzw and [N x 3] tvec, '
+                             'provided {:} and {:}'.format(self.q_.shape, self.t_.shape))
+
+    @classmethod
+    def _from_arrays(cls, q, t):
+        """ Wrap (already normalized) quaternion and translation arrays without copies """
+        a = cls.__new__(cls)
+        a.q_, a.t_ = q, t
+        return a
+
+    def __repr__(self):
+        return 'RigidTransformArray: %i poses' % len(self)
+
+    def __len__(self):
+        return len(self.q_)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return RigidTransform(self.q_[idx], self.t_[idx])
+        return RigidTransformArray._from_arrays(self.q_[idx], self.t_[idx])
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __mul__(self, other):
+        """
+        Left-multiply RigidTransformArray with other rigid transforms
+
+        Two variants:
+           RigidTransform(Array): Identical to oplus operation
+           ndarray: transform [M x 3] point set (or [N x M x 3]
+                    point sets) with each of the N poses [N x M x 3]
+
+        """
+        if isinstance(other, (RigidTransform, RigidTransformArray, list)):
+            return self.oplus(other)
+        else:
+            X = np.asarray(other)
+            if X.ndim == 2:
+                X = X[np.newaxis]
+            return quat_rotate(self.q_[:,np.newaxis], X) + self.t_[:,np.newaxis]
+
+    def __rmul__(self, other):
+        """
+        Right-multiply RigidTransformArray with a RigidTransform (or list) 
+        on the left, i.e. other.oplus(p) for each of the N poses p
+        """
+        q, t = RigidTransformArray._unpack(other)
+        return RigidTransformArray._from_arrays(
+            quat_multiply(q, self.q_), quat_rotate(q, self.t_) + t)
+
+    @staticmethod
+    def _unpack(other):
+        """ Returns quaternion and translation arrays for broadcasting """
+        if isinstance(other, RigidTransformArray):
+            return other.q_, other.t_
+        elif isinstance(other, RigidTransform):
+            return other.quat.q, other.tvec
+        elif isinstance(other, list):
+            return RigidTransformArray._unpack(RigidTransformArray.from_list(other))
+        else:
+            raise TypeError("Type inconsistent", type(other), other.__class__)
+
+    # Basic operations
+
+    def inverse(self):
+        """ Returns a new RigidTransformArray with the inverse of each pose """
+        qinv = quat_conjugate(self.q_)
+        return RigidTransformArray._from_arrays(qinv, quat_rotate(qinv, -self.t_))
+
+    def oplus(self, other):
+        q, t = RigidTransformArray._unpack(other)
+        return RigidTransformArray._from_arrays(
+            quat_multiply(self.q_, q), quat_rotate(self.q_, t) + self.t_)
+
+    def wrt(self, p_tr):
+        """
+        self: p_ro, desired: p_to
+        o: other, r: reference, t: target
+        """
+        return self * p_tr
+
+    def interpolate(self, other, w):
+        """
+        SLERP interpolation on rotation, and linear interpolation on position
+        with weights w [N] (w=0: self, w=1: other)
+        """
+        q, t = RigidTransformArray._unpack(other)
+        w = np.asarray(w, dtype=np.float64)
+        return RigidTransformArray._from_arrays(
+            quat_slerp(self.q_, q, w), self.t_ + w[...,np.newaxis] * (t - self.t_))
+
+    def cumulative_oplus(self):
+        """
+        Cumulative compounding of the poses [p_0, p_0 * p_1, p_0 * p_1 * p_2, ...],
+        e.g. relative odometry to absolute trajectory. Evaluated as a
+        (Hillis-Steele) prefix scan with log2(N) vectorized passes.
+        """
+        q, t = self.q_.copy(), self.t_.copy()
+        shift = 1
+        while shift < len(q):
+            # p[i] = p[i-shift] * p[i]
+            qa, ta = q[:-shift], t[:-shift]
+            t_ = quat_rotate(qa, t[shift:]) + ta
+            q_ = quat_multiply(qa, q[shift:])
+            q[shift:], t[shift:] = q_, t_
+            shift *= 2
+        return RigidTransformArray._from_arrays(quat_normalize(q), t)
+
+    # (To) Conversions
+
+    def to_matrix(self):
+        """ Returns [N x 4 x 4] homogenous matrices of the form [R t; 0 1] """
+        T = np.zeros((len(self), 4, 4))
+        T[:,:3,:3] = quat_to_matrix(self.q_)
+        T[:,:3,3] = self.t_
+        T[:,3,3] = 1.0
+        return T
+
+    def to_Rt(self):
+        """ Returns rotations R [N x 3 x 3], and translational vectors t [N x 3] """
+        return quat_to_matrix(self.q_), self.t_.copy()
+
+    def to_list(self):
+        """ Returns a list of RigidTransforms """
+        return [RigidTransform(q, t) for q, t in zip(self.q_, self.t_)]
+
+    def to_se3(self):
+        """ Returns [N x 6] twists (w, v), via the SE(3) log map """
+        return se3_log(self.to_matrix())
+
+    # (From) Conversions
+
+    @classmethod
+    def from_Rt(cls, R, t):
+        return cls._from_arrays(quat_from_matrix(R),
+                                np.array(t, dtype=np.float64, ndmin=2))
+
+    @classmethod
+    def from_matrix(cls, T):
+        """ From [N x 4 x 4] (or [N x 3 x 4]) homogenous matrices """
+        T = np.asarray(T, dtype=np.float64)
+        return cls._from_arrays(quat_from_matrix(T), T[:,:3,3].copy())
+
+    @classmethod
+    def from_se3(cls, xi):
+        """ From [N x 6] twists (w, v), via the SE(3) exp map """
+        return cls.from_matrix(se3_exp(xi))
+
+    @classmethod
+    def from_list(cls, poses):
+        """ From a list of RigidTransforms """
+        if not len(poses):
+            return cls._from_arrays(np.zeros((0,4)), np.zeros((0,3)))
+        return cls._from_arrays(np.vstack([p.quat.q for p in poses]),
+                                np.vstack([p.tvec for p in poses]).astype(np.float64))
+
+    @classmethod
+    def identity(cls, n=1):
+        return cls._from_arrays(np.tile([0.,0.,0.,1.], (n,1)), np.zeros((n,3)))
+
+    # Properties
+    @property
+    def quat(self):
+        """ QuaternionArray view of the rotations """
+        return QuaternionArray._from_array(self.q_)
+
+    @property
+    def rotation(self):
+        return self.quat
+
+    @property
+    def orientation(self):
+        return self.quat
+
+    @property
+    def wxyz(self):
+        return np.roll(self.q_, shift=1, axis=1)
+
+    @property
+    def xyzw(self):
+        return self.q_
+
+    @property
+    def R(self):
+        return quat_to_matrix(self.q_)
+
+    @property
+    def t(self):
+        return self.t_
+
+    @property
+    def tvec(self):
+        return self.t_
+
+    @property
+    def translation(self):
+        return self.t_
+
+    @property
+    def matrix(self):
         return self.to_matrix()
 
 ###############################################################################
@@ -394,6 +667,21 @@ class Sim3(RigidTransform):
         RigidTransform.__init__(self, xyzw=xyzw, tvec=tvec)
         self.scale = scale
 
+    @property
+    def scale(self): 
+        return self.scale_
+
+    @scale.setter
+    def scale(self, s): 
+        self.scale_ = s
+        self._invalidate()
+
+    def __mul__(self, other): 
+        if isinstance(other, RigidTransform):
+            return self.oplus(other)
+        else: 
+            return np.dot(other, self.R.T) / self.scale + self.tvec
+
     @classmethod
     def from_matrix(cls, T):
         sR_t = np.eye(4)
@@ -401,10 +689,10 @@ class Sim3(RigidTransform):
         return cls(Quaternion.from_matrix(sR_t), T[:3,3], scale=1.0 / T[3,3])
 
     def to_matrix(self):
-        result = self.quat.to_matrix()
+        result = np.eye(4)
+        result[:3, :3] = self.R / self.scale
         result[:3, 3] = self.tvec
         result[3, 3] = 1.0 / self.scale
-        result[:3, :3] /= self.scale
         return result
 
 class Pose(RigidTransform): 
@@ -0,0 +1,45 @@
+# Author: Sudeep Pillai <spillai@csail.mit.edu>
+# License: MIT
+
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+def async_prefetch(func, iterable, prefetch=4, workers=1, processes=False):
+    """
+    Ordered, bounded-lookahead map: apply func to the items of iterable
+    on a pool of workers, keeping at most `prefetch` results in flight
+    ahead of the consumer.
+
+    Worker exceptions are re-raised in the consumer (in order), and the
+    pool is terminated when the consumer stops early (i.e. the generator
+    is closed or garbage collected).
+
+        prefetch:   Maximum number of items decoded ahead (0 to disable)
+        workers:    Number of threads (or processes)
+        processes:  Use a process pool (func and items need to be picklable)
+
+    Usage:
+        for im in async_prefetch(cv2.imread, files, prefetch=8, workers=4):
+            ...
+    """
+    if prefetch < 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    it = iter(iterable)
+    pool = Pool(workers) if processes else ThreadPool(workers)
+    try:
+        pending = deque(pool.apply_async(func, (item,)) for item in islice(it, prefetch))
+        while len(pending):
+            res = pending.popleft()
+
+            # Keep the pipeline full while waiting on the oldest item
+            for item in islice(it, 1):
+                pending.append(pool.apply_async(func, (item,)))
+            yield res.get()
+    finally:
+        pool.terminate()
+        pool.join()
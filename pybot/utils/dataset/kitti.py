@@ -10,8 +10,9 @@ from pybot.utils.db_utils import AttrDict
 from pybot.utils.dataset_readers import natural_sort, \
     FileReader, DatasetReader, ImageDatasetReader, \
     StereoDatasetReader, VelodyneDatasetReader
+from pybot.utils.frame_store import packed_stereo_reader
 
-from pybot.geometry.rigid_transform import RigidTransform
+from pybot.geometry.rigid_transform import RigidTransformArray
 from pybot.vision.camera_utils import StereoCamera
 
 def kitti_stereo_calib(sequence, scale=1.0): 
@@ -32,17 +33,19 @@ def kitti_stereo_calib(sequence, scale=1.0):
 #     baseline_px = 386.1448 * scale
 #     return get_calib_params(f, f, cx, cy, baseline_px=baseline_px)
 
-def kitti_load_poses(fn): 
-    X = (np.fromfile(fn, dtype=np.float64, sep=' ')).reshape(-1,12)
-    return map(lambda p: RigidTransform.from_Rt(p[:3,:3], p[:3,3]), 
-                map(lambda x: x.reshape(3,4), X))
+def kitti_load_poses(fn, as_array=False): 
+    X = (np.fromfile(fn, dtype=np.float64, sep=' ')).reshape(-1,3,4)
+    poses = RigidTransformArray.from_matrix(X)
+    return poses if as_array else poses.to_list()
 
 def kitti_poses_to_str(poses): 
     return "\r\n".join(map(lambda x: " ".join(map(str, 
                                                   (x.matrix[:3,:4]).flatten())), poses))
 
 def kitti_poses_to_mat(poses): 
-    return np.vstack(map(lambda x: (x.matrix[:3,:4]).flatten(), poses)).astype(np.float64)
+    if not isinstance(poses, RigidTransformArray): 
+        poses = RigidTransformArray.from_list(poses)
+    return poses.to_matrix()[:,:3,:4].reshape(-1,12)
 
 
 class KITTIDatasetReader(object): 
@@ -64,7 +67,15 @@ class KITTIDatasetReader(object):
                  left_template='image_0/%06i.png', 
                  right_template='image_1/%06i.png', 
                  velodyne_template='velodyne/%06i.bin',
-                 start_idx=0, max_files=50000, scale=1.0): 
+                 start_idx=0, max_files=50000, scale=1.0, packed=None): 
+        """
+        packed: Optional packed frame store with left/right channels 
+                (see pybot.utils.frame_store), used instead of the images. 
+                Frames [start_idx, start_idx + max_files) of the sequence 
+                are used (the store's meta start_idx, every_k_frames and 
+                scale are checked, so that images, velodyne and calib 
+                remain in sync)
+        """
 
         # Set args
         self.sequence = sequence
@@ -75,10 +86,13 @@ class KITTIDatasetReader(object):
 
         # Read stereo images
         seq_directory = os.path.join(os.path.expanduser(directory), 'sequences', sequence)
-        self.stereo = StereoDatasetReader(directory=seq_directory, 
-                                          left_template=os.path.join(seq_directory,left_template), 
-                                          right_template=os.path.join(seq_directory,right_template), 
-                                          start_idx=start_idx, max_files=max_files, scale=scale)
+        if packed is not None: 
+            self.stereo = KITTIDatasetReader._packed_stereo(packed, start_idx, max_files, scale)
+        else: 
+            self.stereo = StereoDatasetReader(directory=seq_directory, 
+                                              left_template=os.path.join(seq_directory,left_template), 
+                                              right_template=os.path.join(seq_directory,right_template), 
+                                              start_idx=start_idx, max_files=max_files, scale=scale)
 
         # Read poses
         try: 
@@ -98,6 +112,24 @@ class KITTIDatasetReader(object):
 
         print 'Initialized stereo dataset reader with %f scale' % scale
 
+    @staticmethod
+    def _packed_stereo(packed, start_idx, max_files, scale):
+        """ Packed stereo reader sliced to frames [start_idx, start_idx + max_files) """
+        stereo = packed_stereo_reader(packed)
+        meta = stereo.left.store.meta
+        if meta.get('every_k_frames', 1) != 1:
+            raise ValueError('Packed store {:} skips frames (every_k_frames={:}), '
+                             'cannot be aligned with the sequence'
+                             .format(stereo.left.store.filename, meta['every_k_frames']))
+        if not np.isclose(meta.get('scale', 1.0), scale):
+            raise ValueError('Packed store {:} has scale {:}, requested {:}'
+                             .format(stereo.left.store.filename, meta.get('scale', 1.0), scale))
+        offset = start_idx - meta.get('start_idx', 0)
+        if offset < 0:
+            raise ValueError('Packed store {:} starts at frame {:}, requested start_idx={:}'
+                             .format(stereo.left.store.filename, meta.get('start_idx', 0), start_idx))
+        return stereo[offset:offset+max_files]
+
     def iteritems(self, *args, **kwargs): 
         return self.stereo.left.iteritems(*args, **kwargs)
 
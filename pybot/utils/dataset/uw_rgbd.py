@@ -17,12 +17,13 @@ from pybot.utils.misc import progressbar
 from pybot.utils.db_utils import AttrDict
 from pybot.utils.dataset_readers import read_dir, read_files, natural_sort, \
     DatasetReader, ImageDatasetReader
+from pybot.utils.frame_store import PackedFrameStore, PackedDatasetReader
 from pybot.vision.draw_utils import annotate_bbox
 from pybot.vision.camera_utils import kinect_v1_params, \
     Camera, CameraIntrinsic, CameraExtrinsic, \
-    check_visibility, get_object_bbox
+    check_visibility, get_object_bboxes
 
-from pybot.geometry.rigid_transform import Quaternion, RigidTransform
+from pybot.geometry.rigid_transform import Quaternion, RigidTransform, RigidTransformArray
 from pybot.externals.plyfile import PlyData
 
 # __categories__ = ['flashlight', 'cap', 'cereal_box', 'coffee_mug', 'soda_can']
@@ -286,17 +287,23 @@ class UWRGBDSceneDataset(UWRGBDDataset):
         RGB-D reader 
         Given mask, depth, and rgb files build an read iterator with appropriate process_cb
         """
-        def __init__(self, files, meta_file, aligned_file, version, name=''): 
+        def __init__(self, files, meta_file, aligned_file, version, name='', packed=None): 
             self.name = name
             self.version = version
 
             self.rgb_files, self.depth_files = UWRGBDSceneDataset._reader.scene_files(files, version)
             assert(len(self.depth_files) == len(self.rgb_files))
 
-            # RGB, Depth
+            # RGB, Depth (optionally from a packed frame store with rgb/depth channels)
             # TODO: Check depth seems scaled by 256 not 16
-            self.rgb = ImageDatasetReader.from_filenames(self.rgb_files)
-            self.depth = ImageDatasetReader.from_filenames(self.depth_files)
+            if packed is not None: 
+                store = PackedFrameStore(packed)
+                self.rgb = PackedDatasetReader(store, 'rgb')
+                self.depth = PackedDatasetReader(store, 'depth')
+                assert(len(self.rgb) == len(self.rgb_files))
+            else: 
+                self.rgb = ImageDatasetReader.from_filenames(self.rgb_files)
+                self.depth = ImageDatasetReader.from_filenames(self.depth_files)
 
             # BBOX
             self.bboxes = UWRGBDSceneDataset._reader.load_bboxes(meta_file, version) \
@@ -524,9 +531,35 @@ class UWRGBDSceneDataset(UWRGBDDataset):
             draw_utils.publish_pose_list('aligned_poses', [RigidTransform(tvec=obj.center) for obj in self.map_info.objects], 
                                          texts=[str(obj.label) for obj in self.map_info.objects])
 
-        def get_bboxes(self, pose): 
+        def object_bboxes(self, batch_size=256): 
+            """
+            Bounding boxes of each object in every frame, batched over the 
+            scene's poses (computed once, and cached)
+
+            Returns: 
+               AttrDict(bboxes [M x K x 4], depths [M x K], valid [M x K])
+               for M objects, K frames
+            """
+            if getattr(self, 'object_bboxes_', None) is None: 
+                poses = RigidTransformArray.from_list(self.poses).inverse()
+                bboxes, depths, valid = [], [], []
+                for obj in self.map_info.objects: 
+                    res = [get_object_bboxes(self.map_info.camera, obj.points, 
+                                             poses=poses[k:k+batch_size], subsample=3, scale=1)
+                           for k in range(0, len(poses), batch_size)]
+                    bboxes.append(np.vstack([r[0] for r in res]))
+                    depths.append(np.hstack([r[1] for r in res]))
+                    valid.append(np.hstack([r[2] for r in res]))
+                self.object_bboxes_ = AttrDict(bboxes=np.stack(bboxes), depths=np.stack(depths), 
+                                               valid=np.stack(valid))
+            return self.object_bboxes_
+
+        def get_bboxes(self, pose, index=None): 
             """
             Support for occlusion handling is incomplete/bug-ridden
+
+            index: Frame index of the pose, to look up the batched 
+                   object bboxes (see object_bboxes)
             """
 
             # 1. Get pose for a particular frame, 
@@ -542,19 +575,26 @@ class UWRGBDSceneDataset(UWRGBDDataset):
             object_centers = np.vstack([obj.center for obj in self.map_info.objects])
             visible_inds, = np.where(check_visibility(self.map_info.camera, object_centers))
 
+            if index is not None: 
+                res = self.object_bboxes()
+                bboxes, depths, valid = res.bboxes[:,index], res.depths[:,index], res.valid[:,index]
+            else: 
+                res = [get_object_bboxes(self.map_info.camera, obj.points, poses=[pose.inverse()], 
+                                         subsample=3, scale=1) for obj in self.map_info.objects]
+                bboxes, depths, valid = [np.concatenate(r) for r in zip(*res)]
+
             object_candidates = []
             for ind in visible_inds:
+                if not valid[ind]: 
+                    continue
                 obj = self.map_info.objects[ind]
-                label = obj.label
-                pts2d, coords, depth = get_object_bbox(self.map_info.camera, obj.points, subsample=3, scale=1)
-                if coords is not None: 
-                    object_candidates.append(
-                        AttrDict(
-                            target=obj.label, 
-                            category=UWRGBDDataset.target_unhash[obj.label], 
-                            coords=coords, 
-                            depth=depth, 
-                            uid=obj.uid))
+                object_candidates.append(
+                    AttrDict(
+                        target=obj.label, 
+                        category=UWRGBDDataset.target_unhash[obj.label], 
+                        coords=bboxes[ind], 
+                        depth=depths[ind], 
+                        uid=obj.uid))
 
             # # 3. Ensure occlusions are handled, sort by increasing depth, and filter 
             # # based on overlapping threshold
@@ -594,7 +634,7 @@ class UWRGBDSceneDataset(UWRGBDDataset):
 
             if self.version == 'v2': 
                 if bbox is None and hasattr(self, 'map_info'): 
-                    bbox = self.get_bboxes(pose)
+                    bbox = self.get_bboxes(pose, index=index)
 
             # print 'Processing pose', pose, bbox
             return AttrDict(index=index, img=rgb_im, depth=depth_im, 
@@ -625,12 +665,20 @@ class UWRGBDSceneDataset(UWRGBDDataset):
                 yield self._process_items(index, rgb_im, depth_im, bbox, pose)
 
 
-    def __init__(self, version, directory, targets=None, num_targets=None, blacklist=['']):
+    def __init__(self, version, directory, targets=None, num_targets=None, blacklist=[''], 
+                 packed_directory=None):
+        """
+        packed_directory: Optional directory of packed frame stores (<scene>.pfs 
+                          with rgb/depth channels, see pybot.utils.frame_store), 
+                          used instead of the scene images where available
+        """
         if version not in ['v1', 'v2']: 
             raise ValueError('Version %s not supported. '''
                              '''Check dataset and choose either v1 or v2 scene dataset''' % version)
         self.version = version
         self.blacklist = blacklist
+        self.packed_directory = os.path.expanduser(packed_directory) \
+                                if packed_directory is not None else None
 
         # Recursively read, and categorize items based on folder
         self.dataset_ = read_dir(os.path.expanduser(directory), pattern='*.png', recursive=False)
@@ -685,7 +733,13 @@ class UWRGBDSceneDataset(UWRGBDDataset):
         meta_file = self.meta_.get(key, None)
         aligned_file = self.aligned_.get(key, None) if (self.aligned_ and with_ground_truth) else None
 
-        return UWRGBDSceneDataset._reader(files, meta_file, aligned_file, self.version, key) 
+        # Get packed frames
+        packed = os.path.join(self.packed_directory, '{:}.pfs'.format(key)) \
+                 if self.packed_directory is not None else None
+        if packed is not None and not os.path.exists(packed): 
+            packed = None
+
+        return UWRGBDSceneDataset._reader(files, meta_file, aligned_file, self.version, key, packed=packed) 
 
     def scenes(self): 
         return self.dataset_.keys()
@@ -9,22 +9,45 @@ import cv2
 import numpy as np
 import os, fnmatch, time
 import re
+import sys
+import copy
+import json
+import threading
 
+from functools import partial
 from itertools import izip, imap, chain, islice
 from collections import defaultdict, namedtuple, OrderedDict
-# from .async_utils import async_prefetch
+from pybot.utils.async_utils import async_prefetch
 
 from pybot.vision.image_utils import im_resize
 
+# Directory listings via scandir (os.scandir on Python 3.5+, or the 
+# scandir package), falling back to the listdir-based os.walk
+try: 
+    from os import scandir, walk
+except ImportError: 
+    try: 
+        from scandir import scandir, walk
+    except ImportError: 
+        scandir, walk = None, os.walk
+
+def _listdir_names(directory): 
+    """ Returns the set of entry names in a directory """
+    if scandir is None: 
+        return set(os.listdir(directory))
+    return set(entry.name for entry in scandir(directory))
+
 def valid_path(path): 
     vpath = os.path.expanduser(path)
     if not os.path.exists(vpath): 
         raise RuntimeError('Path invalid {:}'.format(vpath))
     return vpath
 
+_natural_split = re.compile('([0-9]+)').split
+
 def natural_sort(l): 
     convert = lambda text: int(text) if text.isdigit() else text.lower() 
-    alphanum_key = lambda key: [ convert(c) for c in re.split('([0-9]+)', key) ] 
+    alphanum_key = lambda key: [ convert(c) for c in _natural_split(key) ] 
     return sorted(l, key = alphanum_key)
 
 def recursive_set_dict(d, splits, value): 
@@ -42,7 +65,7 @@ def read_files(directory, pattern='*.png'):
     that match file pattern. 
     """
     matched_files = []
-    for root, dirs, files in os.walk(directory): 
+    for root, dirs, files in walk(directory): 
         
         # Filter only filename matches 
         matches = [os.path.join(root, fn) 
@@ -75,7 +98,7 @@ def read_dir(directory, pattern='*.png', recursive=True, expected_dirs=[], verbo
         if len(expected_set) and not rootd in expected_set: 
             continue
 
-        for root, dirs, files in os.walk(os.path.join(directory, rootd)): 
+        for root, dirs, files in walk(os.path.join(directory, rootd)): 
 
             # Verbose print
             if verbose: 
@@ -100,13 +123,235 @@ def read_dir(directory, pattern='*.png', recursive=True, expected_dirs=[], verbo
 
     return fn_map
 
+manifest_filename = '.pybot_manifest.json'
+
+def _contiguous_stop(template, start_idx): 
+    """
+    Returns the (exclusive) end of the run of files template % idx 
+    from start_idx, via exponential and binary search on existence 
+    (O(log N) stats). Gaps within the run are not detected (see 
+    _first_gap).
+    """
+    exists = lambda idx: os.path.exists(template % idx)
+    if not exists(start_idx): 
+        return start_idx
+
+    # Bracket the end of the run: lo exists, hi does not
+    lo, step = start_idx, 1
+    while exists(start_idx + step): 
+        lo, step = start_idx + step, step * 2
+    hi = start_idx + step
+
+    while hi - lo > 1: 
+        mid = (lo + hi) // 2
+        if exists(mid): 
+            lo = mid
+        else: 
+            hi = mid
+    return hi
+
+# Bracketed ranges up to this length are checked with stats 
+# rather than listing the directory
+_max_gap_stats = 64
+
+def _first_gap(template, start_idx, stop_idx): 
+    """
+    Returns the first missing index of template % idx in 
+    [start_idx, stop_idx) (or stop_idx if the run is contiguous), 
+    with a single directory listing (or per-index stats for short 
+    ranges)
+    """
+    directory, basename = os.path.split(template)
+    if '%' not in basename or stop_idx - start_idx <= _max_gap_stats: 
+        for idx in range(start_idx, stop_idx): 
+            if not os.path.exists(template % idx): 
+                return idx
+        return stop_idx
+
+    names = _listdir_names(directory or '.')
+    for idx in range(start_idx, stop_idx): 
+        if basename % idx not in names: 
+            return idx
+    return stop_idx
+
+def _mtime(path): 
+    try: 
+        return os.stat(path).st_mtime
+    except OSError: 
+        return None
+
+def _load_manifest(directory): 
+    try: 
+        with open(os.path.join(directory, manifest_filename), 'r') as fd: 
+            return json.load(fd)
+    except (IOError, OSError, ValueError): 
+        return {}
+
+def _save_manifest(directory, manifest): 
+    """ Atomically write the manifest (skipped for read-only datasets) """
+    fn = os.path.join(directory, manifest_filename)
+    tmp = '{:}.{:}.tmp'.format(fn, os.getpid())
+    try: 
+        with open(tmp, 'w') as fd: 
+            json.dump(manifest, fd, indent=1, sort_keys=True)
+        os.rename(tmp, fn)
+    except (IOError, OSError): 
+        pass
+
+def template_range(template, start_idx=0, use_manifest=True): 
+    """
+    Resolve the contiguous range [start, stop) of files matching a 
+    numeric template (e.g. image_0/%06i.png) from start_idx, without 
+    listing the directory. 
+
+    The range is bracketed by searching on file existence, and verified 
+    to be free of gaps (the run stops at the first missing file). The 
+    resolved range (first, last, count, and the mtimes of the first 
+    and last files) is persisted in a manifest beside the files. It is 
+    reused while the first/last files are unchanged and the run has not 
+    been extended, so that subsequent opens are O(1).
+    """
+    template = os.path.expanduser(template)
+    directory, basename = os.path.split(template)
+    directory = directory or '.'
+
+    manifest = _load_manifest(directory) if use_manifest else {}
+    entry = manifest.get(basename)
+    if entry is not None and entry['first'] <= start_idx <= entry['last'] and \
+       _mtime(template % entry['first']) == entry['mtimes'][0] and \
+       _mtime(template % entry['last']) == entry['mtimes'][1] and \
+       not os.path.exists(template % (entry['last'] + 1)): 
+        return start_idx, entry['last'] + 1
+
+    stop = _first_gap(template, start_idx, _contiguous_stop(template, start_idx))
+    if use_manifest and stop > start_idx: 
+        manifest[basename] = dict(first=start_idx, last=stop-1, count=stop-start_idx, 
+                                  mtimes=[_mtime(template % start_idx), _mtime(template % (stop-1))])
+        _save_manifest(directory, manifest)
+    return start_idx, stop
+
+def item_nbytes(item): 
+    """ Approximate memory footprint (bytes) of a decoded item """
+    if isinstance(item, np.ndarray): 
+        return item.nbytes
+    if isinstance(item, dict): 
+        return sum(item_nbytes(v) for v in item.itervalues())
+    if isinstance(item, (list, tuple)): 
+        return sum(item_nbytes(v) for v in item)
+    return sys.getsizeof(item)
+
+class LRUEviction(object): 
+    """ Evict the least recently used item """
+    def __init__(self): 
+        self.order_ = OrderedDict()
+
+    def insert(self, key): 
+        self.order_[key] = None
+
+    def access(self, key): 
+        self.order_[key] = self.order_.pop(key)
+
+    def remove(self, key): 
+        self.order_.pop(key, None)
+
+    def victim(self): 
+        return next(iter(self.order_))
+
+class FIFOEviction(LRUEviction): 
+    """ Evict the earliest inserted item (accesses do not refresh items) """
+    def access(self, key): 
+        pass
+
+class FrameCache(object): 
+    """
+    Thread-safe cache of decoded frames, bounded in bytes (see
+    item_nbytes), with a pluggable eviction policy implementing 
+    insert/access/remove/victim (see LRUEviction, FIFOEviction)
+
+    Items larger than max_bytes are not cached.
+    """
+    policies = { 'lru': LRUEviction, 'fifo': FIFOEviction }
+
+    def __init__(self, max_bytes=512 * 1024 ** 2, eviction='lru'): 
+        try: 
+            self.eviction_ = FrameCache.policies[eviction]() \
+                             if isinstance(eviction, str) else eviction
+        except KeyError: 
+            raise ValueError('Unknown eviction policy {:}, use from {:}'
+                             .format(eviction, FrameCache.policies.keys()))
+        self.max_bytes_ = max_bytes
+        self.items_ = {}
+        self.nbytes_ = 0
+        self.lock_ = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self): 
+        return len(self.items_)
+
+    def __contains__(self, key): 
+        return key in self.items_
+
+    def get(self, key, load): 
+        """ Returns the cached item for key, or caches load(key) """
+        with self.lock_: 
+            if key in self.items_: 
+                self.hits += 1
+                self.eviction_.access(key)
+                return self.items_[key][0]
+            self.misses += 1
+
+        # Decode outside the lock
+        item = load(key)
+        self.put(key, item)
+        return item
+
+    def put(self, key, item): 
+        nbytes = item_nbytes(item)
+        if nbytes > self.max_bytes_: 
+            return
+        with self.lock_: 
+            if key in self.items_: 
+                return
+            while self.nbytes_ + nbytes > self.max_bytes_ and len(self.items_): 
+                victim = self.eviction_.victim()
+                self.eviction_.remove(victim)
+                self.nbytes_ -= self.items_.pop(victim)[1]
+                self.evictions += 1
+            self.items_[key] = (item, nbytes)
+            self.eviction_.insert(key)
+            self.nbytes_ += nbytes
+
+    def clear(self): 
+        with self.lock_: 
+            for key in self.items_.keys(): 
+                self.eviction_.remove(key)
+            self.items_, self.nbytes_ = {}, 0
+
+    @property
+    def nbytes(self): 
+        return self.nbytes_
+
+    @property
+    def hit_rate(self): 
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.
+
+    def __repr__(self): 
+        return 'FrameCache(items={:}, nbytes={:.1f}/{:.1f} MB, hits={:}, misses={:}, ' \
+            'evictions={:}, hit_rate={:.2f})'.format(
+                len(self), self.nbytes_ / 1024. ** 2, self.max_bytes_ / 1024. ** 2, 
+                self.hits, self.misses, self.evictions, self.hit_rate)
+
 class FileReader(object): 
     def __init__(self, filename, process_cb, start_idx=0): 
         self.filename_ = filename
         self.start_idx_ = start_idx
         self.items_ = process_cb(filename)
 
-    def iteritems(self, every_k_frames=1, reverse=False): 
+    def iteritems(self, every_k_frames=1, reverse=False, **kwargs): 
+        """ Prefetch options (see DatasetReader) are ignored, items are in memory """
         if reverse: 
             raise NotImplementedError
         return islice(self.items_, self.start_idx_, None, every_k_frames)
@@ -119,6 +364,19 @@ class DatasetReader(object):
     """
     Simple Dataset Reader
     Refer to this class and ImageDatasetWriter for input/output
+
+    Items may be decoded ahead of the consumer on a pool of workers
+    (order is preserved, and memory is bounded by the prefetch depth): 
+    
+    >> for im in reader.iteritems(prefetch=8, workers=4): ...
+
+    The reader is also random-access and sliceable (slices are views
+    sharing the process_cb and cache). Decoded items are cached once 
+    a FrameCache is set: 
+
+    >> reader.set_cache(max_bytes=2 * 1024 ** 3)
+    >> im, ims = reader[-1], reader[100:200:10]
+    >> print reader.cache
     """
 
     # Get directory, and filename pattern
@@ -131,31 +389,23 @@ class DatasetReader(object):
         # Index starts at 0
         if files is None:
 
-            # Find files with matching patterns within 
-            # the directory, and only add up to required
-            # number of files (replace %010i with *
-            # for fast pattern matching)
-
-            directory, basename = os.path.split(template)
-            ext = os.path.splitext(basename)[-1]
-            st = basename.find('%')
-            end = basename.find('i', st)+1
-            pattern = basename.replace(basename[st:end], '*')
-
-            try: 
-                files = os.listdir(directory) 
-                nmatches = len(fnmatch.filter(files, pattern))
-            except: 
-                nmatches = start_idx + max_files
+            # Resolve the contiguous range of files matching the 
+            # template (see template_range), and only add up to 
+            # required number of files
+            start, stop = template_range(template, start_idx=start_idx)
+            if stop <= start: 
+                valid_path(template % start_idx)
             self.files = [template % idx
-                          for idx in range(start_idx, min(nmatches, start_idx + max_files))]
+                          for idx in range(start, min(stop, start + max_files))]
 
-            print('Found {:} files with pattern: {:}'.format(nmatches, pattern))
-            print('From {:} to {:}'.format(valid_path(self.files[0]), valid_path(self.files[-1])))
+            print('Found {:} files with template: {:}'.format(stop - start, template))
+            print('From {:} to {:}'.format(self.files[0], self.files[-1]))
         else: 
             print('Files: {:}'.format(len(files)))
             self.files = files
         
+        self.cache_ = None
+
         # print('First file: {:}: {:}'.format(template % start_idx, 'GOOD' if
         # os.path.exists(template % start_idx) else 'BAD'))
 
@@ -163,31 +413,70 @@ class DatasetReader(object):
     def from_filenames(process_cb, files): 
         return DatasetReader(process_cb=process_cb, files=files)
 
-    def _prefetch(self, fnos): 
-        pass
-    def yield_data(self): 
-        pass
-
     @staticmethod
     def from_directory(process_cb, directory, pattern='*.png'):
         files = read_dir(directory, pattern=pattern, flatten=True)
         sorted_files = natural_sort(files)
         return DatasetReader.from_filenames(process_cb, sorted_files)
 
-    # @async_prefetch
-    def iteritems(self, every_k_frames=1, reverse=False):
+    def iteritems(self, every_k_frames=1, reverse=False, prefetch=0, workers=1, processes=False):
+        """
+        Iterate over processed items, optionally decoding up to `prefetch`
+        items ahead with `workers` threads (or processes, in which case 
+        process_cb needs to be picklable), see async_prefetch
+        """
         fnos = np.arange(0, len(self.files), every_k_frames).astype(int)
         if reverse: 
             fnos = fnos[::-1]
-        for fno in fnos:
-            yield self.process_cb(self.files[fno])
-
-    def iterinds(self, inds, reverse=False): 
-        fnos = inds.astype(int)
+        return self.iterinds(fnos, prefetch=prefetch, workers=workers, processes=processes)
+
+    def iterinds(self, inds, reverse=False, prefetch=0, workers=1, processes=False): 
+        """
+        Iterate over the processed items at inds (the cache, if set, 
+        is bypassed with processes=True)
+        """
+        fnos = np.asarray(inds).astype(int)
         if reverse: 
             fnos = fnos[::-1]
-        for fno in fnos: 
-            yield self.process_cb(self.files[fno])
+        return async_prefetch(self.process_cb if processes else self._load, 
+                              [self.files[fno] for fno in fnos], 
+                              prefetch=prefetch, workers=workers, processes=processes)
+
+    def set_cache(self, max_bytes=512 * 1024 ** 2, eviction='lru'): 
+        """
+        Cache decoded items (up to max_bytes), see FrameCache. 
+        max_bytes=None disables caching.
+        """
+        self.cache_ = FrameCache(max_bytes=max_bytes, eviction=eviction) \
+                      if max_bytes is not None else None
+        return self.cache_
+
+    @property
+    def cache(self): 
+        return self.cache_
+
+    def _load(self, fn): 
+        if self.cache_ is None: 
+            return self.process_cb(fn)
+        return self.cache_.get(fn, self.process_cb)
+
+    def __len__(self): 
+        return len(self.files)
+
+    def __getitem__(self, index): 
+        """
+        Returns the processed item at index, or a view over the 
+        files for slices
+        """
+        if isinstance(index, slice): 
+            view = copy.copy(self)
+            view.files = self.files[index]
+            return view
+        try: 
+            return self._load(self.files[index])
+        except TypeError: 
+            raise TypeError('DatasetReader indices must be integers or slices, provided {:}'
+                            .format(type(index)))
 
     @property
     def length(self): 
@@ -213,10 +502,14 @@ class VelodyneDatasetReader(DatasetReader):
             from pybot_vision import read_velodyne_pc
         except: 
             raise RuntimeError('read_velodyne_pc missing in pybot_vision. Compile it first!')
-        DatasetReader.__init__(self, process_cb=lambda fn: read_velodyne_pc(fn), template=template, 
+        DatasetReader.__init__(self, process_cb=read_velodyne_pc, template=template, 
                                start_idx=start_idx, max_files=max_files, files=files)
         
 
+def imread_resize(fn, scale=1.0, grayscale=False, interpolation=cv2.INTER_AREA): 
+    return im_resize(cv2.imread(fn, cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_UNCHANGED), 
+                     scale=scale, interpolation=interpolation)
+
 class ImageDatasetReader(DatasetReader): 
     """
     ImageDatasetReader
@@ -228,12 +521,19 @@ class ImageDatasetReader(DatasetReader):
     """
 
     @staticmethod
-    def imread_process_cb(scale=1.0, grayscale=False):
-        return lambda fn: im_resize(cv2.imread(fn, cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_UNCHANGED), scale=scale)
+    def imread_process_cb(scale=1.0, grayscale=False, interpolation=cv2.INTER_AREA):
+        # Picklable, so that items can be decoded in worker processes
+        return partial(imread_resize, scale=scale, grayscale=grayscale, interpolation=interpolation)
     
-    def __init__(self, template='template_%i.txt', start_idx=0, max_files=10000, files=None, scale=1.0, grayscale=False): 
+    def __init__(self, template='template_%i.txt', start_idx=0, max_files=10000, files=None, scale=1.0, grayscale=False, 
+                 interpolation=cv2.INTER_AREA): 
+        """
+        interpolation: Resize interpolation (i.e. cv2.INTER_NEAREST for depth images)
+        """
         DatasetReader.__init__(self, 
-                               process_cb=ImageDatasetReader.imread_process_cb(scale=scale, grayscale=grayscale), template=template, 
+                               process_cb=ImageDatasetReader.imread_process_cb(scale=scale, grayscale=grayscale, 
+                                                                               interpolation=interpolation), 
+                               template=template, 
                                start_idx=start_idx, max_files=max_files, files=files)
 
     @staticmethod
@@ -278,6 +578,22 @@ class StereoDatasetReader(object):
         assert(self.left.length == self.right.length)
         return self.left.length
 
+    def __len__(self): 
+        return self.length
+
+    def __getitem__(self, index): 
+        if isinstance(index, slice): 
+            view = copy.copy(self)
+            view.left, view.right = self.left[index], self.right[index]
+            return view
+        return self.left[index], self.right[index]
+
+    def set_cache(self, max_bytes=512 * 1024 ** 2, eviction='lru'): 
+        """ Cache decoded frames, split evenly between left and right """
+        half = max_bytes // 2 if max_bytes is not None else None
+        return self.left.set_cache(half, eviction=eviction), \
+            self.right.set_cache(half, eviction=eviction)
+
     def iteritems(self, *args, **kwargs): 
         return izip(self.left.iteritems(*args, **kwargs), 
                     self.right.iteritems(*args, **kwargs))
@@ -5,6 +5,7 @@ import tables as tb
 import numpy as np
 import pickle
 import time, logging, cPickle, shelve
+import atexit, weakref
 from collections import defaultdict
 from itertools import izip, imap
 
@@ -225,30 +226,122 @@ class AttrDict(dict):
         create_path_if_not_exists(fn)
         return save_pytable(fn, self)
 
+class IterDBColumn(object): 
+    """
+    Random-access view of an IterDB key, i.e. db[key][i], db[key][i:j]
+    and db[key][inds]. Slices of fixed-shape keys are a single
+    contiguous read.
+    """
+    def __init__(self, db, key): 
+        self.db_ = db
+        self.node_ = db.get_node(key)
+
+    def __len__(self): 
+        return self.node_.nrows
+
+    @property
+    def shape(self): 
+        return self.node_.shape
+
+    @property
+    def dtype(self): 
+        return self.node_.atom.dtype
+
+    def _take(self, inds): 
+        """ Rows at (integer) inds, read as a single span when dense """
+        inds = np.asarray(inds)
+        if inds.dtype == np.bool: 
+            inds, = np.where(inds)
+        inds = np.where(inds < 0, inds + len(self), inds)
+        if not len(inds): 
+            return self.node_.read(0, 0)
+        lo, hi = inds.min(), inds.max() + 1
+        if hi - lo <= 8 * len(inds): 
+            return self.node_.read(lo, hi)[inds - lo]
+        return np.stack([self.node_[int(idx)] for idx in inds])
+
+    def __getitem__(self, idx): 
+        fixed = isinstance(self.node_, tb.EArray)
+        if isinstance(idx, (list, np.ndarray)): 
+            if fixed: 
+                return self._take(idx)
+            return [self[int(i)] for i in np.asarray(idx).reshape(-1)]
+
+        rows = self.node_[idx]
+        if fixed: 
+            return rows
+        if isinstance(idx, slice): 
+            return [self.db_.unpack(row) for row in rows]
+        return self.db_.unpack(rows)
+
+# Writable IterDBs that are still open, flushed at exit (before 
+# PyTables closes the remaining open files)
+_open_iterdbs = weakref.WeakSet()
+
+@atexit.register
+def _flush_open_iterdbs(): 
+    for db in list(_open_iterdbs): 
+        db._flush_if_open()
+
 class IterDB(object): 
-    def __init__(self, filename, mode, batch_size=5): 
+    def __init__(self, filename, mode, batch_size=5, buffer_size=4096, 
+                 chunk_bytes=64*1024, complevel=1, complib='blosc'): 
         """
         An iterable database that should theoretically allow 
         scalable reading/writing of datasets. 
            batch_size: length of list
 
-        Notes: 
-           meta_file should contain all the related meta data 
-        including keys, their corresponding value lengths, 
-        overall file size etc
+        Keys of fixed-shape ndarrays (one row per appended item) are 
+        stored column-wise in chunked EArrays, and their appends are 
+        buffered and written out in bulk. Once an ndarray with a 
+        different number of rows is appended, the key is converted to 
+        a VLArray of [k x item.shape[1:]] rows (as in the previous 
+        layout). Any other item is pickled into a (variable-length) 
+        VLArray. Items are cast to the key's dtype, and casts that 
+        change values (i.e. 300 or -1 into uint8) raise ValueError.
+           buffer_size: rows buffered per key before writing
+           chunk_bytes: target (HDF5) chunk size for ndarray keys
+
+        Buffered rows are only written by flush() or close(), call 
+        either (or use the IterDB as a context manager) for the rows 
+        to be durable. As a fallback, open writers are flushed (and 
+        closed) when garbage collected, and flushed at interpreter exit.
+
+        Usage: 
+           db = IterDB('desc.h5', mode='w')
+           db.extend('desc', desc)          # [N x 128] in a single write
+           db.append('frame', dict(idx=0))
+           db.close()
+
+           db = IterDB('desc.h5', mode='r')
+           for chunk in db.iterchunks('desc', batch_size=100000): ...
+           desc = db['desc'][1000:2000]
         """
         fn = os.path.expanduser(filename)
+        self.filename_ = fn
+        self.buffer_size_ = buffer_size
+        self.chunk_bytes_ = chunk_bytes
+        self.filters_ = tb.Filters(complevel=complevel, complib=complib)
+        self.buffers_, self.counts_ = {}, {}
+
         if mode == 'w' or mode == 'a': 
-            print('{}::{} with batch size: {}'.format(
+            print('{}::{} with buffer size: {}'.format(
                 'Writing' if mode == 'w' else 'Appending', 
-                self.__class__.__name__, batch_size))
+                self.__class__.__name__, buffer_size))
             self.h5f_ = tb.open_file(fn, mode=mode, title='%s' % fn)
-            self.data_ = {}
+            _open_iterdbs.add(self)
         elif mode == 'r': 
             self.h5f_ = tb.open_file(fn, mode=mode, title='%s' % fn)
             print('{}::Loaded with fields: {}'.format(self.__class__.__name__, self.keys))
         else: 
             raise RuntimeError('Unknown mode %s' % mode)
+        self.data_ = dict((child._v_name, child) for child in self.h5f_.list_nodes(self.h5f_.root))
+
+    def __enter__(self): 
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback): 
+        self.close()
 
     @property
     def keys(self): 
@@ -258,19 +351,100 @@ class IterDB(object):
     def filename(self): 
         return self.filename_
 
-    def append(self, key, item): 
-        if key not in self.data_: 
-            filters = tb.Filters(complevel=5, complib='blosc')
-            if isinstance(item, np.ndarray): 
-                atom = tb.Atom.from_type(item.dtype.name, item.shape[1:])
-            else:
-                atom = tb.VLStringAtom()
-            self.data_[key] = self.h5f_.create_vlarray(self.h5f_.root, key, 
-                                                       atom, filters=filters)
-            print('Creating VLArray, and appending to key {}'.format(key))
-            print self.data_[key]
+    def __contains__(self, key): 
+        return key in self.data_
+
+    def __getitem__(self, key): 
+        self._check_keys([key])
+        self._flush_key(key)
+        return IterDBColumn(self, key)
+
+    def _check_keys(self, keys): 
+        for key in keys: 
+            if key not in self.data_: 
+                raise RuntimeError('Key %s not found in dataset. keys: %s' % (key, self.keys))
+
+    def _create(self, key, dtype=None, shape=None): 
+        """ EArray with [rows x shape] chunks of ~chunk_bytes, or an object VLArray """
+        if dtype is None: 
+            self.data_[key] = self.h5f_.create_vlarray(self.h5f_.root, key, tb.VLStringAtom(), 
+                                                       filters=self.filters_)
+        else: 
+            atom = tb.Atom.from_dtype(np.dtype(dtype))
+            rows = max(1, self.chunk_bytes_ // max(atom.itemsize * int(np.prod(shape)), 1))
+            self.data_[key] = self.h5f_.create_earray(self.h5f_.root, key, atom, shape=(0,) + shape, 
+                                                      chunkshape=(rows,) + shape, 
+                                                      filters=self.filters_)
+        print('Creating {}, and appending to key {}'.format(
+            self.data_[key].__class__.__name__, key))
+        return self.data_[key]
+
+    def _to_vlarray(self, key, item): 
+        """ Convert a fixed-shape key to a VLArray of [k x shape[1:]] rows (variable k) """
+        node = self.data_[key]
+        shape, dtype = node.shape[1:], node.atom.dtype
+        if not len(shape) or np.ndim(item) != len(shape) or np.shape(item)[1:] != shape[1:]: 
+            raise ValueError('Key {} has item shape {}, provided {} (only the number of rows may vary)'
+                             .format(key, shape, np.shape(item)))
+        self._flush_key(key)
+        self.buffers_.pop(key, None)
+        self.counts_.pop(key, None)
+
+        self.h5f_.rename_node(node, key + '__fixed')
+        vlarray = self.h5f_.create_vlarray(self.h5f_.root, key, tb.Atom.from_type(dtype.name, shape[1:]), 
+                                           filters=self.filters_)
+        for start in range(0, node.nrows, node.chunkshape[0]): 
+            for row in node.read(start, min(start + node.chunkshape[0], node.nrows)): 
+                vlarray.append(row)
+        node._f_remove()
+        print('Converted key {} to VLArray, item shape {} differs from {}'.format(key, np.shape(item), shape))
+        self.data_[key] = vlarray
+        return vlarray
+
+    def _cast(self, key, item, dtype): 
+        """ item as an ndarray of dtype, raising ValueError if the cast changes values """
+        item = np.asarray(item)
+        if np.can_cast(item.dtype, dtype) or \
+           (np.issubdtype(item.dtype, np.floating) and np.issubdtype(dtype, np.floating)): 
+            return item
+        cast = item.astype(dtype)
+        if not np.array_equal(cast, item): 
+            raise ValueError('Key {} has dtype {}, provided {} values that cannot be cast without loss'
+                             .format(key, dtype, item.dtype))
+        return cast
+
+    def _flush_key(self, key): 
+        count = self.counts_.get(key, 0)
+        if count: 
+            self.data_[key].append(self.buffers_[key][:count])
+            self.counts_[key] = 0
 
-        self.data_[key].append(self.pack(item))
+    def append(self, key, item): 
+        node = self.data_.get(key)
+        if node is None: 
+            node = self._create(key, item.dtype, item.shape) \
+                   if isinstance(item, np.ndarray) else self._create(key)
+
+        if isinstance(node, tb.EArray) and np.shape(item) != node.shape[1:]: 
+            node = self._to_vlarray(key, item)
+
+        if not isinstance(node, tb.EArray): 
+            if not isinstance(node.atom, (tb.VLStringAtom, tb.ObjectAtom)): 
+                if np.shape(item)[1:] != node.atom.shape: 
+                    raise ValueError('Key {} has item shape [k x {}], provided {}'
+                                     .format(key, node.atom.shape, np.shape(item)))
+                item = self._cast(key, item, node.atom.dtype)
+            node.append(self.pack(item))
+            return
+
+        if key not in self.buffers_: 
+            self.buffers_[key] = np.empty((self.buffer_size_,) + node.shape[1:], dtype=node.atom.dtype)
+            self.counts_[key] = 0
+        count = self.counts_[key]
+        self.buffers_[key][count] = self._cast(key, item, node.atom.dtype)
+        self.counts_[key] = count + 1
+        if count + 1 == self.buffer_size_: 
+            self._flush_key(key)
 
     def pack(self, item): 
         if isinstance(item, np.ndarray): 
@@ -287,8 +461,29 @@ class IterDB(object):
             raise ValueError('Unknown type written to pytables')
             
     def extend(self, key, items): 
-        for item in items: 
-            self.data_[key].append(item)
+        """
+        Append items in bulk: [N x ...] ndarrays are written as N rows
+        of key in a single write, other iterables item by item
+        """
+        if not isinstance(items, np.ndarray) or not items.ndim: 
+            for item in items: 
+                self.append(key, item)
+            return
+
+        node = self.data_.get(key)
+        if node is None: 
+            node = self._create(key, items.dtype, items.shape[1:])
+        if isinstance(node, tb.EArray) and items.shape[1:] != node.shape[1:]: 
+            node = self._to_vlarray(key, items[0])
+        if not isinstance(node, tb.EArray): 
+            if isinstance(node.atom, (tb.VLStringAtom, tb.ObjectAtom)): 
+                raise ValueError('Key {} stores objects, use append instead'.format(key))
+            for item in items: 
+                self.append(key, item)
+            return
+        items = self._cast(key, items, node.atom.dtype)
+        self._flush_key(key)
+        node.append(items)
 
     def node_str(self, key): 
         return ''.join(['/',key])
@@ -298,43 +493,70 @@ class IterDB(object):
         return self.h5f_.get_node(self.node_str(key))
 
     def length(self, key): 
-        return self.get_node(key).nrows
+        return self.get_node(key).nrows + self.counts_.get(key, 0)
 
     def itervalues_for_key(self, key, inds=None, verbose=False): 
-        if key not in self.keys: 
-            raise RuntimeError('Key %s not found in dataset. keys: %s' % (key, self.keys))
-        return imap(self.unpack, self.get_node(key).iterrows())
+        self._check_keys([key])
+        self._flush_key(key)
+        node = self.data_[key]
+        if inds is not None: 
+            column = IterDBColumn(self, key)
+            return (column[int(idx)] for idx in inds)
+        if not isinstance(node, tb.EArray): 
+            return imap(self.unpack, node.iterrows())
+        return (item for chunk in self.iterchunks(key, batch_size=node.chunkshape[0], verbose=verbose) 
+                for item in chunk)
             
     def itervalues_for_keys(self, keys, inds=None, verbose=False): 
-        for key in keys: 
-            if key not in self.keys: 
-                raise RuntimeError('Key %s not found in dataset. keys: %s' % (key, self.keys))
-
-        items = (self.itervalues_for_key(key) for key in keys)
+        self._check_keys(keys)
+        items = (self.itervalues_for_key(key, inds=inds) for key in keys)
         return izip(*items)
 
     def iterchunks(self, key, batch_size=10, verbose=False): 
-        if key not in self.keys: 
-            raise RuntimeError('Key %s not found in dataset. keys: %s' % (key, self.keys))
-
-        chunks = grouper(self.itervalues_for_key(key), batch_size)
-        for chunk in progressbar(chunks, size=self.length(key) / batch_size, verbose=verbose): 
-            yield chunk
+        """
+        Iterate over blocks of batch_size consecutive items, each read 
+        with a single read(start, stop): [batch_size x ...] ndarrays 
+        for ndarray keys, and lists of items otherwise
+        """
+        self._check_keys([key])
+        self._flush_key(key)
+        node = self.data_[key]
+        N = node.nrows
+        starts = range(0, N, batch_size)
+        if verbose: 
+            starts = progressbar(starts, size=len(starts))
+        for start in starts: 
+            chunk = node.read(start, min(start + batch_size, N))
+            yield chunk if isinstance(node, tb.EArray) else [self.unpack(item) for item in chunk]
  
     def iterchunks_keys(self, keys, batch_size=10, verbose=False): 
         """
         Iterate in chunks and izip specific keys
         """
-        for key in keys: 
-            if key not in self.keys: 
-                raise RuntimeError('Key %s not found in dataset. keys: %s' % (key, self.keys))
-            
+        self._check_keys(keys)
         iterables = (self.iterchunks(key, batch_size=batch_size, verbose=verbose) for key in keys)
         return izip(*iterables)
 
+    def flush(self): 
+        for key in list(self.counts_.keys()): 
+            self._flush_key(key)
+        self.h5f_.flush()
+
+    def _flush_if_open(self): 
+        h5f = getattr(self, 'h5f_', None)
+        if h5f is not None and h5f.isopen and h5f.mode != 'r': 
+            self.flush()
+
     def close(self): 
+        self._flush_if_open()
+        _open_iterdbs.discard(self)
         self.h5f_.close()
 
+    def __del__(self): 
+        h5f = getattr(self, 'h5f_', None)
+        if h5f is not None and h5f.isopen: 
+            self.close()
+
 class IterDBDeprecated(object): 
     def __init__(self, filename, mode, fields=[], batch_size=5): 
         """
@@ -0,0 +1,347 @@
+"""
+Packed frame store: a single file of frames for fast (memory-mapped)
+dataset replay, with a converter from DatasetReader/StereoDatasetReader
+
+Layout:
+    [magic | header length | JSON header] (padded to header_size)
+    [frame region]
+
+    raw:        fixed-stride records (one field per channel), memory-mapped
+                so that frames are zero-copy views
+    compressed: per-frame zlib blobs, followed by an [N x C x 2]
+                (offset, nbytes) index
+
+Usage:
+    python -m pybot.utils.frame_store pack -o 00.pfs \\
+        --channel left=~/data/kitti/sequences/00/image_0/%06i.png \\
+        --channel right=~/data/kitti/sequences/00/image_1/%06i.png
+    python -m pybot.utils.frame_store info 00.pfs
+
+    >> store = PackedFrameStore('00.pfs')
+    >> left = store['left'][10]                      # zero-copy view
+    >> reader = PackedDatasetReader(store, 'left')   # DatasetReader
+"""
+
+# Author: Sudeep Pillai <spillai@csail.mit.edu>
+# License: MIT
+
+import os
+import json
+import zlib
+import struct
+import numpy as np
+from itertools import izip
+
+from pybot.utils.db_utils import AttrDict
+from pybot.utils.dataset_readers import DatasetReader, StereoDatasetReader
+
+magic = b'PYBOTPFS'
+header_size = 65536
+record_alignment = 64
+
+def _read_header(filename):
+    with open(filename, 'rb') as fd:
+        if fd.read(len(magic)) != magic:
+            raise ValueError('{:} is not a packed frame store'.format(filename))
+        n, = struct.unpack('<Q', fd.read(8))
+        return json.loads(fd.read(n).decode('utf-8'))
+
+def _write_header(fd, header):
+    data = json.dumps(header, sort_keys=True).encode('utf-8')
+    if len(magic) + 8 + len(data) > header_size:
+        raise ValueError('Packed frame store header exceeds {:} bytes'.format(header_size))
+    fd.seek(0)
+    fd.write(magic + struct.pack('<Q', len(data)) + data)
+
+def _record_dtype(channels):
+    """ Record dtype with each channel aligned to record_alignment bytes """
+    names, formats, offsets, offset = [], [], [], 0
+    for ch in channels:
+        dtype = (np.dtype(ch['dtype']), tuple(ch['shape']))
+        names.append(str(ch['name']))
+        formats.append(dtype)
+        offsets.append(offset)
+        nbytes = np.dtype(dtype).itemsize
+        offset += (nbytes + record_alignment - 1) // record_alignment * record_alignment
+    return np.dtype(dict(names=names, formats=formats, offsets=offsets, itemsize=max(offset, 1)))
+
+class PackedFrameWriter(object):
+    """
+    Sequentially writes frames (one array per channel) into a packed
+    frame store. Channel names, shapes and dtypes are fixed by the
+    first frame.
+
+    >> with PackedFrameWriter('out.pfs') as writer:
+    >>     for left, right in stereo.iteritems():
+    >>         writer.append(left=left, right=right)
+    """
+    def __init__(self, filename, compress=False, level=1, meta=None):
+        self.filename_ = os.path.expanduser(filename)
+        self.fd_ = open(self.filename_ + '.tmp', 'wb')
+        self.fd_.truncate(header_size)
+        self.fd_.seek(header_size)
+        self.header_ = AttrDict(version=1, count=0, compressed=compress, level=level,
+                                channels=None, meta=meta or {})
+        self.index_ = []
+        self.dtype_ = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.fd_.close()
+            os.remove(self.filename_ + '.tmp')
+
+    def append(self, **frames):
+        if self.header_.channels is None:
+            self.header_.channels = [dict(name=name, dtype=np.asarray(frames[name]).dtype.str,
+                                          shape=list(np.shape(frames[name])))
+                                     for name in sorted(frames.keys())]
+            self.dtype_ = _record_dtype(self.header_.channels)
+
+        channels = self.header_.channels
+        if sorted(frames.keys()) != [ch['name'] for ch in channels]:
+            raise ValueError('Expected channels {:}, provided {:}'
+                             .format([ch['name'] for ch in channels], sorted(frames.keys())))
+        arrs = []
+        for ch in channels:
+            arr = np.ascontiguousarray(frames[ch['name']], dtype=np.dtype(ch['dtype']))
+            if list(arr.shape) != ch['shape']:
+                raise ValueError('Channel {:} expected shape {:}, provided {:}'
+                                 .format(ch['name'], ch['shape'], arr.shape))
+            arrs.append(arr)
+
+        if self.header_.compressed:
+            entry = []
+            for arr in arrs:
+                blob = zlib.compress(arr.tobytes(), self.header_.level)
+                entry.append((self.fd_.tell(), len(blob)))
+                self.fd_.write(blob)
+            self.index_.append(entry)
+        else:
+            record = np.zeros(1, dtype=self.dtype_)
+            for ch, arr in izip(channels, arrs):
+                record[ch['name']] = arr
+            self.fd_.write(record.tobytes())
+        self.header_.count += 1
+
+    def close(self):
+        if self.header_.compressed:
+            self.header_.index_offset = self.fd_.tell()
+            self.fd_.write(np.uint64(self.index_).reshape(-1).tobytes())
+        _write_header(self.fd_, self.header_)
+        self.fd_.close()
+        os.rename(self.filename_ + '.tmp', self.filename_)
+
+class PackedFrameStore(object):
+    """
+    Reader for packed frame stores (see PackedFrameWriter). Frames of
+    raw stores are zero-copy views into the memory-mapped file, while
+    compressed frames are decoded on access.
+
+    >> store['left'][i], store.frame('left', i), store[i].left
+    """
+    def __init__(self, filename):
+        self.filename_ = os.path.expanduser(filename)
+        self.header_ = AttrDict(_read_header(self.filename_))
+        channels = self.header_.channels or []
+        self.channels_ = [str(ch['name']) for ch in channels]
+        self.specs_ = dict((str(ch['name']), ch) for ch in channels)
+
+        N = self.header_.count
+        if not N:
+            self.records_, self.index_ = None, None
+        elif self.header_.compressed:
+            self.data_ = np.memmap(self.filename_, dtype=np.uint8, mode='r')
+            off = self.header_.index_offset
+            self.index_ = np.frombuffer(self.data_[off:off + N * len(channels) * 16],
+                                        dtype=np.uint64).reshape(N, len(channels), 2)
+        else:
+            self.records_ = np.memmap(self.filename_, dtype=_record_dtype(channels),
+                                      mode='r', offset=header_size, shape=(N,))
+
+    def __len__(self):
+        return self.header_.count
+
+    @property
+    def filename(self):
+        return self.filename_
+
+    @property
+    def channels(self):
+        return self.channels_
+
+    @property
+    def meta(self):
+        return self.header_.meta
+
+    @property
+    def compressed(self):
+        return self.header_.compressed
+
+    def frame(self, channel, index):
+        if channel not in self.specs_:
+            raise KeyError('Unknown channel {:}, use from {:}'.format(channel, self.channels_))
+        if not self.header_.compressed:
+            return self.records_[channel][index]
+        if index < 0:
+            index += len(self)
+        offset, nbytes = self.index_[index, self.channels_.index(channel)]
+        spec = self.specs_[channel]
+        data = zlib.decompress(self.data_[int(offset):int(offset + nbytes)].tobytes())
+        return np.frombuffer(data, dtype=np.dtype(spec['dtype'])).reshape(spec['shape'])
+
+    def __getitem__(self, key):
+        """
+        store[channel]: [N x ...] frames (memory-mapped for raw stores)
+        store[index]: AttrDict of all channels at index
+        """
+        if isinstance(key, basestring):
+            if not self.header_.compressed:
+                return self.records_[key]
+            return [self.frame(key, idx) for idx in range(len(self))]
+        return AttrDict((ch, self.frame(ch, key)) for ch in self.channels_)
+
+    def __repr__(self):
+        return 'PackedFrameStore({:}, count={:}, compressed={:}, channels={:})'.format(
+            self.filename_, len(self), self.compressed,
+            ['{:}: {:} {:}'.format(ch['name'], ch['dtype'], tuple(ch['shape']))
+             for ch in self.header_.channels or []])
+
+class PackedChannel(object):
+    """
+    Frame loader (index -> frame) for a channel of a packed frame store.
+    Picklable (only the filename and channel are pickled, and the store
+    is re-opened on first use), so that frames can be read in worker
+    processes, i.e. iteritems(processes=True).
+    """
+    def __init__(self, store, channel):
+        self.store_ = store
+        self.filename_ = store.filename
+        self.channel_ = channel
+
+    def __getstate__(self):
+        return dict(filename_=self.filename_, channel_=self.channel_)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.store_ = None
+
+    def __call__(self, index):
+        if self.store_ is None:
+            self.store_ = PackedFrameStore(self.filename_)
+        return self.store_.frame(self.channel_, index)
+
+class PackedDatasetReader(DatasetReader):
+    """
+    DatasetReader over a channel of a packed frame store (supports
+    iteritems/iterinds with prefetch, worker processes, indexing, 
+    slicing and caching)
+    """
+    def __init__(self, store, channel='image'):
+        if not isinstance(store, PackedFrameStore):
+            store = PackedFrameStore(store)
+        if channel not in store.channels:
+            raise KeyError('Unknown channel {:}, use from {:}'.format(channel, store.channels))
+        self.store_ = store
+        self.channel_ = channel
+        DatasetReader.__init__(self, process_cb=PackedChannel(store, channel), files=range(len(store)))
+
+    @property
+    def store(self):
+        return self.store_
+
+def packed_stereo_reader(store, left='left', right='right'):
+    """ StereoDatasetReader over the left/right channels of a packed frame store """
+    if not isinstance(store, PackedFrameStore):
+        store = PackedFrameStore(store)
+    reader = StereoDatasetReader.__new__(StereoDatasetReader)
+    reader.left = PackedDatasetReader(store, left)
+    reader.right = PackedDatasetReader(store, right)
+    return reader
+
+def pack_dataset(readers, filename, every_k_frames=1, compress=False, level=1,
+                 prefetch=8, workers=4, meta=None, verbose=True):
+    """
+    Pack datasets into a single frame store
+
+        readers:    {channel: DatasetReader}, a StereoDatasetReader
+                    (channels left, right), or a DatasetReader (channel image)
+    """
+    if isinstance(readers, StereoDatasetReader):
+        readers = dict(left=readers.left, right=readers.right)
+    elif isinstance(readers, DatasetReader):
+        readers = dict(image=readers)
+    names = sorted(readers.keys())
+    lengths = set(len(readers[name]) for name in names)
+    if len(lengths) != 1:
+        raise ValueError('Channels have differing lengths {:}'.format(
+            dict((name, len(readers[name])) for name in names)))
+    total = (lengths.pop() + every_k_frames - 1) // every_k_frames
+
+    iters = [readers[name].iteritems(every_k_frames=every_k_frames,
+                                     prefetch=prefetch, workers=workers) for name in names]
+    with PackedFrameWriter(filename, compress=compress, level=level, meta=meta) as writer:
+        for idx, frames in enumerate(izip(*iters)):
+            writer.append(**dict(izip(names, frames)))
+            if verbose and idx % 500 == 0:
+                print('Packed {:}/{:} frames'.format(idx, total))
+    return PackedFrameStore(filename)
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    from pybot.utils.dataset_readers import ImageDatasetReader
+
+    parser = argparse.ArgumentParser(description='Packed frame store converter')
+    sub = parser.add_subparsers(dest='command')
+    pack = sub.add_parser('pack', help='Pack image templates into a frame store')
+    pack.add_argument('-o', '--output', required=True)
+    pack.add_argument('-c', '--channel', action='append', required=True,
+                      help='name=template, e.g. depth=scene/depth_%%i.png (repeatable)')
+    pack.add_argument('--start-idx', type=int, default=0)
+    pack.add_argument('--max-files', type=int, default=1000000)
+    pack.add_argument('--every-k-frames', type=int, default=1)
+    pack.add_argument('--scale', type=float, default=1.0, 
+                      help='Image scale (depth channels are resized with nearest neighbor interpolation)')
+    pack.add_argument('--grayscale', action='store_true')
+    pack.add_argument('--compress', action='store_true')
+    pack.add_argument('--workers', type=int, default=4)
+    info = sub.add_parser('info', help='Describe (and benchmark) a frame store')
+    info.add_argument('filename')
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        import cv2
+        readers = {}
+        for spec in args.channel:
+            name, template = spec.split('=', 1)
+            depth = name == 'depth'
+            readers[name] = ImageDatasetReader(template=template, start_idx=args.start_idx,
+                                               max_files=args.max_files, scale=args.scale,
+                                               grayscale=args.grayscale and not depth,
+                                               interpolation=cv2.INTER_NEAREST if depth else cv2.INTER_AREA)
+        st = time.time()
+        store = pack_dataset(readers, args.output, every_k_frames=args.every_k_frames,
+                             compress=args.compress, workers=args.workers,
+                             meta=dict(channels=args.channel, scale=args.scale,
+                                       start_idx=args.start_idx, every_k_frames=args.every_k_frames))
+        print('Packed {:} frames in {:.1f} s'.format(len(store), time.time() - st))
+        print(store)
+    else:
+        store = PackedFrameStore(args.filename)
+        print(store)
+        # Read (and touch) every frame
+        st = time.time()
+        nbytes = 0
+        for idx in range(len(store)):
+            for ch in store.channels:
+                frame = store.frame(ch, idx)
+                frame.max()
+                nbytes += frame.nbytes
+        elapsed = time.time() - st
+        print('Read {:} frames ({:.1f} MB) in {:.2f} s ({:.1f} MB/s)'.format(
+            len(store), nbytes / 1024. ** 2, elapsed, nbytes / 1024. ** 2 / max(elapsed, 1e-9)))
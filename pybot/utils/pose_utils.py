@@ -8,6 +8,7 @@ from abc import ABCMeta, abstractmethod
 from itertools import imap
 from pybot.utils.misc import print_green, print_red
 from pybot.utils.misc import Counter, Accumulator, CounterWithPeriodicCallback 
+from pybot.geometry.rigid_transform import RigidTransformArray
 
 import matplotlib as mpl
 import matplotlib.pyplot as plt
@@ -298,18 +299,125 @@ class PoseAccumulator(Accumulator):
         """ pose of [t] wrt [0]:  p_0t = p_w0.inverse() * p_wt """  
         return (self.init_.inverse()).oplus(pose_wt)
 
+    def to_array(self): 
+        """ Accumulated pose history as a RigidTransformArray """
+        return RigidTransformArray.from_list(list(self.items_))
+
+class TrajectoryInterpolator(object): 
+    """
+    Vectorized pose lookup on a time-stamped trajectory, with SLERP 
+    on rotation and linear interpolation on position. 
+
+    timestamps: [N] sorted timestamps
+    poses: RigidTransformArray (or list of RigidTransforms) of length N
+    extrapolate: policy for queries outside [t_0, t_{N-1}]
+        'clamp': hold the first/last pose
+        'linear': extend the motion of the first/last segment
+        'none': flag the queries as invalid
+        'raise': raise a ValueError
+    max_gap: flag queries as invalid if the bracketing samples 
+        (or the nearest sample, when extrapolating) are more 
+        than max_gap apart
+
+    >> interp = TrajectoryInterpolator(pose_ts, poses, max_gap=0.1)
+    >> poses_im, valid = interp.query(image_ts)
+    """
+    policies = ['clamp', 'linear', 'none', 'raise']
+
+    def __init__(self, timestamps, poses, extrapolate='clamp', max_gap=None): 
+        if not isinstance(poses, RigidTransformArray): 
+            poses = RigidTransformArray.from_list(list(poses))
+        if extrapolate not in TrajectoryInterpolator.policies: 
+            raise ValueError('Unknown extrapolation policy {:}, use from {:}'
+                             .format(extrapolate, TrajectoryInterpolator.policies))
+
+        self.ts_ = np.asarray(timestamps, dtype=np.float64).ravel()
+        self.poses_ = poses
+        self.extrapolate_ = extrapolate
+        self.max_gap_ = max_gap
+
+        if len(self.ts_) != len(self.poses_): 
+            raise ValueError('TrajectoryInterpolator timestamps ({:}) and poses ({:}) lengths differ'
+                             .format(len(self.ts_), len(self.poses_)))
+        if len(self.ts_) < 2: 
+            raise ValueError('TrajectoryInterpolator requires at least 2 poses')
+        if np.any(np.diff(self.ts_) < 0): 
+            raise ValueError('TrajectoryInterpolator timestamps are not sorted')
+
+    def __len__(self): 
+        return len(self.ts_)
+
+    def query(self, timestamps): 
+        """
+        Returns the interpolated poses (RigidTransformArray) at 
+        the queried timestamps [M], along with the validity mask [M]. 
+        """
+        t = np.atleast_1d(np.asarray(timestamps, dtype=np.float64))
+        ts, N = self.ts_, len(self.ts_)
+
+        # Bracketing samples ts[i0] <= t < ts[i1], and weights
+        i1 = np.clip(np.searchsorted(ts, t, side='right'), 1, N-1)
+        i0 = i1 - 1
+        dt = ts[i1] - ts[i0]
+        w = (t - ts[i0]) / np.where(dt > 0, dt, 1.0)
+
+        valid = np.ones(len(t), dtype=np.bool)
+        before, after = t < ts[0], t > ts[-1]
+        outside = np.bitwise_or(before, after)
+        if np.any(outside): 
+            if self.extrapolate_ == 'raise': 
+                raise ValueError('TrajectoryInterpolator: {:} queries outside [{:}, {:}]'
+                                 .format(np.sum(outside), ts[0], ts[-1]))
+            elif self.extrapolate_ == 'clamp': 
+                w = np.clip(w, 0, 1)
+            elif self.extrapolate_ == 'none': 
+                valid[outside] = False
+
+        if self.max_gap_ is not None: 
+            gap = np.where(before, ts[0] - t, np.where(after, t - ts[-1], dt))
+            valid = np.bitwise_and(valid, gap <= self.max_gap_)
+
+        return self.poses_[i0].interpolate(self.poses_[i1], w), valid
+
+    @property
+    def timestamps(self): 
+        return self.ts_
+
+    @property
+    def poses(self): 
+        return self.poses_
+
 class PoseInterpolator(PoseAccumulator): 
-    def __init__(self, maxlen=100, relative=False): 
+    """
+    Time-stamped pose history (up to maxlen), that can be
+    queried at arbitrary timestamps (see TrajectoryInterpolator)
+    """
+    def __init__(self, maxlen=100, relative=False, extrapolate='clamp', max_gap=None): 
         PoseAccumulator.__init__(self, maxlen=maxlen, relative=relative)
 
         self.relative_ = relative
         self.init_ = None
+        self.ts_ = deque(maxlen=maxlen)
+        self.extrapolate_ = extrapolate
+        self.max_gap_ = max_gap
         
-    def add(self, pose): 
+    def add(self, pose, t=None): 
+        """ 
+        Add pose at timestamp t (defaults to the next sample index, 
+        i.e. the previous timestamp + 1)
+        """
+        if t is None: 
+            t = self.ts_[-1] + 1 if len(self.ts_) else 0
+        if len(self.ts_) and t < self.ts_[-1]: 
+            raise ValueError('PoseInterpolator expects increasing timestamps')
+        self.ts_.append(t)
         super(PoseAccumulator, self).accumulate(pose)
 
-    def query(self, pose): 
-        raise NotImplementedError()
+    def query(self, t): 
+        """ Returns the interpolated poses, and validity mask at timestamps t """
+        return TrajectoryInterpolator(list(self.ts_), self.to_array(), 
+                                      extrapolate=self.extrapolate_, 
+                                      max_gap=self.max_gap_).query(t)
 
 class SkippedPoseAccumulator(PoseAccumulator): 
     def __init__(self, skip=10, **kwargs): 
@@ -4,6 +4,7 @@
 import cv2
 
 import numpy as np
+from collections import OrderedDict
 from numpy.linalg import det, norm
 import numpy.matlib as npm
 from scipy import linalg
@@ -11,7 +12,7 @@ from scipy import linalg
 from pybot.vision.color_utils import get_color_by_label
 from pybot.vision.image_utils import to_color
 from pybot.utils.db_utils import AttrDict
-from pybot.geometry.rigid_transform import Quaternion, RigidTransform
+from pybot.geometry.rigid_transform import RigidTransform, RigidTransformArray
 
 kinect_v1_params = AttrDict(
     K_depth = np.array([[576.09757860, 0, 319.5],
@@ -59,15 +60,19 @@ def sampson_error(F, pts1, pts2):
     -----------------
     (F * x)_1^2 + (F * x)_2^2 + (F^T * x')_1^2 + (F^T * x')_2^2
 
-    where (F * x)_i^2 is the square of the i-th entry of the vector Fx
+    where (F * x)_i^2 is the square of the i-th entry of the vector Fx, 
+    and x'^{T} * F * x = 0 (as in compute_fundamental). 
+
+    F may also be a stack of [H x 3 x 3] hypotheses, returning [H x N] errors
     """
+    F = np.asarray(F, dtype=np.float64)
     x1, x2 = unproject_points(pts1).T, unproject_points(pts2).T
-    Fx1 = np.dot(F, x1)
-    Fx2 = np.dot(F, x2)
+    Fx1 = np.matmul(F, x1)
+    Ftx2 = np.matmul(np.swapaxes(F, -1, -2), x2)
        
     # Sampson distance as error measure
-    denom = Fx1[0]**2 + Fx1[1]**2 + Fx2[0]**2 + Fx2[1]**2
-    return ( np.diag(x1.T.dot(Fx2)) )**2 / denom 
+    denom = Fx1[...,0,:]**2 + Fx1[...,1,:]**2 + Ftx2[...,0,:]**2 + Ftx2[...,1,:]**2
+    return np.sum(x2 * Fx1, axis=-2)**2 / denom 
     
 def get_baseline(fx, baseline=None, baseline_px=None): 
     """
@@ -106,6 +111,26 @@ def construct_D(k1=0, k2=0, k3=0, p1=0, p2=0):
     """
     return np.float64([k1,k2,p1,p2,k3])
 
+def distort_points(xy, D): 
+    """
+    Apply the OpenCV distortion model (k1, k2, p1, p2[, k3[, k4, k5, k6]])
+    to [... x 2] normalized image coordinates. D may be [... x M], 
+    broadcasting against the leading dimensions of xy.
+    """
+    D = np.asarray(D, dtype=np.float64)
+    if D.shape[-1] > 8: 
+        raise ValueError('Unsupported distortion model with {:} coefficients'.format(D.shape[-1]))
+    D = np.concatenate([D, np.zeros(D.shape[:-1] + (8 - D.shape[-1],))], axis=-1)
+    k1, k2, p1, p2, k3, k4, k5, k6 = [D[...,j] for j in range(8)]
+
+    x, y = xy[...,0], xy[...,1]
+    r2 = x * x + y * y
+    r4, r6 = r2 * r2, r2 * r2 * r2
+    radial = (1 + k1 * r2 + k2 * r4 + k3 * r6) / (1 + k4 * r2 + k5 * r4 + k6 * r6)
+    xd = x * radial + 2 * p1 * x * y + p2 * (r2 + 2 * x * x)
+    yd = y * radial + p1 * (r2 + 2 * y * y) + 2 * p2 * x * y
+    return np.stack([xd, yd], axis=-1)
+
 def undistort_image(im, K, D): 
     """
     Optionally: 
@@ -115,6 +140,29 @@ def undistort_image(im, K, D):
     Kprime, roi = cv2.getOptimalNewCameraMatrix(K, D, (W,H), 1, (W,H))
     return cv2.undistort(im, K, D, None, K)
 
+###############################################################################
+# Per-camera lookup tables (pixel rays, undistortion maps), keyed by (K, D, shape)
+
+_camera_tables = OrderedDict()
+
+def camera_tables(K, D, shape, maxlen=8): 
+    """
+    Returns the (LRU) cached lookup tables for the calibration and image shape. 
+    Tables are lazily populated (rays: [H x W x 3] float32, maps: CV_16SC2
+    initUndistortRectifyMap pair), and source is an optional (tables, scale) 
+    from which the rays may be derived.
+    """
+    key = (np.float64(K).tobytes(), np.float64(D).ravel().tobytes(), 
+           tuple(int(v) for v in shape[:2]))
+    try: 
+        tables = _camera_tables.pop(key)
+    except KeyError: 
+        tables = AttrDict(rays=None, maps=None, source=None)
+    _camera_tables[key] = tables
+    while len(_camera_tables) > maxlen: 
+        _camera_tables.popitem(last=False)
+    return tables
+
 # def camera_from_P(P): 
     
 def get_calib_params(fx, fy, cx, cy, baseline=None, baseline_px=None): 
@@ -145,6 +193,9 @@ def get_calib_params(fx, fy, cx, cy, baseline=None, baseline_px=None):
                     D0=D0, D1=D1, fx=fx, fy=fy, cx=cx, cy=cy, baseline=baseline, baseline_px=baseline * fx)
 
 class CameraIntrinsic(object): 
+    # Minimum number of (integral) points for ray() to use the ray table
+    ray_table_min_pts = 4096
+
     def __init__(self, K, D=np.zeros(5, dtype=np.float64), shape=None): 
         """
         K: Calibration matrix
@@ -231,11 +282,58 @@ class CameraIntrinsic(object):
         from resizing the image by the appropriate scale parameter
         """
         shape = np.int32(self.shape * scale) if self.shape is not None else None
-        return CameraIntrinsic.from_calib_params(self.fx * scale, self.fy * scale, 
-                                                 self.cx * scale, self.cy * scale, 
-                                                 k1=self.k1, k2=self.k2, k3=self.k3, 
-                                                 p1=self.p1, p2=self.p2, 
-                                                 shape=shape)
+        intrinsic = CameraIntrinsic.from_calib_params(self.fx * scale, self.fy * scale, 
+                                                      self.cx * scale, self.cy * scale, 
+                                                      k1=self.k1, k2=self.k2, k3=self.k3, 
+                                                      p1=self.p1, p2=self.p2, 
+                                                      shape=shape)
+
+        # Derive the scaled ray table from this camera's (once built)
+        if shape is not None and scale != 1.0: 
+            tables = camera_tables(intrinsic.K, intrinsic.D, shape)
+            if tables.rays is None: 
+                tables.source = (camera_tables(self.K, self.D, self.shape), scale)
+        return intrinsic
+
+    def ray_table(self): 
+        """
+        Returns the cached [H x W x 3] float32 table of undistorted 
+        rays (on the z=1 plane) for each pixel
+        """
+        if self.shape is None: 
+            raise ValueError('ray_table cannot proceed. CameraIntrinsic.shape is not set')
+        tables = camera_tables(self.K, self.D, self.shape)
+        if tables.rays is not None: 
+            return tables.rays
+
+        H, W = self.shape[:2]
+        if tables.source is not None and tables.source[0].rays is not None: 
+            # Resample the (unscaled) source table at u/scale, v/scale
+            source, scale = tables.source
+            mapx = np.tile(np.arange(W, dtype=np.float32) / scale, (H, 1))
+            mapy = np.tile((np.arange(H, dtype=np.float32) / scale)[:,np.newaxis], (1, W))
+            rays = cv2.remap(source.rays, mapx, mapy, cv2.INTER_LINEAR, 
+                             borderMode=cv2.BORDER_REPLICATE)
+        else: 
+            xs, ys = np.meshgrid(np.arange(W, dtype=np.float32), np.arange(H, dtype=np.float32))
+            xy = cv2.undistortPoints(np.dstack([xs, ys]).reshape(-1,1,2), 
+                                     np.float64(self.K), np.float64(self.D))
+            rays = np.dstack([xy.reshape(H, W, 2), np.ones((H, W), dtype=np.float32)])
+        tables.rays, tables.source = rays, None
+        return rays
+
+    def undistort_maps(self): 
+        """
+        Returns the cached fixed-point (CV_16SC2) undistortion maps 
+        """
+        if self.shape is None: 
+            raise ValueError('undistort_maps cannot proceed. CameraIntrinsic.shape is not set')
+        tables = camera_tables(self.K, self.D, self.shape)
+        if tables.maps is None: 
+            H, W = self.shape[:2]
+            tables.maps = cv2.initUndistortRectifyMap(self.K, self.D, None, self.K, 
+                                                      (int(W), int(H)), cv2.CV_16SC2)
+        return tables.maps
 
     def ray(self, pts, undistort=True, rotate=False, normalize=False): 
         """
@@ -243,10 +341,12 @@ class CameraIntrinsic(object):
         Optionally undistort (defaults to true), and 
         rotate ray to the camera's viewpoint 
         """
-        upts = self.undistort_points(pts) if undistort else pts
-        ret = unproject_points(
-            np.hstack([ (colvec(upts[:,0])-self.cx) / self.fx, (colvec(upts[:,1])-self.cy) / self.fy ])
-        )
+        ret = self._ray_lookup(pts) if undistort else None
+        if ret is None: 
+            upts = self.undistort_points(pts) if undistort else pts
+            ret = unproject_points(
+                np.hstack([ (colvec(upts[:,0])-self.cx) / self.fx, (colvec(upts[:,1])-self.cy) / self.fy ])
+            )
 
         if rotate: 
             ret = self.extrinsics.rotate_vec(ret)
@@ -256,6 +356,19 @@ class CameraIntrinsic(object):
 
         return ret
 
+    def _ray_lookup(self, pts): 
+        """
+        Returns rays from the ray table for dense sets of integral, 
+        in-bounds pixel coordinates (None otherwise)
+        """
+        if self.shape is None or len(pts) < self.ray_table_min_pts: 
+            return None
+        ipts = np.int64(np.round(pts))
+        if not (ipts == pts).all() or \
+           not ((ipts >= 0) & (ipts < self.shape[1::-1])).all(): 
+            return None
+        return np.float64(self.ray_table()[ipts[:,1], ipts[:,0]])
+
     def reconstruct(self, xyZ, undistort=True): 
         """
         Reproject to 3D with calib params
@@ -264,6 +377,13 @@ class CameraIntrinsic(object):
         return self.ray(xyZ[:,:2], undistort=undistort) * Z
         
     def undistort(self, im): 
+        """
+        Undistort image (using the cached undistortion maps, 
+        if the image matches the camera's shape)
+        """
+        if self.shape is not None and tuple(im.shape[:2]) == tuple(self.shape[:2]): 
+            map1, map2 = self.undistort_maps()
+            return cv2.remap(im, map1, map2, cv2.INTER_LINEAR)
         return undistort_image(im, self.K, self.D)
 
     def undistort_points(self, pts): 
@@ -309,12 +429,15 @@ class CameraExtrinsic(RigidTransform):
         """
         p = RigidTransform.from_Rt(R, t)
         RigidTransform.__init__(self, xyzw=p.quat.to_xyzw(), tvec=p.tvec)
-        self.__cached_inverse = None
+
+    def _invalidate(self): 
+        super(CameraExtrinsic, self)._invalidate()
+        self.inverse_ = None
 
     def inverse(self): 
-        if self.__cached_inverse is None: 
-            self.__cached_inverse = super(CameraExtrinsic, self).inverse()
-        return self.__cached_inverse
+        if self.inverse_ is None: 
+            self.inverse_ = super(CameraExtrinsic, self).inverse()
+        return self.inverse_
 
     def __repr__(self): 
         return 'CameraExtrinsic =======>\npose = {:}'.format(RigidTransform.__repr__(self))
@@ -336,18 +459,10 @@ class CameraExtrinsic(RigidTransform):
         R, t = p.to_Rt()
         return cls(R, t)
     
-    @property
-    def R(self): 
-        return self.quat.R
-
     @property
     def Rt(self): 
         return self.matrix[:3]
 
-    @property
-    def t(self): 
-        return self.tvec
-
     @classmethod
     def identity(cls): 
         """
@@ -424,28 +539,10 @@ class Camera(CameraIntrinsic, CameraExtrinsic):
         """
         Project [Nx3] points onto 2-D image plane [Nx2]
         """
-        R, t = self.to_Rt()
-	rvec,_ = cv2.Rodrigues(R)
-	proj,_ = cv2.projectPoints(X, rvec, t, self.K, self.D)
-        x = proj.reshape(-1,2)
-
-        if check_depth: 
-            # Only return positive depths
-            depths = self.depth_from_projection(X)
-            valid = depths >= min_depth
-        else:
-            valid = np.ones(len(x), dtype=np.bool)
-        
-        if check_bounds: 
-            if self.shape is None: 
-                raise ValueError('check_bounds cannot proceed. Camera.shape is not set')
-        
-            # Only return points within-image bounds
-            valid = np.bitwise_and(
-                valid, np.bitwise_and(
-                    np.bitwise_and(x[:,0] >= 0, x[:,0] < self.shape[1]), \
-                    np.bitwise_and(x[:,1] >= 0, x[:,1] < self.shape[0]))
-            )
+        x, depths, valid = project_many([self], X, 
+                                        min_depth=min_depth if check_depth else None, 
+                                        check_bounds=check_bounds)
+        x, depths, valid = x[0], depths[0], valid[0]
 
         if return_depth: 
             return x[valid], depths[valid]
@@ -459,7 +556,7 @@ class Camera(CameraIntrinsic, CameraExtrinsic):
         Transform points in camera frame, and check z-vector: 
         [p_c = T_cw * p_w]
         """
-        return (self.extrinsics * X)[:,2]
+        return (self * X)[:,2]
 
     def factor(self): 
         """
@@ -682,6 +779,7 @@ class StereoCamera(Camera):
     def reconstruct_sparse(self, xyd): 
         """
         Reproject to 3D with calib params
+        xyd: [N x 3] (x, y, disparity), e.g. from stereo_utils.sparse_stereo_match
         """
         N, _ = xyd.shape[:2]
         xyd1 = np.hstack([xyd, np.ones(shape=(N,1))])
@@ -732,25 +830,90 @@ class DepthCamera(CameraIntrinsic):
     def _build_mesh(self, shape): 
         H, W = shape
         xs,ys = np.arange(0,W), np.arange(0,H);
-        fx_inv = 1.0 / self.fx;
+        fx_inv, fy_inv = 1.0 / self.fx, 1.0 / self.fy
 
         self.xs = (xs-self.cx) * fx_inv
         self.xs = self.xs[::self.skip]
-        self.ys = (ys-self.cy) * fx_inv
+        self.ys = (ys-self.cy) * fy_inv
         self.ys = self.ys[::self.skip]
 
         self.xs, self.ys = np.meshgrid(self.xs, self.ys);
 
-    def reconstruct(self, depth): 
+        # Single-precision mesh (for float32/float16 outputs), and 
+        # invalid-depth scratch buffers
+        self.mesh32_ = (self.xs.astype(np.float32), self.ys.astype(np.float32))
+        self.invalid_ = np.empty(self.xs.shape, dtype=np.bool)
+        self.scratch_ = np.empty(self.xs.shape, dtype=np.bool)
+
+    def reconstruct(self, depth, out=None, dtype=np.float64, depth_scale=1.0, 
+                    min_depth=None, max_depth=None, voxel_size=None): 
+        """
+        Reconstruct the [H/skip x W/skip x 3] point cloud from depth, 
+        writing into out (float64/float32/float16) if provided. 
+
+        depth_scale:            Scale applied to depth (e.g. 0.001 for mm)
+        min_depth, max_depth:   Points with depth outside the range are set to NaN
+        voxel_size:             If provided, returns the [M x 3] valid points 
+                                subsampled to one point per voxel instead
+        """
         s = self.skip
         depth_sampled = depth[::s,::s]
-        assert(depth_sampled.shape == self.xs.shape)
-        return np.dstack([self.xs * depth_sampled, self.ys * depth_sampled, depth_sampled])
-
-    def reconstruct_sparse(self, pts, depth): 
-        return np.vstack([(pts[:,0] - self.cx) * 1.0 / self.fx * depth,
-                          (pts[:,1] - self.cy) * 1.0 / self.fx * depth, 
-                          depth]).T
+        if depth_sampled.shape != self.xs.shape: 
+            raise ValueError('Depth shape {:} (skip={:}) does not match camera {:}'
+                             .format(depth.shape, s, self.xs.shape))
+        if out is None: 
+            out = np.empty(depth_sampled.shape + (3,), dtype=dtype)
+        xs, ys = (self.xs, self.ys) if out.dtype == np.float64 else self.mesh32_
+
+        # Z (invalidated outside the depth range), and X, Y along rays
+        Z = out[...,2]
+        if depth_scale != 1.0: 
+            np.multiply(depth_sampled, depth_scale, out=Z, casting='unsafe')
+        else: 
+            np.copyto(Z, depth_sampled, casting='unsafe')
+
+        if min_depth is not None or max_depth is not None: 
+            invalid = self.invalid_
+            invalid.fill(False)
+            with np.errstate(invalid='ignore'): 
+                if min_depth is not None: 
+                    np.less(Z, min_depth, out=invalid)
+                if max_depth is not None: 
+                    np.greater(Z, max_depth, out=self.scratch_)
+                    np.logical_or(invalid, self.scratch_, out=invalid)
+            np.copyto(Z, np.nan, where=invalid)
+
+        np.multiply(xs, Z, out=out[...,0], casting='unsafe')
+        np.multiply(ys, Z, out=out[...,1], casting='unsafe')
+
+        if voxel_size is not None: 
+            X = out.reshape(-1,3)
+            return voxel_subsample(X[np.isfinite(X[:,2])], voxel_size)
+        return out
+
+    def reconstruct_sparse(self, pts, depth, out=None): 
+        """
+        Reconstruct [N x 3] points from [N x 2] pixels and [N] depths, 
+        writing into out if provided
+        """
+        if out is None: 
+            out = np.empty((len(pts), 3), dtype=np.result_type(pts, depth, np.float32))
+        np.copyto(out[:,2], depth, casting='unsafe')
+        np.multiply(pts[:,0] - self.cx, 1.0 / self.fx, out=out[:,0], casting='unsafe')
+        np.multiply(pts[:,1] - self.cy, 1.0 / self.fy, out=out[:,1], casting='unsafe')
+        out[:,:2] *= out[:,2:]
+        return out
+
+    def reconstruct_stream(self, depths, buffers=2, dtype=np.float32, **kwargs): 
+        """
+        Generator over a depth stream, that reconstructs each frame into a 
+        ring of preallocated outputs (see reconstruct for kwargs). A yielded 
+        point cloud is overwritten after the next `buffers`-1 frames; copy 
+        it if it needs to be retained.
+        """
+        ring = np.empty((buffers,) + self.xs.shape + (3,), dtype=dtype)
+        for idx, depth in enumerate(depths): 
+            yield self.reconstruct(depth, out=ring[idx % buffers], **kwargs)
 
     def save(self, filename): 
         raise NotImplementedError()
@@ -813,6 +976,81 @@ def compute_essential(F, K):
     """ Compute the Essential matrix, and R1, R2 """
     return (K.T).dot(npm.mat(F)).dot(K)
 
+def project_many(cameras, X, poses=None, min_depth=0.1, check_bounds=True): 
+    """
+    Project [N x 3] points onto K cameras in a single vectorized pass. 
+
+    cameras: List of K Cameras, or a single CameraIntrinsic 
+             together with K (world-to-camera) poses
+    poses:   RigidTransformArray (or list of RigidTransform) of K poses, 
+             only if cameras is a CameraIntrinsic
+
+    Returns: 
+       pts2d:   [K x N x 2] projections (distortion applied)
+       depths:  [K x N] depths in each camera's frame
+       valid:   [K x N] mask for points with depth >= min_depth (if
+                min_depth is not None), and within image bounds 
+                (if check_bounds)
+    """
+    X = np.asarray(X, dtype=np.float64).reshape(-1,3)
+
+    # Stack intrinsics and extrinsics
+    if poses is not None: 
+        if not isinstance(poses, RigidTransformArray): 
+            poses = RigidTransformArray.from_list(poses)
+        R, t = poses.R, poses.t
+        K = np.asarray(cameras.K, dtype=np.float64)[np.newaxis]
+        D = np.asarray(cameras.D, dtype=np.float64).reshape(1,-1)
+        shapes = [cameras.shape]
+    else: 
+        R = np.stack([cam.R for cam in cameras])
+        t = np.stack([np.array(cam.tvec, dtype=np.float64).ravel() for cam in cameras])
+        K = np.stack([np.asarray(cam.K, dtype=np.float64) for cam in cameras])
+        nD = max(len(np.ravel(cam.D)) for cam in cameras)
+        D = np.stack([np.r_[np.ravel(cam.D), np.zeros(nD - len(np.ravel(cam.D)))]
+                      for cam in cameras])
+        shapes = [cam.shape for cam in cameras]
+
+    # Transform points in camera frame [p_c = T_cw * p_w]
+    Xc = np.matmul(R, X.T) + t[:,:,np.newaxis]
+    depths = Xc[:,2]
+    with np.errstate(divide='ignore', invalid='ignore'): 
+        iz = 1.0 / depths
+    x, y = Xc[:,0] * iz, Xc[:,1] * iz
+
+    # Distort, and apply calibration
+    if np.any(D): 
+        xy = distort_points(np.stack([x, y], axis=-1), D[:,np.newaxis,:])
+        x, y = xy[...,0], xy[...,1]
+    u = K[:,0,0,np.newaxis] * x + K[:,0,1,np.newaxis] * y + K[:,0,2,np.newaxis]
+    v = K[:,1,1,np.newaxis] * y + K[:,1,2,np.newaxis]
+    pts2d = np.stack([u, v], axis=-1)
+
+    valid = np.ones(depths.shape, dtype=np.bool)
+    if min_depth is not None: 
+        valid &= depths >= min_depth
+        
+    if check_bounds: 
+        if any(shape is None for shape in shapes): 
+            raise ValueError('check_bounds cannot proceed. Camera.shape is not set')
+        HW = np.float64([shape[:2] for shape in shapes])
+        valid &= (u >= 0) & (u < HW[:,1,np.newaxis]) & (v >= 0) & (v < HW[:,0,np.newaxis])
+
+    return pts2d, depths, valid
+
+def voxel_subsample(X, voxel_size): 
+    """
+    Subsample [N x 3] points to (the first) one point per voxel
+    """
+    if not len(X): 
+        return X
+    ijk = np.floor(X / voxel_size).astype(np.int64)
+    ijk -= ijk.min(axis=0)
+    dims = ijk.max(axis=0) + 1
+    keys = (ijk[:,0] * dims[1] + ijk[:,1]) * dims[2] + ijk[:,2]
+    _, inds = np.unique(keys, return_index=True)
+    return X[np.sort(inds)]
+
 def check_visibility(camera, pts_w, zmin=0, zmax=100): 
     """
     Check if points are visible given fov of camera. 
@@ -831,9 +1069,143 @@ def check_visibility(camera, pts_w, zmin=0, zmax=100):
     hangle, vangle = np.arctan2(v[:,0], v[:,2]), np.arctan2(-v[:,1], v[:,2])
 
     # Provides inds mask for all points that are within fov
-    return np.fabs(hangle) < camera.fov[0] * 0.5 and \
-        np.fabs(vangle) < camera.fov[1] * 0.5 and \
-        z >= zmin and z <= zmax
+    return (np.fabs(hangle) < camera.fov[0] * 0.5) & \
+        (np.fabs(vangle) < camera.fov[1] * 0.5) & \
+        (z >= zmin) & (z <= zmax)
+
+def frustum_planes(cameras, poses=None, zmin=0.01, zmax=100): 
+    """
+    Batched frustum planes for K cameras (or a CameraIntrinsic with K 
+    poses, see project_many), clipped to [zmin, zmax]
+
+    Returns: 
+       planes: [K x 6 x 4] world-frame planes [n, d] (left, bottom, 
+               right, top, near, far) with unit normals pointing 
+               inwards, i.e. n.X + d >= 0 for X inside the frustum
+    """
+    if zmin <= 0 or zmax <= zmin: 
+        raise ValueError('Invalid frustum depth range [{:}, {:}]'.format(zmin, zmax))
+
+    # Stack intrinsics and extrinsics
+    if poses is not None: 
+        if not isinstance(poses, RigidTransformArray): 
+            poses = RigidTransformArray.from_list(poses)
+        R, t = poses.R, poses.t
+        intrinsics = [cameras]
+    else: 
+        R = np.stack([cam.R for cam in cameras])
+        t = np.stack([np.array(cam.tvec, dtype=np.float64).ravel() for cam in cameras])
+        intrinsics = cameras
+    if any(cam.shape is None for cam in intrinsics): 
+        raise ValueError('frustum_planes cannot proceed. Camera.shape is not set')
+
+    # Image corners (ccw in the image): [0,0], [0,H-1], [W-1,H-1], [W-1,0]
+    HW = np.float64([cam.shape[:2] for cam in intrinsics])
+    H, W = HW[:,0] - 1, HW[:,1] - 1
+    Z = np.zeros_like(H)
+    corners = np.stack([np.stack([Z, Z], axis=-1), np.stack([Z, H], axis=-1), 
+                        np.stack([W, H], axis=-1), np.stack([W, Z], axis=-1)], axis=1)
+
+    # Undistort corners (only for distorted cameras), and back-project to 
+    # rays on the z=1 plane [C x 4 x 3]
+    for idx, cam in enumerate(intrinsics): 
+        if np.any(cam.D): 
+            corners[idx] = cam.undistort_points(np.float32(corners[idx])).reshape(-1,2)
+    K = np.stack([np.asarray(cam.K, dtype=np.float64) for cam in intrinsics])
+    y = (corners[...,1] - K[:,1,2,np.newaxis]) / K[:,1,1,np.newaxis]
+    x = (corners[...,0] - K[:,0,2,np.newaxis] - K[:,0,1,np.newaxis] * y) / K[:,0,0,np.newaxis]
+    rays = np.stack([x, y, np.ones_like(x)], axis=-1)
+
+    # Side planes pass through the camera center, normals oriented 
+    # towards the optical axis [C x 6 x 4] (camera frame)
+    normals = np.cross(rays, np.roll(rays, -1, axis=1))
+    normals /= np.linalg.norm(normals, axis=2)[...,np.newaxis]
+    normals *= np.sign(np.sum(normals * rays.mean(axis=1)[:,np.newaxis], axis=2))[...,np.newaxis]
+    C = len(intrinsics)
+    planes_c = np.zeros((C, 6, 4), dtype=np.float64)
+    planes_c[:,:4,:3] = normals
+    planes_c[:,4] = [0, 0, 1, -zmin]
+    planes_c[:,5] = [0, 0, -1, zmax]
+    planes_c = np.broadcast_to(planes_c, (len(R), 6, 4))
+
+    # Transform to world frame (p_c = R p_w + t): 
+    # n_w = R^T n_c, d_w = d_c + n_c . t
+    planes = np.empty_like(planes_c)
+    planes[...,:3] = np.matmul(planes_c[...,:3], R)
+    planes[...,3] = planes_c[...,3] + np.matmul(planes_c[...,:3], t[:,:,np.newaxis])[...,0]
+    return planes
+
+def frustum_cull(planes, X, voxel_size=None, chunk_size=65536): 
+    """
+    Test [N x 3] points against K frusta ([K x 6 x 4] planes, see 
+    frustum_planes). Points are tested in chunks of chunk_size, to
+    bound the [K x 6 x chunk_size] intermediate.
+
+    voxel_size: If provided, points are first bucketed into voxels; 
+                voxels entirely outside (inside) a frustum are rejected
+                (accepted) without testing their points
+
+    Returns: 
+       inds: List of K arrays of visible point indices (sorted)
+    """
+    planes = np.asarray(planes, dtype=np.float64).reshape(-1,6,4)
+    X = np.asarray(X, dtype=np.float64).reshape(-1,3)
+    K, N = len(planes), len(X)
+    if not N: 
+        return [np.empty(0, dtype=np.int64) for _ in range(K)]
+
+    def inside(Y, margin=0):
+        d = np.matmul(planes[:,:,:3], Y.T) + planes[:,:,3,np.newaxis]
+        return (d >= margin).all(axis=1), (d < -margin).any(axis=1)
+
+    def inside_chunked(Y): 
+        return np.hstack([inside(Y[j:j+chunk_size])[0] for j in range(0, len(Y), chunk_size)])
+
+    if voxel_size is None: 
+        mask = inside_chunked(X)
+        return [np.flatnonzero(m) for m in mask]
+
+    # Bucket points into voxels, and classify voxels by their 
+    # bounding spheres
+    ijk = np.floor(X / voxel_size).astype(np.int64)
+    origin = ijk.min(axis=0)
+    ijk -= origin
+    dims = ijk.max(axis=0) + 1
+    keys = (ijk[:,0] * dims[1] + ijk[:,1]) * dims[2] + ijk[:,2]
+    ukeys, inverse = np.unique(keys, return_inverse=True)
+    uijk = np.stack([ukeys // (dims[1] * dims[2]), (ukeys // dims[2]) % dims[1], 
+                     ukeys % dims[2]], axis=1) + origin
+    centers = (uijk + 0.5) * voxel_size
+    radius = np.sqrt(3) * 0.5 * voxel_size
+    vinside, voutside = [], []
+    for j in range(0, len(ukeys), chunk_size): 
+        i, o = inside(centers[j:j+chunk_size], margin=radius)
+        vinside.append(i)
+        voutside.append(o)
+    vinside, voutside = np.hstack(vinside), np.hstack(voutside)
+
+    # Test points only within voxels straddling a frustum boundary
+    inds = []
+    for k in range(K): 
+        mask = vinside[k][inverse]
+        partial, = np.where(~(vinside[k] | voutside[k])[inverse])
+        if len(partial): 
+            mask[partial] = _frustum_inside(planes[k], X[partial], chunk_size)
+        inds.append(np.flatnonzero(mask))
+    return inds
+
+def _frustum_inside(plane, X, chunk_size): 
+    """ Single frustum point test [6 x 4], [N x 3] -> [N] """
+    return np.hstack([((np.dot(X[j:j+chunk_size], plane[:,:3].T) + plane[:,3]) >= 0).all(axis=1)
+                      for j in range(0, len(X), chunk_size)])
+
+def visible_points(cameras, X, poses=None, zmin=0.01, zmax=100, voxel_size=None, chunk_size=65536): 
+    """
+    Per-camera visible point indices of [N x 3] world points for K cameras
+    (or a CameraIntrinsic with K poses), via frustum_planes and frustum_cull
+    """
+    planes = frustum_planes(cameras, poses=poses, zmin=zmin, zmax=zmax)
+    return frustum_cull(planes, X, voxel_size=voxel_size, chunk_size=chunk_size)
 
 def get_median_depth(camera, pts, subsample=10): 
     """ 
@@ -855,25 +1227,68 @@ def get_bounded_projection(camera, pts, subsample=10):
                            np.bitwise_and(pts2d[:,1] >= 0, pts2d[:,1] < camera.shape[0]))
     return pts2d[valid], valid
 
-def get_discretized_projection(camera, pts, subsample=10, discretize=4): 
+def zbuffer(pts2d, depths, shape, discretize=1, empty=np.inf, tol=0.0): 
+    """
+    Z-buffer rasterization of projected points, keeping the nearest 
+    depth per (discretized) pixel via a sort-based scatter-min
 
-    vis = np.ones(shape=(camera.shape[0]/discretize, camera.shape[1]/discretize), dtype=np.float32) * 10000.0
-    pts2d, valid = get_bounded_projection(camera, pts, subsample=subsample)
+        pts2d:      [N x 2] projected points (pixels)
+        depths:     [N] depths of the projected points
+        shape:      Image shape (H, W), rendered at (H/discretize, W/discretize)
+        tol:        Points within tol of the nearest depth are also visible
 
-    if True: 
-        pts3d = pts[valid]
-        depth = (camera * pts3d[::subsample])[:,2]
-        vis[pts2d[::subsample,1], pts2d[::subsample,0]] = depth 
-    else: 
-        pts2d = pts2d.astype(np.int32) / discretize
-        depth = get_median_depth(camera, pts, subsample=subsample)
-        vis[pts2d[:,1], pts2d[:,0]] = depth 
+    Returns: 
+       zbuf: Depth image (empty where no points project)
+       visible: [N] mask of in-bounds points that are not occluded
+    """
+    H, W = int(shape[0]) // discretize, int(shape[1]) // discretize
+    zbuf = np.full((H, W), empty, dtype=np.float32)
+
+    # Discretize and check bounds (and depth)
+    xy = np.floor(np.asarray(pts2d, dtype=np.float64).reshape(-1,2) / discretize)
+    depths = np.asarray(depths).ravel()
+    with np.errstate(invalid='ignore'): 
+        valid = (xy[:,0] >= 0) & (xy[:,0] < W) & (xy[:,1] >= 0) & (xy[:,1] < H) & (depths > 0)
+    inds, = np.where(valid)
+    visible = np.zeros(len(depths), dtype=np.bool)
+    if not len(inds): 
+        return zbuf, visible
+
+    # Scatter-min: sort by (pixel, depth), and keep the first per pixel
+    pix = xy[inds,1].astype(np.int64) * W + xy[inds,0].astype(np.int64)
+    order = np.lexsort((depths[inds], pix))
+    spix, sdepths = pix[order], depths[inds[order]]
+    first = np.r_[True, spix[1:] != spix[:-1]]
+    zbuf.flat[spix[first]] = sdepths[first]
+
+    # Compare against the nearest depth per pixel at full precision
+    # (zbuf is float32, and rounding would occlude the nearest points)
+    nearest = sdepths[first][np.cumsum(first) - 1]
+    visible[inds[order]] = sdepths <= nearest + tol
+    return zbuf, visible
+
+def get_discretized_projection(camera, pts, subsample=10, discretize=4, empty=10000.0, tol=0.0): 
+    """
+    Render the (subsampled) points into a depth image of the camera, at 
+    1/discretize resolution, with nearest-depth (z-buffer) semantics
 
-    return vis, depth
+    Returns: 
+       vis: Depth image [H/discretize x W/discretize] (empty where no points project)
+       visible: Mask of the subsampled points pts[::subsample] that are 
+                within bounds and not occluded
+    """
+    if camera.shape is None: 
+        raise ValueError('get_discretized_projection cannot proceed. Camera.shape is not set')
+    pts2d, depths, _ = project_many([camera], pts[::subsample], min_depth=None, check_bounds=False)
+    return zbuffer(pts2d[0], depths[0], camera.shape, discretize=discretize, empty=empty, tol=tol)
 
-def get_object_bbox(camera, pts, subsample=10, scale=1.0, min_height=10, min_width=10): 
+def get_object_bbox(camera, pts, subsample=10, scale=1.0, min_height=10, min_width=10, 
+                    zbuf=None, tol=0.05): 
     """
 
+    zbuf: Optional scene depth image (see get_discretized_projection), 
+          points occluded by more than tol are excluded from the bbox
+
     Returns: 
        pts2d: Projected points onto camera
        bbox: Bounding box of the projected points [l, t, r, b]
@@ -883,6 +1298,14 @@ def get_object_bbox(camera, pts, subsample=10, scale=1.0, min_height=10, min_wid
 
     pts2d, valid = get_bounded_projection(camera, pts, subsample=subsample)
 
+    # Remove occluded points 
+    if zbuf is not None and len(pts2d): 
+        discretize = int(camera.shape[0]) // zbuf.shape[0]
+        depths = (camera * pts[::subsample][valid])[:,2]
+        xy = np.int64(pts2d // discretize)
+        xy = np.minimum(xy, [zbuf.shape[1]-1, zbuf.shape[0]-1])
+        pts2d = pts2d[depths <= zbuf[xy[:,1], xy[:,0]] + tol]
+
     if not len(pts2d): 
         return [None] * 3
 
@@ -907,6 +1330,41 @@ def get_object_bbox(camera, pts, subsample=10, scale=1.0, min_height=10, min_wid
     else: 
         return [None] * 3
 
+def get_object_bboxes(cameras, pts, poses=None, subsample=10, scale=1.0, min_height=10, min_width=10): 
+    """
+    Batched get_object_bbox over K cameras (or a CameraIntrinsic with K poses, 
+    see project_many)
+
+    Returns: 
+       bboxes: Bounding boxes of the projected points [K x 4] ([l, t, r, b])
+       depths: Median depths of the projected points [K]
+       valid: Mask of cameras with a valid bounding box [K]
+
+    """
+    pts2d, depths, visible = project_many(cameras, pts[::subsample], poses=poses, 
+                                          min_depth=None, check_bounds=True)
+    shapes = [cameras.shape] if poses is not None else [cam.shape for cam in cameras]
+    HW = np.float64([shape[:2] for shape in shapes])
+    H, W = HW[:,0], HW[:,1]
+
+    # Min-max bounds
+    u, v = pts2d[...,0], pts2d[...,1]
+    x0 = np.floor(np.maximum(0, np.where(visible, u, np.inf).min(axis=1)))
+    x1 = np.floor(np.minimum(W-1, np.where(visible, u, -np.inf).max(axis=1)))
+    y0 = np.floor(np.maximum(0, np.where(visible, v, np.inf).min(axis=1)))
+    y1 = np.floor(np.minimum(H-1, np.where(visible, v, -np.inf).max(axis=1)))
+
+    # Median depth (over all points, as in get_median_depth)
+    depth = np.median(depths, axis=1)
+    valid = visible.any(axis=1) & ((y1-y0) >= min_height) & ((x1-x0) >= min_width) & (depth >= 0)
+
+    if scale != 1.0: 
+        w2, h2 = (scale-1.0) * (x1-x0) / 2, (scale-1.0) * (y1-y0) / 2
+        x0, x1 = np.floor(np.maximum(0, x0 - w2)), np.floor(np.minimum(x1 + w2, W-1))
+        y0, y1 = np.floor(np.maximum(0, y0 - h2)), np.floor(np.minimum(y1 + h2, H-1))
+
+    return np.float32(np.vstack([x0, y0, x1, y1]).T), depth, valid
+
 def epipolar_line(F_10, x_0): 
     """
     l_1 = F_10 * x_0
@@ -987,11 +1445,16 @@ def test_HalfPlane():
     pass
 
 class Frustum(object): 
-    def __init__(self, vertices): 
+    def __init__(self, vertices, camera=None, zmin=None, zmax=None): 
         """
         Vertices: nll, nlr, nur, nul, fll, flr, fur, ful
+
+        camera, zmin, zmax: Full field-of-view camera frustum (see from_camera), 
+                            whose planes are determined via frustum_planes
         """
         self.vertices_ = vertices
+        self.camera_ = camera
+        self.zmin_, self.zmax_ = zmin, zmax
 
     @property
     def _front_back_vertices(self): 
@@ -1052,12 +1515,15 @@ class Frustum(object):
             raise ValueError('zmin needs to be finite > 0.01')
 
         # Construct frustum for full camera field-of-view 
+        camera = None
         if pts is None: 
             H, W = c.shape
             pts = np.vstack([[0, 0], [0,H-1], [W-1,H-1], [W-1,0]])
+            camera = c
           
         rays = c.ray(pts, undistort=True, rotate=False)
-        return cls(c.w2c(np.vstack([rays * zmin, rays * zmax])))           
+        return cls(c.w2c(np.vstack([rays * zmin, rays * zmax])), 
+                   camera=camera, zmin=zmin, zmax=zmax)
 
     @property
     def vertices(self): 
@@ -1092,9 +1558,22 @@ class Frustum(object):
 
     @property
     def planes(self): 
-        # plane parameters : [n, -n.p]
+        """
+        Returns the [6 x 4] plane parameters [n, -n.p] (left, bottom, right, 
+        top, near, far) with normals pointing inwards, as in frustum_planes
+        """
+        if self.camera_ is not None: 
+            return frustum_planes([self.camera_], zmin=self.zmin_, zmax=self.zmax_)[0]
+
         pts, normals = self.points_and_normals
-        return np.hstack([normals, -np.sum(np.multiply(pts, normals), axis=1).reshape(-1,1)])
+        planes = np.hstack([normals, -np.sum(np.multiply(pts, normals), axis=1).reshape(-1,1)])
+        center = np.mean(self.vertices_, axis=0)
+        sign = np.where(np.dot(planes[:,:3], center) + planes[:,3] < 0, -1., 1.)
+        return planes * sign[:,np.newaxis]
+
+    def contains(self, pts, chunk_size=65536): 
+        """ Returns the mask of [N x 3] points within the frustum (see frustum_cull) """
+        return _frustum_inside(self.planes, np.asarray(pts, dtype=np.float64).reshape(-1,3), chunk_size)
 
 
 def test_Frustum(): 
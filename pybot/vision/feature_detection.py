@@ -160,11 +160,24 @@ class FeatureDetector(object):
     def detector(self): 
         return self.detector_
 
-    def process(self, im, mask=None, return_keypoints=False): 
-        # Detect features 
+    def process(self, im, mask=None, return_keypoints=False, cells=None):
+        """
+        Detect features, optionally restricted to a dense mask, or to
+        a compact cell description (cell_size, free) where free is
+        a [rows x cols] boolean grid of cells requiring features
+        """
+        # Restrict detection to the free cells, so that the detector's
+        # (grid-adapted) budget is only spent where features are required
+        if cells is not None: 
+            cell_size, free = cells
+            cell_mask = np.repeat(np.repeat(np.uint8(free) * 255, cell_size, axis=0), 
+                                  cell_size, axis=1)[:im.shape[0], :im.shape[1]]
+            mask = cell_mask if mask is None else cv2.bitwise_and(mask, cell_mask)
+
+        # Detect features
         kpts = self.detector.detect(im, mask=mask)
         pts = to_pts(kpts)
-        
+
         # Perform sub-pixel if necessary
         if self.subpixel_: self.subpixel_pts(im, pts)
 
@@ -18,7 +18,7 @@ def im_resize(im, shape=None, scale=0.5, interpolation=cv2.INTER_AREA):
             return cv2.resize(im, None, fx=scale, fy=scale, interpolation=interpolation)
         else: 
             shape = (int(im.shape[1]*scale), int(im.shape[0]*scale))
-            return im_resize(im, shape)
+            return im_resize(im, shape, interpolation=interpolation)
 
 def im_pad(im, pad=3, value=0): 
     return cv2.copyMakeBorder(im, pad, pad, pad, pad, cv2.BORDER_CONSTANT, value)
@@ -0,0 +1,486 @@
+# Author: Sudeep Pillai <spillai@csail.mit.edu>
+# License: MIT
+
+"""
+Robust model estimation with batched minimal solvers and vectorized
+hypothesis scoring (all hypotheses x all matches in one residual
+tensor).
+
+Solvers:
+    FundamentalSolver(method='8point' | '7point')
+    EssentialSolver (5-point, calibrated/normalized coordinates)
+    PnPSolver (P3P minimal, 6-point linear refinement, calibrated/normalized 
+               coordinates)
+
+Usage:
+    res = find_fundamental(pts1, pts2, threshold=1.0, seed=0)
+    F, inliers = res.model, res.inliers
+    print res.timings
+
+    ids, p1, p2 = klt.matches()
+    res = find_essential(p1, p2, K, threshold=1.0)
+"""
+
+import time
+import numpy as np
+from collections import OrderedDict
+
+from pybot.utils.db_utils import AttrDict
+from pybot.vision.camera_utils import sampson_error
+
+def _normalization(x):
+    """ Isotropic (Hartley) normalization transform for [N x 2] points """
+    c = x.mean(axis=0)
+    s = np.sqrt(2) / max(np.sqrt(((x - c) ** 2).sum(axis=1)).mean(), 1e-12)
+    return np.array([[s, 0, -s * c[0]], [0, s, -s * c[1]], [0, 0, 1.]])
+
+def _transform(T, x):
+    return x * T[0,0] + T[:2,2]
+
+def _epipolar_rows(x1, x2):
+    """ Rows of x2^T F x1 = 0 for [..., n, 2] points -> [..., n, 9] """
+    x1h = np.concatenate([x1, np.ones(x1.shape[:-1] + (1,))], axis=-1)
+    x2h = np.concatenate([x2, np.ones(x2.shape[:-1] + (1,))], axis=-1)
+    return (x2h[...,:,np.newaxis] * x1h[...,np.newaxis,:]).reshape(x1.shape[:-1] + (9,))
+
+def _null_space(A, n=1):
+    """ Last n right singular vectors of a stack of matrices [..., m, k] """
+    if A.shape[-2] < A.shape[-1]:
+        pad = np.zeros(A.shape[:-2] + (A.shape[-1] - A.shape[-2], A.shape[-1]))
+        A = np.concatenate([A, pad], axis=-2)
+    _, _, Vt = np.linalg.svd(A, full_matrices=False)
+    return Vt[...,-n:,:]
+
+def _rank2(F):
+    U, S, Vt = np.linalg.svd(F)
+    S[...,2] = 0
+    return np.matmul(U * S[...,np.newaxis,:], Vt)
+
+def _essential_manifold(E):
+    U, S, Vt = np.linalg.svd(E)
+    S[...,:2], S[...,2] = 1, 0
+    return np.matmul(U * S[...,np.newaxis,:], Vt)
+
+def eight_point(x1, x2):
+    """ Batched 8-point algorithm: [H x n x 2] points (n >= 8) -> [H x 3 x 3] """
+    F = _null_space(_epipolar_rows(x1, x2))[...,0,:].reshape(x1.shape[:-2] + (3,3))
+    return _rank2(F)
+
+def seven_point(x1, x2):
+    """
+    Batched 7-point algorithm: [H x 7 x 2] points -> up to 3
+    solutions per sample, as ([M x 3 x 3] models, [M] sample indices)
+    """
+    N = _null_space(_epipolar_rows(x1, x2), n=2)
+    F1, F2 = N[:,0].reshape(-1,3,3), N[:,1].reshape(-1,3,3)
+
+    # det(a F1 + (1-a) F2) is a cubic in a, fit from 4 evaluations
+    a = np.float64([0, 1, -1, 2])
+    dets = np.linalg.det(a[:,np.newaxis,np.newaxis,np.newaxis] * F1 +
+                         (1 - a)[:,np.newaxis,np.newaxis,np.newaxis] * F2).T
+    coeffs = np.linalg.solve(np.vander(a, 4), dets.T).T
+
+    # Roots via companion matrices [H x 3 x 3]
+    valid = np.abs(coeffs[:,0]) > 1e-12 * np.abs(coeffs).max(axis=1)
+    c = coeffs / np.where(valid, coeffs[:,0], 1)[:,np.newaxis]
+    C = np.zeros((len(c), 3, 3))
+    C[:,0] = -c[:,1:]
+    C[:,1,0] = C[:,2,1] = 1
+    roots = np.linalg.eigvals(C)
+    real = (np.abs(roots.imag) < 1e-8) & valid[:,np.newaxis]
+    hyp, k = np.where(real)
+    r = roots.real[hyp, k][:,np.newaxis,np.newaxis]
+    return r * F1[hyp] + (1 - r) * F2[hyp], hyp
+
+# Monomials in (x, y, z) up to degree 3, ordered as
+# [x3, x2y, x2z, xy2, xyz, xz2, y3, y2z, yz2, z3, x2, xy, xz, y2, yz, z2, x, y, z, 1]
+_MONOMIALS = [(3,0,0), (2,1,0), (2,0,1), (1,2,0), (1,1,1), (1,0,2), (0,3,0), (0,2,1), (0,1,2), (0,0,3),
+              (2,0,0), (1,1,0), (1,0,1), (0,2,0), (0,1,1), (0,0,2), (1,0,0), (0,1,0), (0,0,1), (0,0,0)]
+
+def _product_table():
+    index = dict((m, k) for k, m in enumerate(_MONOMIALS))
+    T = np.zeros((len(_MONOMIALS) ** 2, len(_MONOMIALS)))
+    for i, mi in enumerate(_MONOMIALS):
+        for j, mj in enumerate(_MONOMIALS):
+            m = tuple(a + b for a, b in zip(mi, mj))
+            if m in index:
+                T[i * len(_MONOMIALS) + j, index[m]] = 1
+    return T
+
+_PRODUCT = _product_table()
+
+def _pmul(p, q):
+    """ Product of (batched) polynomials, truncated to degree 3 """
+    pq = p[...,:,np.newaxis] * q[...,np.newaxis,:]
+    return np.dot(pq.reshape(pq.shape[:-2] + (-1,)), _PRODUCT)
+
+def five_point(x1, x2):
+    """
+    Batched 5-point algorithm (Stewenius et al. [1]) for normalized
+    [H x 5 x 2] points -> up to 10 essential matrices per sample, as
+    ([M x 3 x 3] models, [M] sample indices)
+
+    [1] H. Stewenius, C. Engels, D. Nister, Recent developments on direct
+    relative orientation, ISPRS J. of Photogrammetry and Remote Sensing, 2006
+    """
+    H = len(x1)
+    N = _null_space(_epipolar_rows(x1, x2), n=4)
+
+    # E = x E1 + y E2 + z E3 + E4 as polynomial matrices [H x 3 x 3 x 20]
+    E = np.zeros((H, 3, 3, len(_MONOMIALS)))
+    E[...,16:20] = np.transpose(N.reshape(H, 4, 3, 3), (0,2,3,1))
+
+    # det(E) = 0, and 2 E E^T E - trace(E E^T) E = 0
+    EEt = sum(_pmul(E[:,:,np.newaxis,k], E[:,np.newaxis,:,k]) for k in range(3))
+    trace = EEt[:,0,0] + EEt[:,1,1] + EEt[:,2,2]
+    cons = sum(_pmul(2 * EEt[:,:,k,np.newaxis], E[:,np.newaxis,k]) for k in range(3)) - \
+        _pmul(trace[:,np.newaxis,np.newaxis], E)
+    det = _pmul(E[:,0,0], _pmul(E[:,1,1], E[:,2,2]) - _pmul(E[:,1,2], E[:,2,1])) - \
+        _pmul(E[:,0,1], _pmul(E[:,1,0], E[:,2,2]) - _pmul(E[:,1,2], E[:,2,0])) + \
+        _pmul(E[:,0,2], _pmul(E[:,1,0], E[:,2,1]) - _pmul(E[:,1,1], E[:,2,0]))
+    A = np.concatenate([cons.reshape(H, 9, -1), det[:,np.newaxis]], axis=1)
+
+    # Eliminate the cubic monomials, skipping degenerate samples
+    A3, A2 = A[:,:,:10], A[:,:,10:]
+    ok = np.abs(np.linalg.det(A3)) > 1e-15
+    A3[~ok] = np.eye(10)
+    B = np.linalg.solve(A3, A2)
+
+    # Action matrix for multiplication by x on the basis
+    # [x2, xy, xz, y2, yz, z2, x, y, z, 1]
+    M = np.zeros((H, 10, 10))
+    M[:,:6] = -B[:,:6]
+    M[:,6,0] = M[:,7,1] = M[:,8,2] = M[:,9,6] = 1
+    w, V = np.linalg.eig(M)
+
+    # Real solutions (eigenvectors, normalized by the constant monomial)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        real = (np.abs(w.imag) < 1e-8) & (np.abs(V[:,9].real) > 1e-12) & ok[:,np.newaxis]
+    hyp, k = np.where(real)
+    v = V.real[hyp, :, k]
+    xyz = v[:,6:9] / v[:,9:10]
+    Es = np.einsum('mk,mkij->mij', np.c_[xyz, np.ones(len(xyz))], N[hyp].reshape(-1, 4, 3, 3))
+    return Es, hyp
+
+def pnp_dlt(X, x):
+    """
+    Batched linear PnP (DLT) for [H x n x 3] world points and their
+    normalized [H x n x 2] projections (n >= 6) -> R [H x 3 x 3], t [H x 3]
+    (world-to-camera)
+    """
+    Xh = np.concatenate([X, np.ones(X.shape[:-1] + (1,))], axis=-1)
+    Z = np.zeros_like(Xh)
+    rows_u = np.concatenate([Xh, Z, -x[...,0:1] * Xh], axis=-1)
+    rows_v = np.concatenate([Z, Xh, -x[...,1:2] * Xh], axis=-1)
+    A = np.concatenate([rows_u, rows_v], axis=-2)
+    P = _null_space(A)[...,0,:].reshape(X.shape[:-2] + (3,4))
+
+    # Fix sign (positive depth at the centroid), and orthogonalize R
+    depth = np.einsum('...j,...j->...', P[...,2,:], Xh.mean(axis=-2))
+    P *= np.sign(depth)[...,np.newaxis,np.newaxis]
+    U, S, Vt = np.linalg.svd(P[...,:3])
+    R = np.matmul(U, Vt)
+    d = np.sign(np.linalg.det(R))
+    R *= d[...,np.newaxis,np.newaxis]
+    t = P[...,3] / (S.mean(axis=-1) * d)[...,np.newaxis]
+    return R, t
+
+def _absolute_orientation(X, P): 
+    """
+    Batched rigid alignment (Kabsch) of [..., n, 3] world points X onto
+    camera-frame points P -> R [..., 3, 3], t [..., 3] with P = R X + t
+    """
+    cx, cp = X.mean(axis=-2), P.mean(axis=-2)
+    C = np.matmul(np.swapaxes(P - cp[...,np.newaxis,:], -1, -2), X - cx[...,np.newaxis,:])
+    U, _, Vt = np.linalg.svd(C)
+    d = np.sign(np.linalg.det(np.matmul(U, Vt)))
+    U[...,:,2] *= d[...,np.newaxis]
+    R = np.matmul(U, Vt)
+    return R, cp - np.einsum('...ij,...j->...i', R, cx)
+
+def p3p(X, x): 
+    """
+    Batched P3P (Grunert's solution, see Haralick et al. [1]) for [H x 3 x 3] 
+    world points and their normalized [H x 3 x 2] projections -> up to 4 
+    solutions per sample, as (R [M x 3 x 3], t [M x 3], [M] sample indices)
+    (world-to-camera)
+
+    [1] R. Haralick, C. Lee, K. Ottenberg, M. Nolle, Review and analysis of 
+    solutions of the three point perspective pose estimation problem, IJCV 1994
+    """
+    f = np.concatenate([x, np.ones(x.shape[:-1] + (1,))], axis=-1)
+    f /= np.linalg.norm(f, axis=-1)[...,np.newaxis]
+    ca = (f[:,1] * f[:,2]).sum(axis=1)
+    cb = (f[:,0] * f[:,2]).sum(axis=1)
+    cg = (f[:,0] * f[:,1]).sum(axis=1)
+    a2 = ((X[:,1] - X[:,2]) ** 2).sum(axis=1)
+    b2 = ((X[:,0] - X[:,2]) ** 2).sum(axis=1)
+    c2 = ((X[:,0] - X[:,1]) ** 2).sum(axis=1)
+
+    # Quartic in v = s3 / s1
+    with np.errstate(divide='ignore', invalid='ignore'): 
+        p, q, r = (a2 - c2) / b2, (a2 + c2) / b2, c2 / b2
+        coeffs = np.vstack([
+            (p - 1) ** 2 - 4 * r * ca ** 2, 
+            4 * (p * (1 - p) * cb - (1 - q) * ca * cg + 2 * r * ca ** 2 * cb), 
+            2 * (p ** 2 - 1 + 2 * p ** 2 * cb ** 2 + 2 * (b2 - c2) / b2 * ca ** 2 - 
+                 4 * q * ca * cb * cg + 2 * (b2 - a2) / b2 * cg ** 2), 
+            4 * (-p * (1 + p) * cb + 2 * a2 / b2 * cg ** 2 * cb - (1 - q) * ca * cg), 
+            (1 + p) ** 2 - 4 * a2 / b2 * cg ** 2]).T
+
+    # Roots via companion matrices [H x 4 x 4]
+    valid = np.isfinite(coeffs).all(axis=1)
+    valid[valid] = np.abs(coeffs[valid,0]) > 1e-12 * np.abs(coeffs[valid]).max(axis=1)
+    c = np.where(valid[:,np.newaxis], coeffs, [1., 0, 0, 0, 0])
+    c = c / c[:,:1]
+    C = np.zeros((len(c), 4, 4))
+    C[:,0] = -c[:,1:]
+    C[:,1,0] = C[:,2,1] = C[:,3,2] = 1
+    roots = np.linalg.eigvals(C)
+    real = (np.abs(roots.imag) < 1e-6 * np.maximum(1, np.abs(roots.real))) & valid[:,np.newaxis]
+    hyp, k = np.where(real)
+    v = roots.real[hyp, k]
+
+    # Distances along the rays, and the camera-frame points
+    p, ca, cb, cg, a2 = p[hyp], ca[hyp], cb[hyp], cg[hyp], a2[hyp]
+    with np.errstate(divide='ignore', invalid='ignore'): 
+        u = ((p - 1) * v ** 2 - 2 * p * cb * v + 1 + p) / (2 * (cg - v * ca))
+        s1 = np.sqrt(a2 / (u ** 2 + v ** 2 - 2 * u * v * ca))
+    ok = np.isfinite(s1) & (u > 0) & (v > 0)
+    hyp, s = hyp[ok], np.stack([s1, u * s1, v * s1], axis=1)[ok]
+    P = f[hyp] * s[...,np.newaxis]
+    R, t = _absolute_orientation(X[hyp], P)
+    return R, t, hyp
+
+class FundamentalSolver(object):
+    """
+    Fundamental matrix (x2^T F x1 = 0) from pixel correspondences, with
+    the 8-point or 7-point minimal solver, scored by the Sampson error
+    """
+    def __init__(self, method='8point'):
+        if method not in ('8point', '7point'):
+            raise ValueError('Unknown fundamental solver {:}, use 8point or 7point'.format(method))
+        self.method_ = method
+        self.sample_size = 8 if method == '8point' else 7
+
+    def prepare(self, x1, x2):
+        self.T1_, self.T2_ = _normalization(x1), _normalization(x2)
+        self.x1_, self.x2_ = x1, x2
+        self.n1_, self.n2_ = _transform(self.T1_, x1), _transform(self.T2_, x2)
+        return len(x1)
+
+    def _denormalize(self, F):
+        F = np.matmul(np.matmul(self.T2_.T, F), self.T1_)
+        return F / np.linalg.norm(F.reshape(-1,9), axis=1).reshape(-1,1,1)
+
+    def fit(self, samples):
+        x1, x2 = self.n1_[samples], self.n2_[samples]
+        if self.method_ == '8point':
+            return self._denormalize(eight_point(x1, x2))
+        return self._denormalize(seven_point(x1, x2)[0])
+
+    def residuals(self, models):
+        return sampson_error(models, self.x1_, self.x2_)
+
+    def refine(self, inliers):
+        if inliers.sum() < 8:
+            return None
+        inds, = np.where(inliers)
+        return self._denormalize(eight_point(self.n1_[inds][np.newaxis], self.n2_[inds][np.newaxis]))[0]
+
+class EssentialSolver(FundamentalSolver):
+    """
+    Essential matrix (x2^T E x1 = 0) from normalized correspondences,
+    with the 5-point minimal solver, scored by the Sampson error
+    """
+    def __init__(self):
+        self.sample_size = 5
+
+    def prepare(self, x1, x2):
+        self.x1_, self.x2_ = x1, x2
+        return len(x1)
+
+    def fit(self, samples):
+        return five_point(self.x1_[samples], self.x2_[samples])[0]
+
+    def refine(self, inliers):
+        if inliers.sum() < 8:
+            return None
+        inds, = np.where(inliers)
+        E = _null_space(_epipolar_rows(self.x1_[inds], self.x2_[inds]))[0].reshape(3,3)
+        return _essential_manifold(E)
+
+class PnPSolver(object):
+    """
+    Camera pose (world-to-camera [R | t]) from 3D-2D correspondences in
+    normalized coordinates, with the P3P minimal solver (refined with
+    the linear 6-point solver), scored by the squared reprojection error
+    """
+    sample_size = 3
+
+    def prepare(self, X, x):
+        self.X_, self.x_ = X, x
+        return len(X)
+
+    def _pose(self, R, t):
+        return np.concatenate([R, t[...,np.newaxis]], axis=-1)
+
+    def fit(self, samples):
+        R, t, _ = p3p(self.X_[samples], self.x_[samples])
+        return self._pose(R, t)
+
+    def residuals(self, models):
+        Xc = np.matmul(models[:,:,:3], self.X_.T) + models[:,:,3:]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            err = ((Xc[:,:2] / Xc[:,2:3] - self.x_.T[np.newaxis]) ** 2).sum(axis=1)
+        return np.where(Xc[:,2] > 0, err, np.inf)
+
+    def refine(self, inliers):
+        if inliers.sum() < 6:
+            return None
+        inds, = np.where(inliers)
+        return self._pose(*pnp_dlt(self.X_[inds], self.x_[inds]))
+
+class RANSAC(object):
+    """
+    RANSAC over batches of minimal samples: each batch of hypotheses is
+    scored against all data in a single [H x N] residual tensor.
+
+        solver:         One of FundamentalSolver, EssentialSolver, PnPSolver
+        threshold:      Inlier threshold on the (non-squared) residual
+        confidence:     Confidence for the adaptive iteration count
+        max_iters:      Maximum number of minimal samples
+        batch_size:     Minimal samples per batch
+        seed:           Seed for deterministic sampling
+
+    Per-stage timings (ms) of the latest estimate are available
+    via the `timings` property. Only non-degenerate minimal samples 
+    count as iterations.
+    """
+    def __init__(self, solver, threshold=1.0, confidence=0.999,
+                 max_iters=1000, batch_size=64, seed=None):
+        self.solver_ = solver
+        self.threshold_ = threshold
+        self.confidence_ = confidence
+        self.max_iters_ = max_iters
+        self.batch_size_ = batch_size
+        self.seed_ = seed
+        self.timings_ = OrderedDict()
+
+    def _stage(self, name, start):
+        now = time.time()
+        self.timings_[name] = self.timings_.get(name, 0.) + (now - start) * 1e3
+        return now
+
+    def _sample(self, rng, N, n):
+        """ Batch of n minimal samples without repetition [n x s] """
+        s = self.solver_.sample_size
+        samples = rng.randint(N, size=(n, s))
+        srt = np.sort(samples, axis=1)
+        return samples[(srt[:,1:] != srt[:,:-1]).all(axis=1)]
+
+    def _required_iters(self, ninliers, N):
+        w = float(ninliers) / N
+        p = w ** self.solver_.sample_size
+        if p <= 0:
+            return self.max_iters_
+        if p >= 1:
+            return 0
+        return int(np.ceil(np.log(1 - self.confidence_) / np.log(1 - p)))
+
+    def estimate(self, *data):
+        """
+        Returns AttrDict(model, inliers, iters, hypotheses, timings)
+        (model is None if no consensus is found), where iters is the 
+        number of minimal samples solved, and hypotheses the number
+        of models scored
+        """
+        self.timings_ = OrderedDict()
+        start = t = time.time()
+        rng = np.random.RandomState(self.seed_)
+        thresh = self.threshold_ ** 2
+
+        N = self.solver_.prepare(*data)
+        if N < self.solver_.sample_size:
+            raise ValueError('{:} requires at least {:} points, provided {:}'
+                             .format(self.solver_.__class__.__name__, self.solver_.sample_size, N))
+        t = self._stage('prepare', t)
+
+        best, best_inliers, best_count = None, np.zeros(N, dtype=np.bool), 0
+        drawn, iters, hypotheses, required = 0, 0, 0, self.max_iters_
+        while drawn < self.max_iters_ and iters < required:
+            n = min(self.batch_size_, self.max_iters_ - drawn)
+            samples = self._sample(rng, N, n)
+            drawn += n
+            iters += len(samples)
+            t = self._stage('sample', t)
+
+            if not len(samples):
+                continue
+            models = self.solver_.fit(samples)
+            hypotheses += len(models)
+            t = self._stage('solve', t)
+            if not len(models):
+                continue
+
+            # Score all hypotheses x all data
+            with np.errstate(invalid='ignore'):
+                inliers = self.solver_.residuals(models) < thresh
+            counts = inliers.sum(axis=1)
+            idx = np.argmax(counts)
+            if counts[idx] > best_count:
+                best, best_inliers, best_count = models[idx], inliers[idx], counts[idx]
+                required = self._required_iters(best_count, N)
+            t = self._stage('score', t)
+
+        # Refine with all inliers, and re-evaluate the consensus
+        if best is not None:
+            refined = self.solver_.refine(best_inliers)
+            if refined is not None:
+                with np.errstate(invalid='ignore'):
+                    inliers = self.solver_.residuals(refined[np.newaxis])[0] < thresh
+                if inliers.sum() >= best_count:
+                    best, best_inliers = refined, inliers
+            t = self._stage('refine', t)
+
+        self._stage('total', start)
+        return AttrDict(model=best, inliers=best_inliers, iters=iters, 
+                        hypotheses=hypotheses, timings=self.timings_)
+
+    @property
+    def timings(self):
+        return self.timings_
+
+def _normalize_pixels(pts, K):
+    K = np.asarray(K, dtype=np.float64)
+    y = (pts[:,1] - K[1,2]) / K[1,1]
+    return np.vstack([(pts[:,0] - K[0,2] - K[0,1] * y) / K[0,0], y]).T
+
+def find_fundamental(pts1, pts2, method='8point', threshold=1.0, **kwargs):
+    """
+    Robust fundamental matrix (x2^T F x1 = 0) between [N x 2] pixel
+    correspondences, see RANSAC for kwargs
+    """
+    ransac = RANSAC(FundamentalSolver(method=method), threshold=threshold, **kwargs)
+    return ransac.estimate(np.float64(pts1).reshape(-1,2), np.float64(pts2).reshape(-1,2))
+
+def find_essential(pts1, pts2, K, threshold=1.0, **kwargs):
+    """
+    Robust essential matrix (x2^T E x1 = 0) between [N x 2] pixel
+    correspondences of a camera with intrinsics K (threshold in pixels),
+    see RANSAC for kwargs
+    """
+    K = np.asarray(K, dtype=np.float64)
+    ransac = RANSAC(EssentialSolver(), threshold=threshold / np.sqrt(K[0,0] * K[1,1]), **kwargs)
+    return ransac.estimate(_normalize_pixels(np.float64(pts1).reshape(-1,2), K),
+                           _normalize_pixels(np.float64(pts2).reshape(-1,2), K))
+
+def solve_pnp(X, pts, K, threshold=2.0, **kwargs):
+    """
+    Robust camera pose (world-to-camera [3 x 4] [R | t]) from [N x 3]
+    world points and their [N x 2] pixel projections with intrinsics K
+    (threshold in pixels), see RANSAC for kwargs
+    """
+    K = np.asarray(K, dtype=np.float64)
+    ransac = RANSAC(PnPSolver(), threshold=threshold / np.sqrt(K[0,0] * K[1,1]), **kwargs)
+    return ransac.estimate(np.float64(X).reshape(-1,3), _normalize_pixels(np.float64(pts).reshape(-1,2), K))
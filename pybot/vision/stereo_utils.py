@@ -1,10 +1,13 @@
 # Author: Sudeep Pillai <spillai@csail.mit.edu>
 # License: MIT
 
+import os
 import time
+import hashlib
 import cv2
 import numpy as np
 from collections import deque
+from multiprocessing.pool import ThreadPool
 from scipy.interpolate import LinearNDInterpolator
 
 from pybot.utils.timer import timeitmethod
@@ -98,24 +101,290 @@ class StereoBM:
 
 
 
+def _roundup16(v): 
+    return int(np.ceil(v / 16.0)) * 16
+
+class TiledStereo(object): 
+    """
+    Tiled stereo matching: splits the rectified pair into horizontal 
+    bands (with overlapping rows for the matching window/smoothness 
+    context), matches the bands concurrently and stitches the disparities. 
+
+    Optionally (coarse_to_fine), a downscaled pass restricts the 
+    disparity search range [minDisparity, minDisparity + numDisparities)
+    of each band (SGBM parameters only). 
+
+        stereo_cls:     StereoSGBM or StereoBM (or any class with 
+                        __init__(params) and compute(left, right))
+        bands:          Number of horizontal bands
+        overlap:        Overlapping rows on either side of a band
+        workers:        Number of threads (defaults to bands), the pool 
+                        is created on demand and released with close()
+    """
+    def __init__(self, stereo_cls=StereoSGBM, params=None, bands=4, overlap=16, workers=None, 
+                 coarse_to_fine=False, coarse_scale=0.5, coarse_margin=8): 
+        self.stereo_cls_ = stereo_cls
+        self.params_ = dict(params if params is not None else stereo_cls.default_params)
+        self.bands_ = bands
+        self.overlap_ = overlap
+        self.coarse_to_fine_ = coarse_to_fine
+        self.coarse_scale_ = coarse_scale
+        self.coarse_margin_ = coarse_margin
+        self.workers_ = workers if workers is not None else bands
+        self.pool_ = None
+
+        if coarse_to_fine and 'numDisparities' not in self.params_: 
+            raise ValueError('coarse_to_fine requires minDisparity/numDisparities params')
+
+        # Per-band matchers (matchers keep internal buffers, and are not shared across threads)
+        self.matchers_ = [stereo_cls(params=self.params_) for _ in range(bands)]
+
+        # Re-map process
+        self.process = self.compute
+
+    def _band_ranges(self, H): 
+        edges = np.linspace(0, H, self.bands_ + 1).astype(np.int32)
+        return [(y0, y1, max(0, y0 - self.overlap_), min(H, y1 + self.overlap_))
+                for y0, y1 in zip(edges[:-1], edges[1:])]
+
+    def _coarse_params(self, disp, ranges): 
+        """
+        Determine the per-band disparity search range from the coarse disparity
+        """
+        min_disp = self.params_.get('minDisparity', 0)
+        num_disp = self.params_['numDisparities']
+        params = []
+        for (y0, y1, _, _) in ranges: 
+            d = disp[y0:y1]
+            d = d[d >= min_disp]
+            if not len(d): 
+                params.append(self.params_)
+                continue
+            dmin = max(min_disp, int(np.floor(d.min())) - self.coarse_margin_)
+            dmax = min(min_disp + num_disp, int(np.ceil(d.max())) + self.coarse_margin_)
+            params.append(dict(self.params_, minDisparity=dmin, 
+                               numDisparities=max(16, _roundup16(dmax - dmin))))
+        return params
+
+    def coarse(self, left, right): 
+        """
+        Coarse disparity (at full resolution scale) from a downscaled pass
+        """
+        s = self.coarse_scale_
+        num_disp = self.params_['numDisparities']
+        params = dict(self.params_, minDisparity=int(np.floor(self.params_.get('minDisparity', 0) * s)), 
+                      numDisparities=max(16, _roundup16(num_disp * s)))
+        l, r = [cv2.resize(im, None, fx=s, fy=s, interpolation=cv2.INTER_AREA) for im in (left, right)]
+        disp = self.stereo_cls_(params=params).compute(l, r)
+        disp = cv2.resize(disp, (left.shape[1], left.shape[0]), interpolation=cv2.INTER_NEAREST)
+        return disp / s
+
+    def compute(self, left, right): 
+        H = left.shape[0]
+        ranges = self._band_ranges(H)
+
+        # Band matchers (restricted search range, if coarse-to-fine)
+        min_disp = self.params_.get('minDisparity', 0)
+        if self.coarse_to_fine_: 
+            band_params = self._coarse_params(self.coarse(left, right), ranges)
+            matchers = [self.stereo_cls_(params=params) for params in band_params]
+            band_min_disp = [params['minDisparity'] for params in band_params]
+        else: 
+            matchers = self.matchers_
+            band_min_disp = [min_disp] * len(ranges)
+
+        def match(args): 
+            matcher, bmin, (y0, y1, py0, py1) = args
+            disp = matcher.compute(left[py0:py1], right[py0:py1])[y0-py0:y1-py0]
+
+            # Invalid disparities are reported as (minDisparity-1) of the band
+            if bmin != min_disp: 
+                disp[disp < bmin] = min_disp - 1
+            return disp
+
+        if self.pool_ is None: 
+            self.pool_ = ThreadPool(self.workers_)
+        return np.vstack(self.pool_.map(match, zip(matchers, band_min_disp, ranges)))
+
+    def close(self): 
+        """ Terminate the thread pool (re-created on demand) """
+        if self.pool_ is not None: 
+            self.pool_.terminate()
+            self.pool_.join()
+            self.pool_ = None
+
+    def __del__(self): 
+        self.close()
+
+def sparse_stereo_match(left, right, pts, min_disparity=0, num_disparities=128, 
+                        patch_size=7, uniqueness_ratio=10, subpixel=True, zero_mean=False, 
+                        chunk_size=256): 
+    """
+    Sparse stereo matching at left-image points (e.g. OpenCVKLT.latest_pts) 
+    on a rectified pair: search along the same row in the right image, over
+    [min_disparity, min_disparity + num_disparities), using a 
+    patch_size x patch_size SAD cost (optionally zero-mean, odd patch_size). Cost scales
+    with the number of points, and not the image size. 
+
+        uniqueness_ratio:   Margin (in %) by which the best cost must beat
+                            the next best (non-adjacent) disparity
+        subpixel:           Parabolic sub-pixel refinement
+
+    Returns: 
+       xyd: [N x 3] (x, y, disparity) for StereoCamera.reconstruct_sparse 
+            (disparity is NaN for invalid matches)
+       valid: [N] mask of valid matches
+    """
+    if patch_size < 1 or patch_size % 2 == 0: 
+        raise ValueError('patch_size needs to be a positive odd number, provided {:}'.format(patch_size))
+
+    left, right = to_gray(left), to_gray(right)
+    H, W = left.shape[:2]
+    pts = np.asarray(pts, dtype=np.float32).reshape(-1,2)
+    N, D, r = len(pts), num_disparities, patch_size // 2
+    disps = min_disparity + np.arange(D)
+    offs = np.arange(-r, r+1)
+
+    d = np.full(N, np.nan, dtype=np.float32)
+    valid = np.zeros(N, dtype=np.bool)
+    for i0 in range(0, N, chunk_size): 
+        xy = np.round(pts[i0:i0+chunk_size]).astype(np.int64)
+        x, y = xy[:,0], xy[:,1]
+
+        # Left patches [n x p x p], and right row strips [n x p x (D+p-1)] 
+        # covering disparities (max -> min)
+        rows = np.clip(y[:,np.newaxis] + offs, 0, H-1)
+        lcols = np.clip(x[:,np.newaxis] + offs, 0, W-1)
+        rcols = np.clip(x[:,np.newaxis] - disps[-1] - r + np.arange(D + 2*r), 0, W-1)
+        P = left[rows[:,:,np.newaxis], lcols[:,np.newaxis,:]].astype(np.int32)
+        S = right[rows[:,:,np.newaxis], rcols[:,np.newaxis,:]].astype(np.int32)
+        if zero_mean: 
+            P -= P.sum(axis=(1,2), keepdims=True) // (patch_size * patch_size)
+
+        # Sliding windows over the strip [n x p x D x p], reversed so that 
+        # index j corresponds to disparity min_disparity + j
+        n, p = len(x), patch_size
+        windows = np.lib.stride_tricks.as_strided(
+            S, shape=(n, p, D, p), strides=(S.strides[0], S.strides[1], S.strides[2], S.strides[2]))
+        if zero_mean: 
+            windows = windows - windows.sum(axis=(1,3), keepdims=True) // (p * p)
+        cost = np.abs(windows - P[:,:,np.newaxis,:]).sum(axis=(1,3))[:,::-1].astype(np.float32)
+
+        # Disparities whose right patch falls outside the image
+        xr = x[:,np.newaxis] - disps
+        cost[(xr - r < 0) | (xr + r > W-1)] = np.inf
+
+        # Best, and next best (non-adjacent) disparity
+        best = np.argmin(cost, axis=1)
+        ar = np.arange(n)
+        cbest = cost[ar, best]
+        masked = cost.copy()
+        for k in (-1, 0, 1): 
+            masked[ar, np.clip(best + k, 0, D-1)] = np.inf
+        csecond = masked.min(axis=1)
+
+        ok = (x >= r) & (x < W-r) & (y >= r) & (y < H-r) & np.isfinite(cbest) & \
+             (cbest * (100 + uniqueness_ratio) < 100 * csecond)
+
+        # Sub-pixel refinement
+        db = best.astype(np.float32)
+        if subpixel: 
+            inner = (best > 0) & (best < D-1)
+            cl = cost[ar, np.clip(best-1, 0, D-1)]
+            cr = cost[ar, np.clip(best+1, 0, D-1)]
+            with np.errstate(invalid='ignore', divide='ignore'): 
+                denom = cl - 2 * cbest + cr
+                refine = inner & np.isfinite(cl) & np.isfinite(cr) & (denom > 0)
+                db[refine] += (0.5 * (cl - cr) / denom)[refine]
+
+        d[i0:i0+n] = np.where(ok, min_disparity + db, np.nan)
+        valid[i0:i0+n] = ok
+
+    return np.hstack([pts, d[:,np.newaxis]]), valid
+
+# In-memory cache of rectification maps, keyed by calibration hash
+_rectification_maps = {}
+
+def rectification_maps(cam, cache_dir=None, nearest=False): 
+    """
+    Returns the fixed-point (CV_16SC2, CV_16UC1) rectification maps for 
+    the camera. Maps are cached in memory, and optionally on disk in 
+    cache_dir (keyed by the hash of K, D, R, P and image size). 
+
+    For nearest-neighbor remapping, map1 holds the rounded 
+    coordinates and map2 is empty.
+    """
+    H, W = cam.shape[:2]
+    key = hashlib.sha1(b''.join(np.float64(v).tobytes() 
+                                for v in [cam.K, cam.D, cam.R, cam.P, [W, H, nearest]])).hexdigest()
+    if key in _rectification_maps: 
+        return _rectification_maps[key]
+
+    fn = os.path.join(os.path.expanduser(cache_dir), 'rectify_{:}.npz'.format(key)) \
+         if cache_dir is not None else None
+    if fn is not None and os.path.exists(fn): 
+        db = np.load(fn)
+        maps = (db['map1'], db['map2'])
+    else: 
+        mapx, mapy = cv2.initUndistortRectifyMap(cam.K, cam.D, cam.R, cam.P, (int(W), int(H)), cv2.CV_32FC1)
+        map1, map2 = cv2.convertMaps(mapx, mapy, cv2.CV_16SC2, nninterpolation=nearest)
+        maps = (map1, map2 if map2 is not None else np.empty(0, dtype=np.uint16))
+        if fn is not None: 
+            if not os.path.exists(os.path.dirname(fn)): 
+                os.makedirs(os.path.dirname(fn))
+            # Write atomically, so that concurrent readers never see partial maps
+            tmp_fn = '{:}.{:}.tmp.npz'.format(fn[:-4], os.getpid())
+            np.savez(tmp_fn, map1=maps[0], map2=maps[1])
+            os.rename(tmp_fn, fn)
+
+    _rectification_maps[key] = maps
+    return maps
+
 class CalibratedStereo(object): 
-    def __init__(self, left, right):
-        self.cams = [left, right]
-        self.undistortion_map = {}
-        self.rectification_map = {}
-        
-        for cidx, cam in enumerate(self.cams):
-            (self.undistortion_map[cidx], self.rectification_map[cidx]) = cv2.initUndistortRectifyMap(
-                cam.K, cam.D, cam.R, cam.P, cam.shape[:2], cv2.CV_32FC1)
+    """
+    Rectify stereo frames with fixed-point rectification maps, that are 
+    cached across instances (in memory, and on disk if cache_dir is set, 
+    e.g. CalibratedStereo.default_cache_dir). 
+    Left and right frames are remapped concurrently.
+    """
+    default_cache_dir = '~/.pybot/cache/rectify'
+
+    def __init__(self, left, right, scale=1.0, cache_dir=None, 
+                 interpolation=cv2.INTER_NEAREST):
+        self.cams = [left, right] if scale == 1.0 else [left.scaled(scale), right.scaled(scale)]
+        self.interpolation = interpolation
+        self.pool_ = None
+        self.maps = [rectification_maps(cam, cache_dir=cache_dir, 
+                                        nearest=(interpolation == cv2.INTER_NEAREST))
+                     for cam in self.cams]
+
+    @staticmethod
+    def _remap(args): 
+        im, (map1, map2), interpolation = args
+        return cv2.remap(im, map1, map2 if map2.size else None, interpolation)
 
     def rectify(self, l, r): 
         """
         Rectify frames passed as (left, right) 
-        Remapping is done with nearest neighbor for speed.
+        Remapping is done with nearest neighbor for speed (by default).
         """
-        return [cv2.remap(l, self.undistortion_map[cidx], self.rectification_map[cidx], cv2.INTER_NEAREST)
-                for cidx in range(len(self.cams))]
-        
+        if self.pool_ is None: 
+            self.pool_ = ThreadPool(len(self.cams))
+
+        # Tasks do not reference self, so that the last reference (and 
+        # __del__) is never dropped from within a pool thread
+        return self.pool_.map(CalibratedStereo._remap, 
+                              zip([l, r], self.maps, [self.interpolation] * 2))
+
+    def close(self): 
+        """ Terminate the thread pool (re-created on demand) """
+        if self.pool_ is not None: 
+            self.pool_.terminate()
+            self.pool_.join()
+            self.pool_ = None
+
+    def __del__(self): 
+        self.close()
 
 class CalibratedFastStereo(object): 
     """
@@ -291,3 +560,47 @@ def setup_ps3eye_dataset(filename, start_idx=0, max_length=None, every_k_frames=
 #     baseline = 0.120018 
 #     return get_calib_params(fx, fy, cx, cy, baseline=baseline)
 
+
+if __name__ == "__main__": 
+    import argparse
+    from pybot.utils.dataset.kitti import KITTIDatasetReader
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark tiled stereo matching against a single full-frame call')
+    parser.add_argument(
+        '-d', '--directory', type=str, required=True, 
+        help="KITTI odometry dataset directory")
+    parser.add_argument(
+        '-s', '--sequence', type=str, default='00', 
+        help="KITTI sequence")
+    parser.add_argument(
+        '-n', '--num-frames', type=int, default=50, 
+        help="Number of stereo pairs")
+    parser.add_argument(
+        '-b', '--bands', type=int, default=4, 
+        help="Number of horizontal bands")
+    args = parser.parse_args()
+
+    dataset = KITTIDatasetReader(directory=args.directory, sequence=args.sequence, 
+                                 max_files=args.num_frames)
+    pairs = [(to_gray(l), to_gray(r)) for (l, r) in dataset.iter_stereo_frames()]
+
+    engines = [('single', StereoSGBM()), 
+               ('tiled', TiledStereo(bands=args.bands)), 
+               ('tiled-c2f', TiledStereo(bands=args.bands, coarse_to_fine=True))]
+
+    # Accuracy is reported w.r.t. the single full-frame call: fraction of pixels 
+    # valid in both, with absolute disparity error > 1px / 3px
+    ref = None
+    for name, engine in engines: 
+        st = time.time()
+        disps = [engine.compute(l, r) for (l, r) in pairs]
+        fps = len(pairs) / (time.time() - st)
+        if ref is None: 
+            ref = disps
+        valid = np.concatenate([((d0 >= 0) & (d1 >= 0)).ravel() for d0, d1 in zip(ref, disps)])
+        err = np.concatenate([np.fabs(d0 - d1).ravel() for d0, d1 in zip(ref, disps)])[valid]
+        print('{:10s}: {:5.1f} fps, >1px: {:5.2f} %, >3px: {:5.2f} %, valid: {:5.2f} %'
+              .format(name, fps, (err > 1).mean() * 100, (err > 3).mean() * 100, valid.mean() * 100))
+        if isinstance(engine, TiledStereo): 
+            engine.close()
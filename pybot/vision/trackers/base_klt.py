@@ -21,10 +21,11 @@ between frames.
 # License: MIT
 
 import cv2
+import time
 import numpy as np
 
 from itertools import izip
-from collections import namedtuple, deque
+from collections import deque, OrderedDict
 
 from pybot.utils.db_utils import AttrDict
 from pybot.utils.timer import timeitmethod
@@ -37,7 +38,7 @@ from pybot.vision.draw_utils import draw_features, draw_lines
 
 from pybot.vision.trackers import FeatureDetector, OpticalFlowTracker, LKTracker
 from pybot.vision.trackers import finite_and_within_bounds, to_pts, \
-    TrackManager, FeatureDetector, OpticalFlowTracker, LKTracker
+    TrackManager, GridIndex, FeatureDetector, OpticalFlowTracker, LKTracker
 
 class BaseKLT(object): 
     """
@@ -53,7 +54,7 @@ class BaseKLT(object):
     default_detector_params = AttrDict(method='fast', grid=(12,10), max_corners=1200, 
                                        max_levels=4, subpixel=False, params=FeatureDetector.fast_params)
     default_tracker_params = AttrDict(method='lk', fb_check=True, 
-                                      params=OpticalFlowTracker.lk_params)
+                                      params=OpticalFlowTracker.lk_params, workers=1)
 
     default_detector = FeatureDetector(**default_detector_params)
     default_tracker = OpticalFlowTracker.create(**default_tracker_params)
@@ -73,6 +74,9 @@ class BaseKLT(object):
         self.min_tracks_ = min_tracks
         self.mask_size_ = mask_size
 
+        # Grid occupancy index over tracked points (created on first frame)
+        self.grid_ = None
+
     @classmethod
     def from_params(cls, detector_params=default_detector_params, 
                     tracker_params=default_tracker_params,
@@ -88,21 +92,35 @@ class BaseKLT(object):
     def register_on_track_delete_callback(self, cb): 
         self.tm_.register_on_track_delete_callback(cb)
 
+    def close(self): 
+        """ Release the tracker's resources (i.e. LK thread pool) """
+        self.tracker_.close()
+
+    def _grid(self, shape): 
+        if self.grid_ is None or self.grid_.shape != tuple(shape[:2]): 
+            self.grid_ = GridIndex(shape, cell_size=2 * self.mask_size_)
+        return self.grid_
+
+    def update_grid(self, shape): 
+        """
+        Update the grid occupancy index with the latest tracked points
+        """
+        grid = self._grid(shape)
+        grid.update(self.tm_.ids, self.tm_.pts)
+        return grid
+
     def create_mask(self, shape, pts): 
         """
         Create a mask image to prevent feature extraction around regions
         that already have features detected. i.e prevent feature crowding
+        (cells of size 2 x mask_size containing tracked, augmented or 
+        the provided features are masked out)
         """
-
-        mask = np.ones(shape=shape, dtype=np.uint8) * 255
-        all_pts = np.vstack([self.aug_pts_, pts]) if hasattr(self, 'aug_pts_') \
-                  else pts
-        try: 
-            for pt in all_pts: 
-                cv2.circle(mask, tuple(map(int, pt)), self.mask_size_, 0, -1, lineType=cv2.CV_AA)
-        except:
-            pass
-        return mask
+        all_pts = pts
+        if hasattr(self, 'aug_pts_'): 
+            all_pts = np.vstack([self.aug_pts_, pts]) if pts is not None and len(pts) \
+                      else self.aug_pts_
+        return self._grid(shape).mask(pts=all_pts)
 
     def augment_mask(self, pts): 
         """
@@ -158,16 +176,14 @@ class BaseKLT(object):
         return out
 
     def matches(self, index1=-2, index2=-1): 
-        tids, p1, p2 = [], [], []
-        for tid, pts in self.tm_.tracks.iteritems(): 
-            if len(pts) > abs(index1) and len(pts) > abs(index2): 
-                tids.append(tid)
-                p1.append(pts.items[index1])
-                p2.append(pts.items[index2]) 
-        try: 
-            return tids, np.vstack(p1), np.vstack(p2)
-        except: 
+        # Tracks (retained items) strictly longer than both history indices
+        p1, _ = self.tm_.items(index1)
+        p2, _ = self.tm_.items(index2)
+        lengths = np.minimum(self.tm_.lengths, self.tm_.maxlen)
+        valid = (lengths > abs(index1)) & (lengths > abs(index2))
+        if not valid.any():
             return np.array([]), np.array([]), np.array([])
+        return self.tm_.ids[valid], p1[valid], p2[valid]
 
     def process(self, im, detected_pts=None):
         raise NotImplementedError()
@@ -191,6 +207,9 @@ class OpenCVKLT(BaseKLT):
     """
     KLT Tracker as implemented in OpenCV 2.4.9
     Stripped from opencv/samples/python2/lk_track.py
+
+    Per-stage timings (ms) of the latest frame are available 
+    via the `timings` property
     """
     def __init__(self, *args, **kwargs):
         BaseKLT.__init__(self, *args, **kwargs)
@@ -198,54 +217,75 @@ class OpenCVKLT(BaseKLT):
         # OpenCV KLT
         self.ims_ = deque(maxlen=2)
         self.add_features_ = True
+        self.timings_ = OrderedDict()
 
     def reset(self): 
         self.add_features_ = True
 
+    def _stage(self, name, start): 
+        now = time.time()
+        self.timings_[name] = (now - start) * 1e3
+        return now
+
     def process(self, im, detected_pts=None):
+        self.timings_ = OrderedDict()
+        start = t = time.time()
 
-        # Preprocess
+        # Preprocess (the blurred frame is reused as im0 for the next frame)
         self.ims_.append(gaussian_blur(to_gray(im)))
+        t = self._stage('preprocess', t)
 
         # Track object
         pids, ppts = self.tm_.ids, self.tm_.pts
         if ppts is not None and len(ppts) and len(self.ims_) == 2: 
             pts = self.tracker_.track(self.ims_[-2], self.ims_[-1], ppts)
+            t = self._stage('track', t)
 
             # Check bounds
             valid = finite_and_within_bounds(pts, im.shape[:2])
             
             # Add pts and prune afterwards
             self.tm_.add(pts[valid], ids=pids[valid], prune=True)
+            t = self._stage('manage', t)
+
+        # Update grid occupancy with moved/removed tracks
+        grid = self.update_grid(im.shape[:2])
+        t = self._stage('grid', t)
 
         # Check if more features required
         self.add_features_ = self.add_features_ or ppts is None or (ppts is not None and len(ppts) < self.min_tracks_)
 
         # Initialize or add more features
         if self.add_features_: 
-            # Extract features
-            mask = self.create_mask(im.shape[:2], ppts)            
-            # imshow_cv('mask', mask)
+            # Detect only in free cells (unoccupied by tracked/augmented features)
+            aug_pts = getattr(self, 'aug_pts_', None)
 
             if detected_pts is None: 
 
                 # Detect features
-                new_kpts = self.detector_.process(self.ims_[-1], mask=mask, return_keypoints=True)
+                new_kpts = self.detector_.process(self.ims_[-1], cells=grid.free_cells(pts=aug_pts), 
+                                                  return_keypoints=True)
                 newlen = max(0, self.min_tracks_ - len(ppts))
                 new_pts = to_pts(sorted(new_kpts, key=lambda kpt: kpt.response, reverse=True)[:newlen])
             else: 
-                xy = detected_pts.astype(np.int32)
-                valid = mask[xy[:,1], xy[:,0]] > 0
+                valid = grid.free(detected_pts, extra_pts=aug_pts)
                 new_pts = detected_pts[valid]
 
             # Add detected features with new ids, and prevent pruning 
             self.tm_.add(new_pts, ids=None, prune=False)
             self.add_features_ = False
+            t = self._stage('detect', t)
+
+        self._stage('total', start)
 
         # Returns only tracks that have a minimum trajectory length
         # This is different from self.tm_.ids, self.tm_.pts
         return self.latest_ids, self.latest_pts
 
+    @property
+    def timings(self): 
+        return self.timings_
+
 class MeshKLT(OpenCVKLT): 
     """
     KLT Tracker as implemented in OpenCV 2.4.9
@@ -298,12 +338,12 @@ def inside_bboxes(pts, bboxes):
     Returns the set of points that are within each bbox
     B x N boolean mask where B bboxes, N pts    
     """
-    try: 
-        bboxes = bboxes.astype(np.float32)
-        return np.vstack([((pts[:,0] >= x1) & (pts[:,0] <= x2) & (pts[:,1] >= y1) & (pts[:,1] <= y2))
-                          for (x1, y1, x2, y2) in izip(bboxes[:,0], bboxes[:,1], bboxes[:,2], bboxes[:,3])])
-    except: 
+    if bboxes is None or not len(bboxes) or not len(pts): 
         return np.array([])
+    bboxes = np.asarray(bboxes, dtype=np.float32).reshape(-1,4)
+    x, y = pts[:,0], pts[:,1]
+    return (x >= bboxes[:,0,None]) & (x <= bboxes[:,2,None]) & \
+        (y >= bboxes[:,1,None]) & (y <= bboxes[:,3,None])
 
 class BoundingBoxKLT(OpenCVKLT): 
     """
@@ -325,8 +365,10 @@ class BoundingBoxKLT(OpenCVKLT):
         """
         OpenCVKLT.process(self, im, detected_pts=None)
 
-        # Degenerate case where no points are available to propagate
-        ids, pts, flow = self.latest_ids, self.latest_pts, self.latest_flow
+        # Index the newly detected features, and query the 
+        # tracked points (ordered by id) from the grid
+        grid = self.update_grid(im.shape[:2])
+        ids, pts = grid.ids, grid.pts
 
         # 1. Update hulls based on the newly tracked locations and 
         for hid in self.hulls_.keys(): 
@@ -347,7 +389,7 @@ class BoundingBoxKLT(OpenCVKLT):
             # the tracking is more prolonged
             vpts = pts[common_inds]
             vbox = get_bbox(vpts)
-            valid_pts = inside_bboxes(pts, [vbox])
+            valid_pts = grid.inside([vbox])
             vinds, = np.where(valid_pts.ravel())
             vids = ids[np.r_[common_inds, vinds]]
 
@@ -367,7 +409,7 @@ class BoundingBoxKLT(OpenCVKLT):
         #     newinds, = np.where(HB.max(axis=0) < 0.3)
         #     bboxes = bboxes[newinds]
 
-        valid_mask = inside_bboxes(pts, bboxes)
+        valid_mask = grid.inside(bboxes) if bboxes is not None and len(bboxes) else []
         for bidx, valid in enumerate(valid_mask):
             vids, vpts = ids[valid], pts[valid], 
             # vis = to_color(im)
@@ -0,0 +1,224 @@
+# Author: Sudeep Pillai <spillai@csail.mit.edu>
+# License: MIT
+
+import time
+import threading
+from collections import OrderedDict
+
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
+
+from pybot.utils.db_utils import AttrDict
+
+class StreamStats(object):
+    """
+    Per-stream processing statistics (latency in ms is measured from
+    submission to completion, and includes queueing delay)
+    """
+    def __init__(self):
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.latency_ = 0.
+        self.total_latency_ = 0.
+
+    def update(self, latency):
+        self.processed += 1
+        self.latency_ = latency * 1e3
+        self.total_latency_ += self.latency_
+
+    @property
+    def latency(self):
+        """ Latency of the most recently processed frame (ms) """
+        return self.latency_
+
+    @property
+    def mean_latency(self):
+        return self.total_latency_ / self.processed if self.processed else 0.
+
+    def __repr__(self):
+        return 'StreamStats(submitted={:}, processed={:}, dropped={:}, failed={:}, ' \
+            'latency={:.1f} ms, mean_latency={:.1f} ms)'.format(
+                self.submitted, self.processed, self.dropped, self.failed,
+                self.latency, self.mean_latency)
+
+class StreamError(RuntimeError):
+    """
+    Raised (in timestamp order) when a stream's tracker fails,
+    with the failing timestamp t, stream index and original error
+    """
+    def __init__(self, t, stream, error):
+        RuntimeError.__init__(self, 'Stream {:} failed at timestamp {:}: {:}'.format(
+            stream, t, repr(error)))
+        self.t = t
+        self.stream = stream
+        self.error = error
+
+class MultiStreamTracker(object):
+    """
+    Schedules frames across N independent tracker instances (e.g.
+    OpenCVKLT/BoundingBoxKLT per camera), each with a dedicated worker
+    thread so that streams are tracked concurrently (OpenCV releases
+    the GIL) while frames within a stream are processed in order.
+
+    Results are synchronized by timestamp: a timestamp is released once
+    every stream has either processed or dropped its frame. Completed
+    timestamps are buffered until they are returned, and a failed
+    timestamp raises a StreamError only after all earlier timestamps
+    have been returned.
+
+        trackers:       List of trackers implementing process(im)
+        max_pending:    Maximum number of queued frames per stream
+        drop:           Drop frames when a stream's queue is full
+                        (otherwise block on submit)
+
+    Usage:
+        mst = MultiStreamTracker([OpenCVKLT(), OpenCVKLT()])
+        for t, (left, right) in stereo_frames:
+            mst.submit(t, [left, right])   # kwargs=[dict(bboxes=...), ...]
+            for t, results in mst.results():
+                (lids, lpts), (rids, rpts) = results
+        mst.close()
+    """
+    def __init__(self, trackers, max_pending=2, drop=True):
+        self.trackers_ = list(trackers)
+        self.max_pending_ = max_pending
+        self.drop_ = drop
+
+        # Pending timestamps: {t: AttrDict(results, remaining)}
+        self.cond_ = threading.Condition()
+        self.pending_ = OrderedDict()
+        self.last_t_ = None
+        self.stats_ = [StreamStats() for _ in self.trackers_]
+
+        # Per-stream queue and worker
+        self.queues_ = [Queue(maxsize=max_pending) for _ in self.trackers_]
+        self.workers_ = []
+        for idx in range(len(self.trackers_)):
+            worker = threading.Thread(target=self._run, args=(idx,))
+            worker.daemon = True
+            worker.start()
+            self.workers_.append(worker)
+
+    def __len__(self):
+        return len(self.trackers_)
+
+    def _run(self, idx):
+        tracker, queue = self.trackers_[idx], self.queues_[idx]
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            t, im, kwargs, submitted = item
+            try:
+                res = tracker.process(im, **kwargs)
+            except Exception as e:
+                res = e
+            self._complete(idx, t, res, time.time() - submitted)
+
+    def _complete(self, idx, t, res, latency=None):
+        with self.cond_:
+            if latency is None:
+                self.stats_[idx].dropped += 1
+            elif isinstance(res, Exception):
+                self.stats_[idx].failed += 1
+            else:
+                self.stats_[idx].update(latency)
+            entry = self.pending_[t]
+            entry.results[idx] = res
+            entry.remaining -= 1
+            self.cond_.notify_all()
+
+    def submit(self, t, ims, kwargs=None):
+        """
+        Submit one frame per stream for timestamp t (timestamps must be
+        increasing). Streams with a None frame are skipped for this timestamp.
+
+            kwargs:     Optional per-stream keyword arguments for the
+                        tracker's process (e.g. [dict(bboxes=bboxes), None])
+        """
+        if len(ims) != len(self.trackers_):
+            raise ValueError('Expected {:} frames, provided {:}'.format(len(self.trackers_), len(ims)))
+        if kwargs is None:
+            kwargs = [None] * len(ims)
+        if len(kwargs) != len(ims):
+            raise ValueError('Expected {:} kwargs, provided {:}'.format(len(ims), len(kwargs)))
+
+        with self.cond_:
+            if self.last_t_ is not None and t <= self.last_t_:
+                raise ValueError('Timestamps need to be increasing, provided {:}'.format(t))
+            self.last_t_ = t
+            self.pending_[t] = AttrDict(results=[None] * len(ims),
+                                        remaining=sum(im is not None for im in ims))
+
+        now = time.time()
+        for idx, (im, kw) in enumerate(zip(ims, kwargs)):
+            if im is None:
+                continue
+            self.stats_[idx].submitted += 1
+            try:
+                self.queues_[idx].put((t, im, kw or {}, now), block=not self.drop_)
+            except Full:
+                self._complete(idx, t, None)
+
+    def _release(self, t):
+        """ Remove completed timestamp t, raising StreamError if a stream failed """
+        entry = self.pending_.pop(t)
+        for idx, res in enumerate(entry.results):
+            if isinstance(res, Exception):
+                raise StreamError(t, idx, res)
+        return entry.results
+
+    def results(self, block=False, timeout=None):
+        """
+        Returns the list of completed [(t, [result_1, ..., result_N]), ...] in
+        timestamp order, where result_i is the tracker output (e.g. (ids, pts))
+        or None if the frame was dropped. If block=True, waits for all
+        submitted timestamps to complete.
+
+        A failed timestamp is returned up to (excluding) itself, and
+        raises a StreamError on the next call.
+        """
+        out = []
+        with self.cond_:
+            while True:
+                while len(self.pending_):
+                    t, entry = next(iter(self.pending_.items()))
+                    if entry.remaining > 0:
+                        break
+                    if len(out) and any(isinstance(res, Exception) for res in entry.results):
+                        return out
+                    out.append((t, self._release(t)))
+                if not block or not len(self.pending_):
+                    break
+                self.cond_.wait(timeout)
+                if timeout is not None:
+                    block = False
+        return out
+
+    def process(self, t, ims, kwargs=None):
+        """
+        Synchronous variant of submit: blocks until timestamp t is
+        complete and returns its per-stream results (other completed
+        timestamps remain available via results())
+        """
+        self.submit(t, ims, kwargs=kwargs)
+        with self.cond_:
+            while self.pending_[t].remaining > 0:
+                self.cond_.wait()
+            return self._release(t)
+
+    def close(self):
+        """ Stop the stream workers (pending frames are processed first) """
+        for queue in self.queues_:
+            queue.put(None)
+        for worker in self.workers_:
+            worker.join()
+        self.workers_ = []
+
+    @property
+    def stats(self):
+        return self.stats_
@@ -2,8 +2,7 @@
 # License: MIT
 import cv2
 import numpy as np
-from copy import deepcopy
-from collections import defaultdict, deque
+from multiprocessing.pool import ThreadPool
 
 from pybot.utils.db_utils import AttrDict
 from pybot.utils.timer import timeitmethod
@@ -11,38 +10,55 @@ from pybot.utils.timer import timeitmethod
 from pybot.vision.feature_detection import to_kpt, to_kpts, to_pts, \
     finite_and_within_bounds
 
-class IndexedDeque(object): 
-    def __init__(self, maxlen=100): 
-        self.items_ = deque(maxlen=maxlen)
-        self.indices_ = deque(maxlen=maxlen)
-        self.length_ = 0
-
-    def append(self, index, item): 
-        self.indices_.append(index)
-        self.items_.append(item)
-        self.length_ += 1
+class TrackView(object): 
+    """
+    Light-weight view of a single track stored in a TrackManager ring 
+    buffer. Provides the item/index accessors of a deque-backed track.
+    Views reference the manager's buffers and remain valid only until
+    the underlying slot is reused (i.e. the next call to add). 
+    """
+    __slots__ = ['manager_', 'slot_']
+    def __init__(self, manager, slot): 
+        self.manager_ = manager
+        self.slot_ = slot
+
+    def _order(self): 
+        # Chronological ring positions of the retained items
+        maxlen = self.manager_.maxlen_
+        length = self.manager_.lengths_[self.slot_]
+        n = min(length, maxlen)
+        return (length - n + np.arange(n)) % maxlen
 
     def item(self, index): 
-        return self.items_[index]
+        return self.items[index]
 
     def index(self, index): 
-        return self.indices_[index]
+        return self.manager_.indices_[self.slot_, self._order()][index]
 
     def __len__(self): 
-        """ Returns the length of the deque """
-        return len(self.items_)
+        """ Returns the number of items retained in the ring buffer """
+        return min(self.manager_.lengths_[self.slot_], self.manager_.maxlen_)
 
     @property
     def latest_item(self):
-        return self.items_[-1]
+        m = self.manager_
+        return m.items_[self.slot_, (m.lengths_[self.slot_]-1) % m.maxlen_]
 
     @property
     def latest_index(self): 
-        return self.indices_[-1]
+        return self.manager_.last_seen_[self.slot_]
 
     @property
     def items(self): 
-        return self.items_
+        """ 
+        Returns the retained items in chronological order. This is a 
+        view into the ring buffer unless it has wrapped around.
+        """
+        m = self.manager_
+        length = m.lengths_[self.slot_]
+        if length <= m.maxlen_: 
+            return m.items_[self.slot_, :length]
+        return m.items_[self.slot_, self._order()]
 
     @property
     def length(self): 
@@ -51,12 +67,24 @@ class IndexedDeque(object):
         including deleted/popped items
         from the queue
         """
-        return self.length_
+        return self.manager_.lengths_[self.slot_]
 
 class TrackManager(object): 
-    def __init__(self, maxlen=20, on_delete_cb=lambda tracks: None): 
+    """
+    Ring-buffer track store. Track history is kept in a preallocated 
+    [max_tracks x maxlen x 2] array alongside per-slot id, length 
+    and last-seen vectors, so that add, prune and latest-point 
+    queries are vectorized over all tracks. 
+
+        maxlen:         Maximum track history retained per track
+        max_tracks:     Initial number of track slots (grown on demand)
+        on_delete_cb:   Called with {track_id: TrackView, ...} for 
+                        the tracks removed on prune
+    """
+    def __init__(self, maxlen=20, on_delete_cb=None, max_tracks=2048): 
         # Max track length 
         self.maxlen_ = maxlen
+        self.max_tracks_ = max_tracks
 
         # Register callbacks on track delete
         self.on_delete_cb_ = on_delete_cb
@@ -66,10 +94,46 @@ class TrackManager(object):
 
     def reset(self): 
         self.index_ = 0
-
-        # Tracks are a dictionary with {key: value, ... } as  
-        # {track_id : , IndexedDeque [(time_index, feature), ... ]
-        self.tracks_ = defaultdict(lambda: IndexedDeque(maxlen=self.maxlen_))
+        self.next_id_ = 0
+
+        # Slot buffers: items/indices are rings along axis 1, 
+        # ids_ = -1 denotes an unused slot
+        self.items_ = np.empty((self.max_tracks_, self.maxlen_, 2), dtype=np.float32)
+        self.indices_ = np.empty((self.max_tracks_, self.maxlen_), dtype=np.int64)
+        self.ids_ = np.full(self.max_tracks_, -1, dtype=np.int64)
+        self.lengths_ = np.zeros(self.max_tracks_, dtype=np.int64)
+        self.last_seen_ = np.full(self.max_tracks_, -1, dtype=np.int64)
+
+        # Active slots (sorted), and active ids in the same order
+        self.slots_ = np.empty(0, dtype=np.int64)
+
+    def _grow(self, capacity): 
+        """ Grow the slot buffers to at least the requested capacity """
+        n = self.max_tracks_
+        while n < capacity: 
+            n *= 2
+        pad = n - self.max_tracks_
+        self.items_ = np.concatenate([self.items_, np.empty((pad, self.maxlen_, 2), dtype=np.float32)])
+        self.indices_ = np.concatenate([self.indices_, np.empty((pad, self.maxlen_), dtype=np.int64)])
+        self.ids_ = np.r_[self.ids_, np.full(pad, -1, dtype=np.int64)]
+        self.lengths_ = np.r_[self.lengths_, np.zeros(pad, dtype=np.int64)]
+        self.last_seen_ = np.r_[self.last_seen_, np.full(pad, -1, dtype=np.int64)]
+        self.max_tracks_ = n
+
+    def _lookup(self, tids): 
+        """ 
+        Returns the slots for the given track ids (-1 if not an active track)
+        """
+        slots = np.full(len(tids), -1, dtype=np.int64)
+        if not len(self.slots_): 
+            return slots
+        active = self.ids_[self.slots_]
+        order = np.argsort(active, kind='mergesort')
+        sorted_ids = active[order]
+        pos = np.minimum(np.searchsorted(sorted_ids, tids), len(sorted_ids)-1)
+        found = sorted_ids[pos] == tids
+        slots[found] = self.slots_[order[pos[found]]]
+        return slots
 
     def add(self, pts, ids=None, prune=True): 
         # Add only if valid and non-zero
@@ -77,16 +141,39 @@ class TrackManager(object):
             return
 
         # Retain valid points
+        pts = np.asarray(pts)
         valid = np.isfinite(pts).all(axis=1)
         pts = pts[valid]
 
         # ID valid points
-        max_id = np.max(self.ids) + 1 if len(self.ids) else 0
-        tids = np.arange(len(pts), dtype=np.int64) + max_id if ids is None else ids[valid].astype(np.int64)
-        
-        # Add pts to track
-        for tid, pt in zip(tids, pts): 
-            self.tracks_[tid].append(self.index_, pt)
+        if ids is None: 
+            tids = np.arange(len(pts), dtype=np.int64) + self.next_id_
+            slots = np.full(len(pts), -1, dtype=np.int64)
+        else: 
+            tids = np.asarray(ids)[valid].astype(np.int64)
+            slots = self._lookup(tids)
+        if len(tids): 
+            self.next_id_ = max(self.next_id_, tids.max() + 1)
+
+        # Allocate free slots for new tracks
+        new, = np.where(slots < 0)
+        if len(new): 
+            free, = np.where(self.ids_ < 0)
+            if len(free) < len(new): 
+                self._grow(self.max_tracks_ + len(new) - len(free))
+                free, = np.where(self.ids_ < 0)
+            nslots = free[:len(new)]
+            slots[new] = nslots
+            self.ids_[nslots] = tids[new]
+            self.lengths_[nslots] = 0
+            self.slots_ = np.union1d(self.slots_, nslots)
+
+        # Append pts to track rings
+        pos = self.lengths_[slots] % self.maxlen_
+        self.items_[slots, pos] = pts
+        self.indices_[slots, pos] = self.index_
+        self.lengths_[slots] += 1
+        self.last_seen_[slots] = self.index_
 
         # If features are propagated
         if prune: 
@@ -97,47 +184,80 @@ class TrackManager(object):
 
     def prune(self): 
         # Remove tracks that are not most recent
-        deleted_tracks = {}
-        for tid, track in self.tracks_.items(): 
-            if track.latest_index < self.index_: 
-                deleted_tracks[tid] = deepcopy(self.tracks[tid])
-                del self.tracks[tid]
-
-        self.on_delete_cb_(deleted_tracks)
-                
+        stale = self.last_seen_[self.slots_] < self.index_
+        deleted = self.slots_[stale]
+        self.slots_ = self.slots_[~stale]
+
+        # Free slots after the callback, so that views are valid
+        if self.on_delete_cb_ is not None: 
+            self.on_delete_cb_({ tid: TrackView(self, slot) 
+                                 for tid, slot in zip(self.ids_[deleted], deleted) })
+        self.ids_[deleted] = -1
+        
     def register_on_track_delete_callback(self, cb): 
         print('{:}: Register callback for track deletion {:}'
               .format(self.__class__.__name__, cb))
         self.on_delete_cb_ = cb
 
+    def _latest(self, offset=1): 
+        """ Returns the items `offset` steps back from the latest, for all active tracks """
+        return self.items_[self.slots_, (self.lengths_[self.slots_]-offset) % self.maxlen_]
+
+    def items(self, index=-1): 
+        """
+        Returns the item at the given (negative) history index for all
+        active tracks, and a mask of tracks that are long enough
+        """
+        if index >= 0: 
+            raise ValueError('Only negative history indices are supported, provided {:}'.format(index))
+        valid = np.minimum(self.lengths_[self.slots_], self.maxlen_) >= -index
+        return self._latest(offset=-index), valid
+
+    def observations(self, n):
+        """
+        Returns the ids of all active tracks, and their observations over
+        the last n frames (oldest first): pts [n x N x 2] (NaN where
+        unobserved), and the mask of observed entries [n x N]
+        """
+        if n < 1 or n > self.maxlen_:
+            raise ValueError('Observations need 1 <= n <= maxlen ({:}), provided {:}'.format(self.maxlen_, n))
+        pts = np.full((n, len(self.slots_), 2), np.nan, dtype=np.float32)
+        valid = np.zeros((n, len(self.slots_)), dtype=np.bool)
+        for k in range(n):
+            p, v = self.items(k - n)
+            pts[k, v], valid[k] = p[v], v
+        return self.ids, pts, valid
+
     @property
     def tracks(self): 
-        return self.tracks_
+        return { tid: TrackView(self, slot) 
+                 for tid, slot in zip(self.ids_[self.slots_], self.slots_) }
 
     @property
     def flow(self): 
-        try: 
-            return np.vstack([ track.item(-1)-track.item(-2) 
-                               if track.length > 1 else np.zeros(2)
-                               for track in self.tracks_.itervalues() 
-                           ])
-        except: 
+        if not len(self.slots_): 
             return np.array([])
+        flow = self._latest(1) - self._latest(2)
+        flow[self.lengths_[self.slots_] < 2] = 0
+        return flow
 
     @property
     def pts(self): 
-        try: 
-            return np.vstack([ track.latest_item for track in self.tracks_.itervalues() ])
-        except: 
+        if not len(self.slots_): 
             return np.array([])
+        return self._latest(1)
         
     @property
     def ids(self): 
-        return np.array(self.tracks_.keys())
+        return self.ids_[self.slots_]
 
     @property
     def lengths(self): 
-        return np.int32([ track.length for track in self.tracks_.itervalues() ])
+        return self.lengths_[self.slots_].astype(np.int32)
+
+    @property
+    def maxlen(self): 
+        return self.maxlen_
 
     def confident_tracks(self, min_length=4): 
         inds, = np.where(self.lengths >= min_length)
@@ -147,6 +267,173 @@ class TrackManager(object):
     def index(self): 
         return self.index_
 
+class GridIndex(object): 
+    """
+    Uniform-grid occupancy index over tracked points. Per-cell counts 
+    are updated incrementally as tracks move, are added or die, and 
+    are used to determine the cells requiring new features, and the 
+    points that are within a set of bounding boxes. 
+
+        shape:          Image shape (H, W)
+        cell_size:      Cell size in pixels
+        max_per_cell:   Cells with fewer points are considered free
+    """
+    def __init__(self, shape, cell_size=16, max_per_cell=1): 
+        H, W = shape[:2]
+        self.shape_ = (H, W)
+        self.cell_size_ = cell_size
+        self.max_per_cell_ = max_per_cell
+        self.rows_ = int(np.ceil(float(H) / cell_size))
+        self.cols_ = int(np.ceil(float(W) / cell_size))
+        self.reset()
+
+    def reset(self): 
+        self.counts_ = np.zeros(self.rows_ * self.cols_, dtype=np.int32)
+
+        # Indexed points (sorted by id) and their cells
+        self.ids_ = np.empty(0, dtype=np.int64)
+        self.cells_ = np.empty(0, dtype=np.int64)
+        self.pts_ = np.empty((0,2), dtype=np.float32)
+        self.order_ = None
+
+    def cells(self, pts): 
+        """
+        Returns the flattened cell index for each point 
+        (-1 for non-finite points or points outside the image)
+        """
+        pts = np.asarray(pts, dtype=np.float32).reshape(-1,2)
+        cells = np.full(len(pts), -1, dtype=np.int64)
+        valid = finite_and_within_bounds(pts, self.shape_)
+        if not len(pts) or not valid.any(): 
+            return cells
+        xy = (pts[valid] // self.cell_size_).astype(np.int64)
+        cells[valid] = xy[:,1] * self.cols_ + xy[:,0]
+        return cells
+
+    def update(self, ids, pts): 
+        """
+        Update the index with the latest set of tracked points. Only
+        tracks that moved across cells, were added or were removed 
+        (not in ids) update the cell counts.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        order = np.argsort(ids)
+        ids, pts = ids[order], np.asarray(pts, dtype=np.float32).reshape(-1,2)[order]
+        cells = self.cells(pts)
+
+        # Tracks present in both the index and the update (both sorted)
+        common_old = np.in1d(self.ids_, ids, assume_unique=True)
+        common_new = np.in1d(ids, self.ids_, assume_unique=True)
+        moved = self.cells_[common_old] != cells[common_new]
+
+        removed = np.r_[self.cells_[~common_old], self.cells_[common_old][moved]]
+        added = np.r_[cells[~common_new], cells[common_new][moved]]
+        np.subtract.at(self.counts_, removed[removed >= 0], 1)
+        np.add.at(self.counts_, added[added >= 0], 1)
+
+        self.ids_, self.cells_, self.pts_ = ids, cells, pts
+        self.order_ = None
+
+    def occupancy(self, pts=None): 
+        """
+        Returns the per-cell counts [rows x cols], optionally including 
+        additional (untracked) points
+        """
+        counts = self.counts_
+        if pts is not None and len(pts): 
+            cells = self.cells(pts)
+            counts = counts + np.bincount(cells[cells >= 0], minlength=len(counts))
+        return counts.reshape(self.rows_, self.cols_)
+
+    def free_cells(self, pts=None): 
+        """
+        Returns the compact (cell_size, free) description of the cells
+        requiring new features, where free is a [rows x cols] boolean grid
+        """
+        return self.cell_size_, self.occupancy(pts=pts) < self.max_per_cell_
+
+    def free(self, pts, extra_pts=None): 
+        """ Returns whether each of the points falls in a free cell """
+        cells = self.cells(pts)
+        free = (self.occupancy(pts=extra_pts) < self.max_per_cell_).ravel()
+        return (cells >= 0) & free[np.maximum(cells, 0)]
+
+    def cell_rects(self, cells): 
+        """ Returns [K x 4] (x1, y1, x2, y2) rectangles for the flattened cell indices """
+        cells = np.asarray(cells, dtype=np.int64)
+        x1, y1 = (cells % self.cols_) * self.cell_size_, (cells // self.cols_) * self.cell_size_
+        return np.vstack([x1, y1, 
+                          np.minimum(x1 + self.cell_size_, self.shape_[1]), 
+                          np.minimum(y1 + self.cell_size_, self.shape_[0])]).T
+
+    def mask(self, pts=None): 
+        """
+        Returns the dense uint8 mask (255 in free cells) at 
+        image resolution, for detectors that require it
+        """
+        free = np.uint8(self.occupancy(pts=pts) < self.max_per_cell_) * 255
+        return np.repeat(np.repeat(free, self.cell_size_, axis=0), 
+                         self.cell_size_, axis=1)[:self.shape_[0], :self.shape_[1]]
+
+    def _candidates(self, bbox): 
+        """ 
+        Indices of the indexed points in cells overlapping the bbox
+        (points outside the image have no cell, and are always candidates)
+        """
+        if self.order_ is None: 
+            self.order_ = np.argsort(self.cells_, kind='mergesort')
+            self.sorted_cells_ = self.cells_[self.order_]
+        outside = self.order_[:np.searchsorted(self.sorted_cells_, 0, side='left')]
+
+        x1, y1, x2, y2 = bbox
+        H, W = self.shape_
+        if not (x2 >= 0 and y2 >= 0 and x1 < W and y1 < H): 
+            return outside
+        c1, c2 = [int(np.clip(v // self.cell_size_, 0, self.cols_-1)) for v in (x1, x2)]
+        r1, r2 = [int(np.clip(v // self.cell_size_, 0, self.rows_-1)) for v in (y1, y2)]
+
+        # Each row of overlapping cells is a contiguous range of sorted cells
+        rows = np.arange(r1, r2+1) * self.cols_
+        lo = np.searchsorted(self.sorted_cells_, rows + c1, side='left')
+        hi = np.searchsorted(self.sorted_cells_, rows + c2, side='right')
+        return np.concatenate([outside] + [self.order_[a:b] for a, b in zip(lo, hi)])
+
+    def inside(self, bboxes, pts=None): 
+        """
+        Returns the [B x N] boolean mask of the indexed points (ordered by id, 
+        or the provided pts) that are within each of the B (x1, y1, x2, y2) bboxes. 
+        For the indexed points, only those in cells overlapping a bbox are tested.
+        """
+        bboxes = np.asarray(bboxes, dtype=np.float32).reshape(-1,4)
+        if pts is not None: 
+            pts = np.asarray(pts).reshape(-1,2)
+            x, y = pts[:,0], pts[:,1]
+            return (x >= bboxes[:,0,None]) & (x <= bboxes[:,2,None]) & \
+                (y >= bboxes[:,1,None]) & (y <= bboxes[:,3,None])
+
+        mask = np.zeros((len(bboxes), len(self.pts_)), dtype=np.bool)
+        for bidx, bbox in enumerate(bboxes): 
+            inds = self._candidates(bbox)
+            x, y = self.pts_[inds,0], self.pts_[inds,1]
+            mask[bidx, inds] = (x >= bbox[0]) & (x <= bbox[2]) & (y >= bbox[1]) & (y <= bbox[3])
+        return mask
+
+    @property
+    def ids(self): 
+        return self.ids_
+
+    @property
+    def pts(self): 
+        return self.pts_
+
+    @property
+    def shape(self): 
+        return self.shape_
+
+    @property
+    def grid(self): 
+        return self.rows_, self.cols_
+
 class AprilTagFeatureDetector(object): 
     """
     AprilTag Feature Detector (only detect 4 corner points)
@@ -180,8 +467,14 @@ class OpticalFlowTracker(object):
         self.fb_check_ = fb_check
 
     @staticmethod
-    def create(method='lk', fb_check=True, params=lk_params): 
+    def create(method='lk', fb_check=True, params=lk_params, workers=None): 
+        """
+        workers: Number of threads for the LK tracker (see LKTracker)
+        """
         trackers = { 'lk': LKTracker, 'dense': FarnebackTracker }
+        params = dict(params)
+        if method == 'lk' and workers is not None: 
+            params['workers'] = workers
         try: 
             # Determine tracker type that implements track
             tracker = trackers[method](**params)
@@ -192,15 +485,48 @@ class OpticalFlowTracker(object):
     def track(self, im0, im1, p0):
         raise NotImplementedError()
 
+    def close(self): 
+        pass
+
 class LKTracker(OpticalFlowTracker): 
     """
     OpenCV's LK Tracker (with modifications for forward backward flow check)
+
+        workers:    Number of threads to split the tracked points over 
+                    (chunks of at least min_chunk points each)
     """
 
     default_params = OpticalFlowTracker.lk_params
-    def __init__(self, fb_check=True, winSize=(5,5), maxLevel=4):
+    def __init__(self, fb_check=True, winSize=(5,5), maxLevel=4, workers=1, min_chunk=256):
         OpticalFlowTracker.__init__(self, fb_check=fb_check)
         self.lk_params_ = AttrDict(winSize=winSize, maxLevel=maxLevel)
+        self.workers_ = workers
+        self.min_chunk_ = min_chunk
+        self.pool_ = None
+
+    @staticmethod
+    def _track(im0, im1, p0, lk_params, fb_check): 
+        """
+        Forward (and backward) flow for a chunk of points
+        """
+        # Forward flow
+        p1, st1, err1 = cv2.calcOpticalFlowPyrLK(im0, im1, p0, None, **lk_params)
+        p1 = p1.reshape(-1,2)
+        p1[st1.ravel() == 0] = np.nan
+
+        if fb_check: 
+            # Backward flow (only for points that survived the forward pass)
+            inds, = np.where(st1.ravel() != 0)
+            if not len(inds): 
+                return p1
+            p0r, st0, err0 = cv2.calcOpticalFlowPyrLK(im1, im0, p1[inds], None, **lk_params)
+            p0r = p0r.reshape(-1,2)
+            
+            # Set only good
+            fb_good = (st0.ravel() != 0) & (np.fabs(p0r-p0[inds]) < 3).all(axis=1)
+            p1[inds[~fb_good]] = np.nan
+
+        return p1
 
     # @timeitmethod
     def track(self, im0, im1, p0): 
@@ -210,20 +536,30 @@ class LKTracker(OpticalFlowTracker):
         if p0 is None or not len(p0): 
             return np.array([])
 
-        # Forward flow
-        p1, st1, err1 = cv2.calcOpticalFlowPyrLK(im0, im1, p0, None, **self.lk_params_)
-        p1[st1 == 0] = np.nan
-
-        if self.fb_check_: 
-            # Backward flow
-            p0r, st0, err0 = cv2.calcOpticalFlowPyrLK(im1, im0, p1, None, **self.lk_params_)
-            p0r[st0 == 0] = np.nan
-            
-            # Set only good
-            fb_good = (np.fabs(p0r-p0) < 3).all(axis=1)
-            p1[~fb_good] = np.nan
-
-        return p1
+        p0 = np.ascontiguousarray(p0, dtype=np.float32).reshape(-1,2)
+        nchunks = min(self.workers_, len(p0) // self.min_chunk_)
+        lk_params, fb_check = self.lk_params_, self.fb_check_
+        if nchunks <= 1: 
+            return LKTracker._track(im0, im1, p0, lk_params, fb_check)
+
+        # Split points across the thread pool (OpenCV releases the GIL). 
+        # Tasks do not reference self, so that the last reference (and 
+        # __del__) is never dropped from within a pool thread
+        if self.pool_ is None: 
+            self.pool_ = ThreadPool(self.workers_)
+        chunks = np.array_split(p0, nchunks)
+        return np.vstack(self.pool_.map(
+            lambda pts: LKTracker._track(im0, im1, pts, lk_params, fb_check), chunks))
+
+    def close(self): 
+        """ Terminate the thread pool (re-created on demand) """
+        if self.pool_ is not None: 
+            self.pool_.terminate()
+            self.pool_.join()
+            self.pool_ = None
+
+    def __del__(self): 
+        self.close()
 
 class FarnebackTracker(OpticalFlowTracker): 
     """
@@ -0,0 +1,146 @@
+# Author: Sudeep Pillai <spillai@csail.mit.edu>
+# License: MIT
+
+"""
+Batched multi-view triangulation. N tracks observed in K views are
+triangulated with a vectorized (linear) DLT, and evaluated for
+reprojection error, cheirality and triangulation angle.
+
+Observations follow the TrackManager.observations layout:
+pts [K x N x 2] (pixels) with a mask of observed entries [K x N].
+
+Usage:
+    ids, pts, valid = tm.observations(len(cameras))
+    res = triangulate_tracks(cameras, pts, valid)
+    X = res.X[res.inliers]
+"""
+
+import cv2
+import numpy as np
+
+from pybot.utils.db_utils import AttrDict
+from pybot.geometry.rigid_transform import RigidTransformArray
+from pybot.vision.camera_utils import project_many
+
+def _stack_cameras(cameras, poses=None):
+    """
+    Returns the per-view intrinsics list, and the stacked
+    (world-to-camera) R [K x 3 x 3], t [K x 3]
+    """
+    if poses is not None:
+        if not isinstance(poses, RigidTransformArray):
+            poses = RigidTransformArray.from_list(poses)
+        return [cameras] * len(poses), poses.R, poses.t
+    R = np.stack([cam.R for cam in cameras])
+    t = np.stack([np.array(cam.tvec, dtype=np.float64).ravel() for cam in cameras])
+    return list(cameras), R, t
+
+def normalize_points(intrinsics, pts):
+    """
+    Undistort and normalize [K x N x 2] pixel observations with
+    their view's intrinsics (K^-1 [u, v, 1])
+    """
+    pts = np.asarray(pts, dtype=np.float64)
+    out = np.empty_like(pts)
+    for k, cam in enumerate(intrinsics):
+        if np.any(cam.D):
+            out[k] = cv2.undistortPoints(pts[k].reshape(-1,1,2),
+                                         np.asarray(cam.K, dtype=np.float64),
+                                         np.asarray(cam.D, dtype=np.float64)).reshape(-1,2)
+            continue
+        K = np.asarray(cam.K, dtype=np.float64)
+        y = (pts[k,:,1] - K[1,2]) / K[1,1]
+        out[k,:,0] = (pts[k,:,0] - K[0,2] - K[0,1] * y) / K[0,0]
+        out[k,:,1] = y
+    return out
+
+def triangulate_dlt(R, t, xy, valid):
+    """
+    Vectorized linear (DLT) triangulation of N tracks in K views
+
+        R, t:   [K x 3 x 3], [K x 3] world-to-camera poses
+        xy:     [K x N x 2] normalized image coordinates
+        valid:  [K x N] mask of observed entries
+
+    Returns:
+       X: [N x 3] triangulated points (NaN for tracks with < 2 views)
+    """
+    P = np.concatenate([R, t[:,:,np.newaxis]], axis=2)
+    xy = np.where(valid[...,np.newaxis], xy, 0)
+
+    # Rows x P3 - P1, y P3 - P2 per view [K x N x 2 x 4], unit-norm
+    # (masked for unobserved entries)
+    A = xy[...,np.newaxis] * P[:,np.newaxis,2:3,:] - P[:,np.newaxis,:2,:]
+    A /= np.linalg.norm(A, axis=3)[...,np.newaxis]
+    A *= valid[...,np.newaxis,np.newaxis]
+
+    # Smallest eigenvector of A^T A [N x 4 x 4]
+    AtA = np.einsum('knij,knil->njl', A, A)
+    _, V = np.linalg.eigh(AtA)
+    Xh = V[:,:,0]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        X = Xh[:,:3] / Xh[:,3:]
+    X[valid.sum(axis=0) < 2] = np.nan
+    return X
+
+def triangulation_angle(R, t, X, valid):
+    """
+    Largest angle (radians) subtended at X [N x 3] by any pair of
+    the observing camera centers
+    """
+    C = -np.matmul(np.transpose(R, (0,2,1)), t[:,:,np.newaxis])[...,0]
+    v = X[np.newaxis] - C[:,np.newaxis]
+    v /= np.linalg.norm(v, axis=2)[...,np.newaxis]
+    cos = np.einsum('inj,knj->nik', v, v)
+    pair = valid.T[:,:,np.newaxis] & valid.T[:,np.newaxis,:]
+    cos = np.where(pair, cos, 1.0)
+    return np.arccos(np.clip(np.nanmin(cos.reshape(len(X), -1), axis=1), -1, 1))
+
+def triangulate_tracks(cameras, pts, valid=None, poses=None,
+                       max_error=2.0, min_angle=np.deg2rad(1.0), min_depth=0.0):
+    """
+    Triangulate N tracks observed in K views, see module documentation
+
+        cameras:    List of K Cameras, or a single CameraIntrinsic
+                    together with K (world-to-camera) poses
+        pts:        [K x N x 2] pixel observations
+        valid:      [K x N] mask of observed entries (defaults to finite pts)
+        max_error:  Maximum mean reprojection error (px) of an inlier
+        min_angle:  Minimum triangulation angle (radians) of an inlier
+
+    Returns:
+       AttrDict with
+         X:          [N x 3] triangulated points
+         errors:     [K x N] reprojection errors (px, NaN where unobserved)
+         error:      [N] mean reprojection error over the observed views
+         cheirality: [N] mask of points in front of all observing views
+         angle:      [N] triangulation angle (radians)
+         inliers:    [N] mask of tracks passing all checks
+    """
+    pts = np.asarray(pts, dtype=np.float64)
+    if pts.ndim != 3 or pts.shape[2] != 2:
+        raise ValueError('Expected [K x N x 2] observations, provided {:}'.format(pts.shape))
+    if valid is None:
+        valid = np.isfinite(pts).all(axis=2)
+    valid = valid & np.isfinite(pts).all(axis=2)
+
+    intrinsics, R, t = _stack_cameras(cameras, poses=poses)
+    if len(R) != len(pts):
+        raise ValueError('Expected {:} views, provided {:}'.format(len(R), len(pts)))
+
+    # Triangulate
+    X = triangulate_dlt(R, t, normalize_points(intrinsics, pts), valid)
+
+    # Reproject (with distortion)
+    pts2d, depths, _ = project_many(cameras, X, poses=poses, min_depth=None, check_bounds=False)
+    errors = np.where(valid, np.linalg.norm(pts2d - pts, axis=2), np.nan)
+    nviews = valid.sum(axis=0)
+    with np.errstate(invalid='ignore'):
+        error = np.where(nviews > 0, np.nansum(errors, axis=0), np.nan) / np.maximum(nviews, 1)
+        cheirality = ((depths > min_depth) | ~valid).all(axis=0)
+        angle = triangulation_angle(R, t, X, valid)
+        inliers = (nviews >= 2) & cheirality & (error <= max_error) & (angle >= min_angle)
+
+    return AttrDict(X=X, errors=errors, error=error, cheirality=cheirality,
+                    angle=angle, inliers=inliers)
@@ -0,0 +1,190 @@
+import numpy as np
+import cv2
+from nose.tools import assert_equal, assert_raises
+
+from pybot.geometry.rigid_transform import RigidTransform, RigidTransformArray
+from pybot.vision.camera_utils import Camera, CameraIntrinsic, CameraExtrinsic, \
+    DepthCamera, Frustum, construct_K, project_many, frustum_planes, visible_points, \
+    zbuffer, get_discretized_projection, get_object_bbox, get_object_bboxes
+
+def random_cameras(intrinsic, K=10, seed=0):
+    rng = np.random.RandomState(seed)
+    cameras = []
+    for k in range(K):
+        R, t = RigidTransform.from_rpyxyz(*(rng.randn(6) * [0.1, 0.1, 0.1, 0.5, 0.5, 0.5])).to_Rt()
+        cameras.append(Camera(intrinsic.K, R, t, D=intrinsic.D, shape=intrinsic.shape))
+    return cameras
+
+def random_points(N, seed=0):
+    rng = np.random.RandomState(seed)
+    return np.c_[rng.uniform(-4, 4, (N, 2)), rng.uniform(-1, 12, N)]
+
+def test_project_many():
+    intrinsic = CameraIntrinsic.from_calib_params(500., 500., 319.5, 239.5, k1=-0.1, k2=0.01,
+                                                  shape=np.int32([480, 640]))
+    cameras = random_cameras(intrinsic)
+    X = random_points(1000)
+    pts, depths, valid = project_many(cameras, X, min_depth=0.1, check_bounds=True)
+    assert_equal(pts.shape, (len(cameras), len(X), 2))
+    for k, cam in enumerate(cameras):
+        ref, _ = cv2.projectPoints(X.reshape(-1,1,3), cv2.Rodrigues(cam.R)[0],
+                                   np.float64(cam.tvec), cam.K, cam.D)
+        Xc = np.dot(X, cam.R.T) + cam.tvec
+        assert np.allclose(pts[k][Xc[:,2] > 0], ref.reshape(-1,2)[Xc[:,2] > 0])
+        assert np.allclose(depths[k], Xc[:,2])
+        assert np.allclose(cam.project(X, check_bounds=True, check_depth=True), pts[k][valid[k]])
+
+    # Single intrinsic with K poses
+    poses = RigidTransformArray.from_list([RigidTransform.from_Rt(c.R, c.tvec) for c in cameras])
+    pts2, depths2, valid2 = project_many(intrinsic, X, poses=poses)
+    assert np.allclose(pts, pts2) and np.allclose(depths, depths2) and np.array_equal(valid, valid2)
+
+def test_ray_table():
+    intrinsic = CameraIntrinsic.from_calib_params(500., 505., 320., 240., k1=-0.2, k2=0.05,
+                                                  p1=0.001, p2=-0.001, shape=np.int32([480, 640]))
+    H, W = intrinsic.shape
+    xs, ys = np.meshgrid(np.arange(W), np.arange(H))
+    pts = np.float32(np.c_[xs.ravel(), ys.ravel()])
+    upts = intrinsic.undistort_points(pts)
+    ref = np.c_[(upts[:,0] - intrinsic.cx) / intrinsic.fx, (upts[:,1] - intrinsic.cy) / intrinsic.fy]
+    rays = intrinsic.ray(pts)
+    assert np.allclose(rays[:,:2], ref, atol=1e-5) and np.allclose(rays[:,2], 1)
+
+    # Sub-pixel (or sparse) points are undistorted directly
+    assert np.allclose(intrinsic.ray(pts[:10] + 0.5)[:,:2],
+                       intrinsic.ray(pts[:10] + 0.5, undistort=False)[:,:2], atol=0.1)
+
+    # Scaled intrinsics (derived from the cached table)
+    scaled = intrinsic.scaled(0.5)
+    xs, ys = np.meshgrid(np.arange(W // 2), np.arange(H // 2))
+    pts = np.float32(np.c_[xs.ravel(), ys.ravel()])
+    upts = scaled.undistort_points(pts)
+    ref = np.c_[(upts[:,0] - scaled.cx) / scaled.fx, (upts[:,1] - scaled.cy) / scaled.fy]
+    assert np.allclose(scaled.ray(pts)[:,:2], ref, atol=1e-3)
+
+def test_undistort_maps():
+    intrinsic = CameraIntrinsic.from_calib_params(500., 505., 320., 240., k1=-0.2, k2=0.05,
+                                                  shape=np.int32([480, 640]))
+    im = cv2.GaussianBlur(np.uint8(np.random.RandomState(0).rand(480, 640) * 255), (5, 5), 2)
+    ref = cv2.undistort(im, intrinsic.K, intrinsic.D, None, intrinsic.K)
+    assert np.abs(intrinsic.undistort(im).astype(np.int32) - ref).mean() < 1
+
+def test_depth_camera_reconstruct():
+    cam = DepthCamera(K=construct_K(570., 580., 319.5, 239.5), shape=(480, 640))
+    rng = np.random.RandomState(0)
+    depth = np.float32(rng.rand(480, 640) * 5)
+    depth[::7,::5] = 0
+    ys, xs = np.mgrid[:480,:640]
+    ref = np.dstack([(xs - 319.5) / 570. * depth, (ys - 239.5) / 580. * depth, depth])
+
+    X = cam.reconstruct(depth)
+    assert X.dtype == np.float64 and np.allclose(X, ref)
+
+    X = cam.reconstruct(depth, out=np.empty((480, 640, 3), np.float32), min_depth=0.1, max_depth=4.0)
+    ok = (depth >= 0.1) & (depth <= 4)
+    assert X.dtype == np.float32 and np.allclose(X[ok], ref[ok], rtol=1e-5)
+    assert np.isnan(X[~ok]).all()
+    assert_equal(cam.reconstruct(depth, dtype=np.float16).dtype, np.float16)
+
+    mm = np.uint16(depth * 1000)
+    assert np.allclose(cam.reconstruct(mm, depth_scale=0.001), ref, atol=1e-3)
+    with assert_raises(ValueError):
+        cam.reconstruct(depth[::2])
+
+    pts = np.float32(rng.rand(100, 2) * [639, 479])
+    d = rng.rand(100)
+    assert np.allclose(cam.reconstruct_sparse(pts, d),
+                       np.c_[(pts[:,0] - 319.5) / 570. * d, (pts[:,1] - 239.5) / 580. * d, d])
+
+    assert_equal(DepthCamera(K=cam.K, shape=(480, 640), skip=2).reconstruct(depth).shape, (240, 320, 3))
+
+def test_depth_camera_stream():
+    cam = DepthCamera(K=construct_K(570., 580., 319.5, 239.5), shape=(48, 64))
+    depths = [np.full((48, 64), k + 1, dtype=np.uint16) for k in range(6)]
+    buffers = set()
+    for k, X in enumerate(cam.reconstruct_stream(depths, buffers=2)):
+        assert np.allclose(X[...,2], k + 1)
+        buffers.add(X.__array_interface__['data'][0])
+    assert_equal(len(buffers), 2)
+
+def test_visible_points():
+    intrinsic = CameraIntrinsic.from_calib_params(500., 500., 319.5, 239.5, shape=np.int32([480, 640]))
+    cameras = random_cameras(intrinsic, K=5)
+    X = random_points(20000)
+    inds = visible_points(cameras, X, zmin=0.1, zmax=30)
+    pts, depths, valid = project_many(cameras, X, min_depth=0.1, check_bounds=False)
+    u, v = pts[...,0], pts[...,1]
+    ref = valid & (depths <= 30) & (u >= 0) & (u <= 639) & (v >= 0) & (v <= 479)
+    for k in range(len(cameras)):
+        assert len(np.setxor1d(inds[k], np.flatnonzero(ref[k]))) <= 2
+
+    # Voxel-accelerated culling is exact
+    for a, b in zip(inds, visible_points(cameras, X, zmin=0.1, zmax=30, voxel_size=1.0)):
+        assert np.array_equal(a, b)
+
+    # Intrinsic with poses, and Frustum.contains
+    poses = [RigidTransform.from_Rt(c.R, c.tvec) for c in cameras]
+    assert np.allclose(frustum_planes(intrinsic, poses=poses), frustum_planes(cameras))
+    frustum = Frustum.from_camera(cameras[0], zmin=0.1, zmax=30)
+    assert np.array_equal(np.flatnonzero(frustum.contains(X)), inds[0])
+
+def test_zbuffer():
+    cam = Camera.from_intrinsics_extrinsics(CameraIntrinsic.simulate(), CameraExtrinsic.simulate())
+    rng = np.random.RandomState(0)
+    wall = np.c_[rng.uniform(-5, 5, (20000, 2)), np.full(20000, 5.)]
+    box = np.c_[rng.uniform(-0.3, 0.3, (20000, 2)), np.full(20000, 2.)]
+    X = np.vstack([wall, box])
+    z, visible = get_discretized_projection(cam, X, subsample=1, discretize=4)
+
+    # Reference scatter-min
+    pts, d, _ = project_many([cam], X, min_depth=None, check_bounds=False)
+    xy = np.floor(pts[0] / 4).astype(int)
+    ok = (xy[:,0] >= 0) & (xy[:,0] < z.shape[1]) & (xy[:,1] >= 0) & (xy[:,1] < z.shape[0])
+    ref = np.full(z.shape, np.inf)
+    np.minimum.at(ref, (xy[ok,1], xy[ok,0]), d[0][ok])
+    ref[np.isinf(ref)] = 10000.
+    assert np.allclose(ref, z)
+    assert visible[len(wall):].all() and not visible[:len(wall)].all()
+
+    # Occluded points are excluded from the object bbox
+    patch = np.c_[rng.uniform(-0.2, 0.2, (2000, 2)), np.full(2000, 5.)]
+    assert get_object_bbox(cam, patch, subsample=1)[1] is not None
+    assert get_object_bbox(cam, patch, subsample=1, zbuf=z)[1] is None
+
+    z, visible = zbuffer(np.zeros((0, 2)), np.zeros(0), (8, 8))
+    assert np.isinf(z).all() and not len(visible)
+
+def test_zbuffer_nearest_visible():
+    # One point per pixel, at depths that are not representable in float32
+    ys, xs = np.mgrid[:30,:40]
+    pts2d = np.c_[xs.ravel(), ys.ravel()] + 0.5
+    depths = np.random.RandomState(0).uniform(0.5, 50, len(pts2d))
+    z, visible = zbuffer(pts2d, depths, (30, 40))
+    assert visible.all()
+    assert np.allclose(z.ravel(), depths)
+
+    # Points behind the nearest are occluded (unless within tol)
+    z, visible = zbuffer(np.r_[pts2d, pts2d], np.r_[depths, depths + 0.01], (30, 40))
+    assert visible[:len(depths)].all() and not visible[len(depths):].any()
+    z, visible = zbuffer(np.r_[pts2d, pts2d], np.r_[depths, depths + 0.01], (30, 40), tol=0.02)
+    assert visible.all()
+
+def test_get_object_bboxes():
+    intrinsic = CameraIntrinsic.from_calib_params(500., 500., 319.5, 239.5, shape=np.int32([480, 640]))
+    cameras = random_cameras(intrinsic, K=10)
+    pts = np.random.RandomState(1).randn(600, 3) * 0.3 + [0, 0, 5]
+    bboxes, depths, valid = get_object_bboxes(cameras, pts, subsample=3, scale=1.2)
+    for k, cam in enumerate(cameras):
+        _, bbox, depth = get_object_bbox(cam, pts, subsample=3, scale=1.2)
+        assert_equal(bbox is not None, valid[k])
+        if bbox is not None:
+            assert np.allclose(bbox, bboxes[k], atol=1) and np.allclose(depth, depths[k])
+
+def test_camera_pose_cache():
+    cam = Camera.from_intrinsics_extrinsics(CameraIntrinsic.simulate(), CameraExtrinsic.identity())
+    X = random_points(10)
+    assert np.allclose(cam.c2w(X), X)
+    pose = RigidTransform.from_rpyxyz(0.1, 0.2, 0.3, 1, 2, 3)
+    cam.set_pose(pose)
+    assert np.allclose(cam.w2c(cam.c2w(X)), X)
+    assert np.allclose(cam.c2w(X), pose * X)
@@ -0,0 +1,170 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import numpy as np
+from nose.tools import assert_equal, assert_raises
+
+from pybot.utils.async_utils import async_prefetch
+from pybot.utils.dataset_readers import DatasetReader, FrameCache, \
+    template_range, manifest_filename
+
+tmpdir = None
+
+def setup_module():
+    global tmpdir
+    tmpdir = tempfile.mkdtemp()
+    for idx in range(1, 21):
+        np.save(os.path.join(tmpdir, '%06i.npy' % idx), np.full((4, 4), idx, dtype=np.uint8))
+
+def teardown_module():
+    shutil.rmtree(tmpdir)
+
+def touch(fn):
+    open(fn, 'w').close()
+
+def slow_square(x):
+    time.sleep(np.random.uniform(0, 0.01))
+    return x * x
+
+def fail_on_5(x):
+    if x == 5:
+        raise IOError('Failed on {:}'.format(x))
+    return x
+
+# -----------------------------------------------------------------------------
+# async_prefetch
+
+def test_async_prefetch_ordering():
+    expected = [x * x for x in range(50)]
+    for prefetch, workers in [(0, 1), (1, 1), (4, 2), (8, 4), (100, 3)]:
+        assert_equal(list(async_prefetch(slow_square, range(50), prefetch=prefetch, workers=workers)),
+                     expected)
+    assert_equal(list(async_prefetch(slow_square, range(10), prefetch=4, workers=2, processes=True)),
+                 [x * x for x in range(10)])
+
+def test_async_prefetch_errors():
+    out = []
+    with assert_raises(IOError):
+        for item in async_prefetch(fail_on_5, range(10), prefetch=4, workers=2):
+            out.append(item)
+    assert_equal(out, range(5))
+
+def test_async_prefetch_bounded():
+    consumed, submitted = [0], []
+    def source():
+        for x in range(100):
+            submitted.append(x)
+            yield x
+    for item in async_prefetch(lambda x: x, source(), prefetch=4, workers=2):
+        assert len(submitted) <= item + 1 + 4
+        consumed[0] += 1
+    assert_equal(consumed[0], 100)
+
+def test_async_prefetch_early_stop():
+    nthreads = threading.active_count()
+    it = async_prefetch(slow_square, range(1000), prefetch=8, workers=4)
+    for idx, item in enumerate(it):
+        if idx == 3:
+            break
+    it.close()
+    time.sleep(0.1)
+    assert threading.active_count() <= nthreads
+
+# -----------------------------------------------------------------------------
+# FrameCache
+
+def test_frame_cache_lru_eviction():
+    item = lambda key: np.zeros(100, dtype=np.uint8)
+    cache = FrameCache(max_bytes=300, eviction='lru')
+    for key in [0, 1, 2, 0, 3]:
+        cache.get(key, item)
+    assert_equal(sorted(cache.items_.keys()), [0, 2, 3])
+    assert_equal((cache.hits, cache.misses, cache.evictions), (1, 4, 1))
+    assert_equal(cache.nbytes, 300)
+
+def test_frame_cache_fifo_eviction():
+    item = lambda key: np.zeros(100, dtype=np.uint8)
+    cache = FrameCache(max_bytes=300, eviction='fifo')
+    for key in [0, 1, 2, 0, 3]:
+        cache.get(key, item)
+    assert_equal(sorted(cache.items_.keys()), [1, 2, 3])
+
+def test_frame_cache_bounds():
+    cache = FrameCache(max_bytes=100)
+    cache.put('large', np.zeros(101, dtype=np.uint8))
+    assert 'large' not in cache
+    cache.put('a', np.zeros(60, dtype=np.uint8))
+    cache.put('b', np.zeros(60, dtype=np.uint8))
+    assert_equal((len(cache), cache.nbytes), (1, 60))
+    cache.clear()
+    assert_equal((len(cache), cache.nbytes), (0, 0))
+    with assert_raises(ValueError):
+        FrameCache(eviction='random')
+
+def test_reader_cache_and_slicing():
+    reader = DatasetReader(process_cb=np.load, template=os.path.join(tmpdir, '%06i.npy'), start_idx=1)
+    assert_equal(len(reader), 20)
+    assert_equal(reader[-1][0,0], 20)
+    view = reader[2:12:3]
+    assert_equal([im[0,0] for im in view.iteritems()], [3, 6, 9, 12])
+
+    cache = reader.set_cache(max_bytes=5 * 16)
+    for epoch in range(2):
+        for idx in range(5):
+            reader[idx]
+    assert_equal((cache.hits, cache.misses), (5, 5))
+    assert_equal([im[0,0] for im in reader.iteritems(prefetch=4, workers=2)], range(1, 21))
+    with assert_raises(TypeError):
+        reader['a']
+    with assert_raises(IndexError):
+        reader[20]
+
+# -----------------------------------------------------------------------------
+# template_range and the manifest
+
+def test_template_range():
+    template = os.path.join(tmpdir, '%06i.npy')
+    for use_manifest in [False, True, True]:
+        assert_equal(template_range(template, start_idx=1, use_manifest=use_manifest), (1, 21))
+        assert_equal(template_range(template, start_idx=15, use_manifest=use_manifest), (15, 21))
+    assert_equal(template_range(template, start_idx=0, use_manifest=False), (0, 0))
+    assert_equal(template_range(template, start_idx=21, use_manifest=False), (21, 21))
+
+def test_template_range_gaps():
+    directory = tempfile.mkdtemp()
+    try:
+        template = os.path.join(directory, '%i.txt')
+        for idx in range(100):
+            if idx != 37:
+                touch(template % idx)
+        assert_equal(template_range(template, start_idx=0), (0, 37))
+        assert_equal(template_range(template, start_idx=38), (38, 100))
+    finally:
+        shutil.rmtree(directory)
+
+def test_template_range_manifest():
+    directory = tempfile.mkdtemp()
+    try:
+        template = os.path.join(directory, '%03i.txt')
+        for idx in range(10):
+            touch(template % idx)
+        assert_equal(template_range(template), (0, 10))
+        manifest = os.path.join(directory, manifest_filename)
+        assert os.path.exists(manifest)
+
+        # Manifest is invalidated when the run is extended or truncated
+        touch(template % 10)
+        assert_equal(template_range(template), (0, 11))
+        os.remove(template % 10)
+        assert_equal(template_range(template), (0, 10))
+        os.remove(template % 9)
+        assert_equal(template_range(template), (0, 9))
+
+        # Corrupt manifests are ignored
+        with open(manifest, 'w') as fd:
+            fd.write('{')
+        assert_equal(template_range(template, start_idx=3), (3, 9))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,168 @@
+import os
+import sys
+import time
+import shutil
+import subprocess
+import cPickle
+import tempfile
+import numpy as np
+import tables as tb
+from nose.tools import assert_equal, assert_raises
+from nose.plugins.attrib import attr
+
+from pybot.utils.db_utils import IterDB
+from pybot.geometry.rigid_transform import RigidTransform
+
+tmpdir = None
+
+def setup_module():
+    global tmpdir
+    tmpdir = tempfile.mkdtemp()
+
+def teardown_module():
+    shutil.rmtree(tmpdir)
+
+def test_iterdb_round_trip():
+    fn = os.path.join(tmpdir, 'round_trip.h5')
+    A = np.random.RandomState(0).rand(1000, 4, 3).astype(np.float32)
+    with IterDB(filename=fn, mode='w', buffer_size=64) as db:
+        for item in A:
+            db.append('a', item)
+            db.append('c', RigidTransform.identity())
+        db.extend('b', A)
+        db.extend('b', A)
+
+    with IterDB(filename=fn, mode='a') as db:
+        db.extend('a', A[:50])
+        db.append('d', 'string')
+
+    with IterDB(filename=fn, mode='r') as db:
+        assert_equal(sorted(db.keys), ['a', 'b', 'c', 'd'])
+        assert_equal((db.length('a'), db.length('b'), db.length('c')), (1050, 2000, 1000))
+        assert np.array_equal(np.concatenate(list(db.iterchunks('a', batch_size=300))), np.r_[A, A[:50]])
+        assert np.array_equal(np.stack(list(db.itervalues_for_key('b'))), np.r_[A, A])
+        assert np.array_equal(db['b'][1005:1010], A[5:10])
+        assert np.array_equal(db['b'][-1], A[-1])
+        assert np.array_equal(db['b'][[10, 3, 1999]], A[[10, 3, 999]])
+        assert isinstance(db['c'][3], RigidTransform) and len(db['c'][2:5]) == 3
+        assert_equal(db['d'][0], 'string')
+        assert_equal(sum(1 for _ in db.itervalues_for_keys(['a', 'c'])), 1000)
+        with assert_raises(RuntimeError):
+            db['e']
+
+def test_iterdb_buffered_reads():
+    fn = os.path.join(tmpdir, 'buffered.h5')
+    with IterDB(filename=fn, mode='w', buffer_size=100) as db:
+        for idx in range(10):
+            db.append('a', np.full(3, idx))
+        assert_equal(db.length('a'), 10)
+        assert_equal(db['a'][9][0], 9)
+
+def test_iterdb_variable_rows():
+    fn = os.path.join(tmpdir, 'variable.h5')
+    with IterDB(filename=fn, mode='w', buffer_size=4) as db:
+        for idx in range(6):
+            db.append('h', np.full((3, 4), idx))
+        db.append('h', np.zeros((5, 4)))
+        db.extend('h', np.ones((2, 7, 4)))
+        with assert_raises(ValueError):
+            db.append('h', np.ones((3, 5)))
+        db.extend('g', np.ones((2, 3)))
+        with assert_raises(ValueError):
+            db.append('g', np.ones((3, 3)))
+
+    with IterDB(filename=fn, mode='r') as db:
+        assert_equal([item.shape for item in db.itervalues_for_key('h')],
+                     [(3, 4)] * 6 + [(5, 4), (7, 4), (7, 4)])
+        assert_equal(db['h'][5][0,0], 5)
+
+def test_iterdb_lossy_casts():
+    fn = os.path.join(tmpdir, 'casts.h5')
+    with IterDB(filename=fn, mode='w') as db:
+        db.append('u', np.zeros(3, dtype=np.uint8))
+        with assert_raises(ValueError):
+            db.append('u', [1.7, 300, -1])
+        with assert_raises(ValueError):
+            db.extend('u', np.array([[0, 0, 256]]))
+        db.append('u', [1, 2, 3])
+        db.append('u', np.float64([4, 5, 6]))
+        db.extend('f', np.zeros((2, 2), dtype=np.float32))
+        db.extend('f', np.ones((2, 2)))
+
+    with IterDB(filename=fn, mode='r') as db:
+        assert np.array_equal(db['u'][:], [[0, 0, 0], [1, 2, 3], [4, 5, 6]])
+        assert_equal(db['u'][:].dtype, np.uint8)
+        assert_equal(db['f'][:].dtype, np.float32)
+
+def test_iterdb_old_format():
+    """ Files written with VLArrays (previous IterDB layout) """
+    fn = os.path.join(tmpdir, 'old.h5')
+    h5f = tb.open_file(fn, mode='w')
+    filters = tb.Filters(complevel=5, complib='blosc')
+    h = h5f.create_vlarray(h5f.root, 'h', tb.Atom.from_type('float64', (4,)), filters=filters)
+    h.append(np.ones((3, 4)))
+    h.append(np.zeros((5, 4)))
+    o = h5f.create_vlarray(h5f.root, 'o', tb.VLStringAtom(), filters=filters)
+    o.append('OBJ_' + cPickle.dumps(dict(a=1), -1))
+    h5f.close()
+
+    with IterDB(filename=fn, mode='a') as db:
+        db.append('h', np.full((2, 4), 2.))
+        db.append('o', [1, 2])
+
+    with IterDB(filename=fn, mode='r') as db:
+        assert_equal([item.shape for item in db.itervalues_for_key('h')], [(3, 4), (5, 4), (2, 4)])
+        assert_equal(db['h'][2][0,0], 2.)
+        assert_equal(list(db.itervalues_for_key('o')), [dict(a=1), [1, 2]])
+        assert_equal([len(chunk) for chunk in db.iterchunks('h', batch_size=2)], [2, 1])
+
+def test_iterdb_unclosed_writers():
+    """ Buffered rows of writers that are never closed are not lost """
+    fn = os.path.join(tmpdir, 'unclosed_del.h5')
+    db = IterDB(filename=fn, mode='w')
+    for idx in range(10):
+        db.append('a', np.full(3, idx))
+    db.append('b', dict(idx=0))
+    del db
+    with IterDB(filename=fn, mode='r') as db:
+        assert_equal((db.length('a'), db.length('b')), (10, 1))
+
+    # Process exit without close()
+    fn = os.path.join(tmpdir, 'unclosed_exit.h5')
+    script = '\n'.join(['import numpy as np',
+                        'from pybot.utils.db_utils import IterDB',
+                        'db = IterDB(filename={!r}, mode="w")'.format(fn),
+                        'for idx in range(10): db.append("a", np.full(3, idx))',
+                        'db.append("b", dict(idx=0))'])
+    subprocess.check_call([sys.executable, '-c', script])
+    with IterDB(filename=fn, mode='r') as db:
+        assert_equal((db.length('a'), db.length('b')), (10, 1))
+
+@attr('slow')
+def test_iterdb_benchmark():
+    rng = np.random.RandomState(0)
+    for name, N, shape, dtype in [('orb', 1000000, (32,), np.uint8),
+                                  ('sift', 250000, (128,), np.float32)]:
+        D = (rng.rand(N, *shape) * 255).astype(dtype)
+        fn = os.path.join(tmpdir, '{}.h5'.format(name))
+        nbytes = D.nbytes / 1024. ** 2
+
+        st = time.time()
+        with IterDB(filename=fn, mode='w') as db:
+            for j in range(0, N, 1000):
+                db.extend('desc', D[j:j+1000])
+        print('{}: extend {:.1f} MB/s'.format(name, nbytes / (time.time() - st)))
+
+        st = time.time()
+        with IterDB(filename=fn, mode='w') as db:
+            for j in range(100000):
+                db.append('desc', D[j])
+        print('{}: append {:.1f} rows/s'.format(name, 100000 / (time.time() - st)))
+
+        with IterDB(filename=fn, mode='w') as db:
+            db.extend('desc', D)
+
+        st = time.time()
+        with IterDB(filename=fn, mode='r') as db:
+            assert_equal(sum(len(chunk) for chunk in db.iterchunks('desc', batch_size=100000)), N)
+        print('{}: iterchunks {:.1f} MB/s'.format(name, nbytes / (time.time() - st)))
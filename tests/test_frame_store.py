@@ -0,0 +1,111 @@
+import os
+import shutil
+import pickle
+import tempfile
+import numpy as np
+from nose.tools import assert_equal, assert_raises
+
+from pybot.utils.dataset_readers import DatasetReader, StereoDatasetReader
+from pybot.utils.frame_store import PackedFrameWriter, PackedFrameStore, \
+    PackedDatasetReader, PackedChannel, packed_stereo_reader, pack_dataset
+
+tmpdir = None
+
+def setup_module():
+    global tmpdir
+    tmpdir = tempfile.mkdtemp()
+
+def teardown_module():
+    shutil.rmtree(tmpdir)
+
+def make_frames(N=12, seed=0):
+    rng = np.random.RandomState(seed)
+    left = (rng.rand(N, 6, 8) * 255).astype(np.uint8)
+    right = (rng.rand(N, 6, 8) * 255).astype(np.uint8)
+    depth = (rng.rand(N, 3, 4) * 5000).astype(np.uint16)
+    return left, right, depth
+
+def write_store(fn, compress, meta=None):
+    left, right, depth = make_frames()
+    with PackedFrameWriter(fn, compress=compress, meta=meta) as writer:
+        for l, r, d in zip(left, right, depth):
+            writer.append(left=l, right=r, depth=d)
+    return left, right, depth
+
+def check_round_trip(compress):
+    fn = os.path.join(tmpdir, 'frames_{:}.pfs'.format(compress))
+    left, right, depth = write_store(fn, compress, meta=dict(scale=0.5))
+    store = PackedFrameStore(fn)
+    assert_equal(len(store), len(left))
+    assert_equal(store.channels, ['depth', 'left', 'right'])
+    assert_equal(store.compressed, compress)
+    assert_equal(store.meta['scale'], 0.5)
+    for idx in [0, 5, -1]:
+        assert np.array_equal(store.frame('left', idx), left[idx])
+        assert np.array_equal(store[idx].right, right[idx])
+        assert np.array_equal(store[idx].depth, depth[idx])
+        assert_equal(store[idx].depth.dtype, np.uint16)
+    assert np.array_equal(np.asarray(store['left']), left)
+    with assert_raises(KeyError):
+        store.frame('image', 0)
+
+def test_raw_round_trip():
+    check_round_trip(compress=False)
+
+def test_compressed_round_trip():
+    check_round_trip(compress=True)
+
+def test_raw_frames_are_views():
+    fn = os.path.join(tmpdir, 'views.pfs')
+    write_store(fn, compress=False)
+    store = PackedFrameStore(fn)
+    assert isinstance(store['left'], np.memmap)
+
+def test_writer_validation():
+    fn = os.path.join(tmpdir, 'invalid.pfs')
+    with assert_raises(ValueError):
+        with PackedFrameWriter(fn) as writer:
+            writer.append(left=np.zeros((2, 2)), right=np.zeros((2, 2)))
+            writer.append(left=np.zeros((2, 3)), right=np.zeros((2, 2)))
+    with assert_raises(ValueError):
+        with PackedFrameWriter(fn) as writer:
+            writer.append(left=np.zeros((2, 2)))
+            writer.append(right=np.zeros((2, 2)))
+    assert not os.path.exists(fn) and not os.path.exists(fn + '.tmp')
+
+def test_packed_dataset_reader():
+    fn = os.path.join(tmpdir, 'reader.pfs')
+    left, right, depth = write_store(fn, compress=True)
+    reader = PackedDatasetReader(fn, 'left')
+    assert_equal(len(reader), len(left))
+    assert np.array_equal(reader[3], left[3])
+    assert all(np.array_equal(a, b) for a, b in zip(reader[2:9:3].iteritems(), left[2:9:3]))
+    assert all(np.array_equal(a, b) for a, b in zip(reader.iteritems(prefetch=4, workers=2), left))
+    assert all(np.array_equal(a, b) for a, b in
+               zip(reader.iteritems(prefetch=4, workers=2, processes=True), left))
+    loader = pickle.loads(pickle.dumps(reader.process_cb))
+    assert isinstance(loader, PackedChannel)
+    assert np.array_equal(loader(4), left[4])
+    with assert_raises(KeyError):
+        PackedDatasetReader(fn, 'image')
+
+    stereo = packed_stereo_reader(fn)[4:]
+    assert_equal(len(stereo), len(left) - 4)
+    for (l, r), el, er in zip(stereo.iteritems(), left[4:], right[4:]):
+        assert np.array_equal(l, el) and np.array_equal(r, er)
+
+def test_pack_dataset():
+    left, right, _ = make_frames()
+    frames = dict(enumerate(zip(left, right)))
+    stereo = StereoDatasetReader.__new__(StereoDatasetReader)
+    stereo.left = DatasetReader(process_cb=lambda idx: frames[idx][0], files=range(len(left)))
+    stereo.right = DatasetReader(process_cb=lambda idx: frames[idx][1], files=range(len(left)))
+
+    fn = os.path.join(tmpdir, 'stereo.pfs')
+    store = pack_dataset(stereo, fn, every_k_frames=2, compress=True, verbose=False)
+    assert_equal(len(store), len(left[::2]))
+    assert np.array_equal(np.stack(store['right']), right[::2])
+
+    with assert_raises(ValueError):
+        stereo.right = stereo.right[1:]
+        pack_dataset(stereo, fn, verbose=False)
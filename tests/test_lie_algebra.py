@@ -0,0 +1,64 @@
+import time
+import numpy as np
+from scipy.linalg import expm
+from nose.plugins.attrib import attr
+
+from pybot.geometry.lie_algebra import so3_hat, so3_vee, so3_exp, so3_log, \
+    se3_hat, se3_exp, se3_log, sim3_exp, sim3_log
+
+def num_left_jacobian(exp, log, xi, eps=1e-6):
+    """ Finite-difference left Jacobian: log(exp(xi + d) exp(xi)^-1) / d """
+    J = np.zeros((len(xi), len(xi)))
+    T0inv = np.linalg.inv(exp(xi)[0])
+    for k in range(len(xi)):
+        d = np.zeros(len(xi))
+        d[k] = eps
+        J[:,k] = log(np.dot(exp(xi + d)[0], T0inv))[0] / eps
+    return J
+
+def test_exp_log_round_trips():
+    rng = np.random.RandomState(0)
+    for scale in [1e-9, 1e-4, 1e-2, 0.5, 3.0]:
+        w = rng.randn(1000, 3)
+        w = w / np.linalg.norm(w, axis=1)[:,None] * rng.uniform(0, scale, (1000, 1))
+        assert np.allclose(so3_log(so3_exp(w)), w, atol=1e-10)
+        xi = np.hstack([w, rng.randn(1000, 3)])
+        assert np.allclose(se3_log(se3_exp(xi)), xi, atol=1e-8)
+        for sigma in [0.0, 1e-7, 0.3]:
+            xs = np.hstack([xi, np.ones((1000, 1)) * sigma])
+            assert np.allclose(sim3_log(sim3_exp(xs)), xs, atol=1e-8)
+
+def test_hat_vee():
+    w = np.random.RandomState(0).randn(10, 3)
+    W = so3_hat(w)
+    assert np.allclose(W, -W.transpose(0, 2, 1))
+    assert np.allclose(so3_vee(W), w)
+
+def test_exp_against_expm():
+    xi = np.random.RandomState(0).randn(10, 7)
+    for x, R, T, S in zip(xi, so3_exp(xi[:,:3]), se3_exp(xi[:,:6]), sim3_exp(xi)):
+        assert np.allclose(R, expm(so3_hat(x[:3])[0]))
+        assert np.allclose(T, expm(se3_hat(x[:6])[0]))
+        Xs = se3_hat(x[:6])[0]
+        Xs[:3,:3] += np.eye(3) * x[6]
+        assert np.allclose(S, expm(Xs))
+
+def test_jacobians():
+    rng = np.random.RandomState(0)
+    for scale in [1e-3, 0.5, 1.0]:
+        x = rng.randn(6) * scale
+        J = num_left_jacobian(so3_exp, so3_log, x[:3])
+        assert np.allclose(J, so3_exp(x[:3], return_jacobian='left')[1], atol=1e-5)
+        assert np.allclose(np.linalg.inv(J), so3_log(so3_exp(x[:3]), return_jacobian='left')[1], atol=1e-5)
+        J = num_left_jacobian(se3_exp, se3_log, x)
+        assert np.allclose(J, se3_exp(x, return_jacobian='left')[1], atol=1e-5)
+        assert np.allclose(np.linalg.inv(J), se3_log(se3_exp(x), return_jacobian='left')[1], atol=1e-5)
+        assert np.allclose(se3_exp(-x, return_jacobian='left')[1],
+                           se3_exp(x, return_jacobian='right')[1])
+
+@attr('slow')
+def test_lie_algebra_benchmark():
+    xi = np.random.randn(100000, 6)
+    st = time.time()
+    se3_log(se3_exp(xi))
+    print('se3 exp + log for 100k twists: {:4.1f} ms'.format((time.time() - st) * 1e3))
@@ -0,0 +1,65 @@
+import numpy as np
+from nose.tools import assert_equal, assert_raises
+
+from pybot.geometry.rigid_transform import RigidTransform
+from pybot.utils.pose_utils import TrajectoryInterpolator, PoseInterpolator
+
+def random_transforms(N, seed=0):
+    rng = np.random.RandomState(seed)
+    q = rng.randn(N, 4)
+    q /= np.linalg.norm(q, axis=1)[:,None]
+    return [RigidTransform(qk, tk) for qk, tk in zip(q, rng.randn(N, 3))]
+
+def test_trajectory_interpolator():
+    poses = random_transforms(5)
+    interp = TrajectoryInterpolator([0, 1, 2, 3, 4], poses)
+    p, valid = interp.query([0, 1.5, 4])
+    assert np.all(valid)
+    assert np.allclose(p[0].matrix, poses[0].matrix)
+    assert np.allclose(p[1].matrix, poses[1].interpolate(poses[2], 0.5).matrix)
+    assert np.allclose(p[2].matrix, poses[4].matrix)
+
+def test_trajectory_interpolator_extrapolation():
+    poses = random_transforms(5)
+    ts = [0, 1, 2, 3, 4]
+    p, valid = TrajectoryInterpolator(ts, poses, extrapolate='clamp').query([-1, 5])
+    assert np.all(valid)
+    assert np.allclose(p[0].matrix, poses[0].matrix) and np.allclose(p[1].matrix, poses[4].matrix)
+
+    p, valid = TrajectoryInterpolator(ts, poses, extrapolate='linear').query([5])
+    assert np.allclose(p[0].t, poses[4].t + (poses[4].t - poses[3].t))
+
+    _, valid = TrajectoryInterpolator(ts, poses, extrapolate='none').query([-1, 2, 5])
+    assert_equal(list(valid), [False, True, False])
+    with assert_raises(ValueError):
+        TrajectoryInterpolator(ts, poses, extrapolate='raise').query([5])
+
+    _, valid = TrajectoryInterpolator([0, 1, 3, 4], poses[:4], max_gap=1.5).query([0.5, 2, 4.2, 6])
+    assert_equal(list(valid), [True, False, True, False])
+
+def test_trajectory_interpolator_validation():
+    poses = random_transforms(3)
+    with assert_raises(ValueError):
+        TrajectoryInterpolator([0, 2, 1], poses)
+    with assert_raises(ValueError):
+        TrajectoryInterpolator([0, 1], poses)
+    with assert_raises(ValueError):
+        TrajectoryInterpolator([0, 1, 2], poses, extrapolate='cubic')
+
+def test_pose_interpolator():
+    poses = random_transforms(5)
+    interp = PoseInterpolator(maxlen=3)
+    for t, p in zip([0, 1, 2, 3, 4], poses):
+        interp.add(p, t)
+    p, valid = interp.query([2.5, 3.5])
+    assert np.all(valid)
+    assert np.allclose(p[0].matrix, poses[2].interpolate(poses[3], 0.5).matrix)
+    with assert_raises(ValueError):
+        interp.add(poses[0], 3)
+
+    # Timestamps default to the sample index
+    interp = PoseInterpolator()
+    for p in poses:
+        interp.add(p)
+    p, _ = interp.query([1])
+    assert np.allclose(p[0].matrix, poses[1].matrix)
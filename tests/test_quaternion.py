@@ -0,0 +1,128 @@
+import time
+import numpy as np
+from nose.tools import assert_equal
+from nose.plugins.attrib import attr
+
+import pybot.geometry.transformations as tf
+from pybot.geometry.quaternion import Quaternion, QuaternionArray, \
+    quat_multiply, quat_conjugate, quat_rotate, quat_rotate_rev, quat_slerp, \
+    quat_to_matrix, quat_from_matrix, quat_to_euler, quat_from_euler, \
+    quat_to_angle_axis, quat_from_angle_axis
+
+def random_quaternions(N, seed=0):
+    rng = np.random.RandomState(seed)
+    q = rng.randn(N, 4)
+    return q / np.linalg.norm(q, axis=1)[:,None]
+
+def same_rotation(q1, q2):
+    """ q and -q represent the same rotation """
+    return np.allclose(np.fabs(np.sum(q1 * q2, axis=-1)), 1)
+
+def test_quat_ops_against_tf():
+    q0, q1 = random_quaternions(100, seed=0), random_quaternions(100, seed=1)
+    qq = quat_multiply(q1, q0)
+    R = quat_to_matrix(q0)
+    for k in range(len(q0)):
+        assert np.allclose(qq[k], tf.quaternion_multiply(q1[k], q0[k]))
+        assert np.allclose(quat_conjugate(q0[k]), tf.quaternion_conjugate(q0[k]))
+        assert np.allclose(R[k], tf.quaternion_matrix(q0[k])[:3,:3])
+    assert same_rotation(quat_from_matrix(R), q0)
+
+def test_quat_slerp_against_tf():
+    q0, q1 = random_quaternions(100, seed=0), random_quaternions(100, seed=1)
+    for w in [0., 0.3, 1.]:
+        qs = quat_slerp(q0, q1, w)
+        for k in range(len(q0)):
+            assert same_rotation(qs[k], tf.quaternion_slerp(q0[k], q1[k], w, shortestpath=True))
+
+def test_quat_from_matrix_degenerate():
+    for axis in [[1, 0, 0], [0, 1, 0], [0, 0, 1], [1, 1, 0]]:
+        for angle in [0, np.pi, -np.pi + 1e-9]:
+            R = tf.rotation_matrix(angle, axis)[:3,:3]
+            assert np.allclose(quat_to_matrix(quat_from_matrix(R)), R)
+
+def test_quat_euler_against_tf():
+    rng = np.random.RandomState(0)
+    for axes in tf._AXES2TUPLE.keys():
+        angles = rng.uniform(-3, 3, (20, 3))
+        q = quat_from_euler(angles[:,0], angles[:,1], angles[:,2], axes=axes)
+        e = quat_to_euler(q, axes=axes)
+        for k in range(len(angles)):
+            M = tf.euler_matrix(angles[k,0], angles[k,1], angles[k,2], axes)
+            assert np.allclose(quat_to_matrix(q[k]), M[:3,:3]), axes
+            assert np.allclose(tf.euler_matrix(e[k,0], e[k,1], e[k,2], axes), M), axes
+
+def test_quat_angle_axis():
+    rng = np.random.RandomState(0)
+    theta = rng.uniform(0, np.pi, 100)
+    axis = rng.randn(100, 3)
+    axis /= np.linalg.norm(axis, axis=1)[:,None]
+    q = quat_from_angle_axis(theta, axis)
+    for k in range(len(q)):
+        assert np.allclose(q[k], tf.quaternion_about_axis(theta[k], axis[k]))
+    theta_, axis_ = quat_to_angle_axis(q)
+    assert np.allclose(theta_, theta) and np.allclose(axis_, axis)
+
+    theta_, axis_ = quat_to_angle_axis(np.array([0, 0, 0, 1.]))
+    assert np.allclose(theta_, 0) and np.allclose(axis_, [0, 0, 1])
+
+def test_quat_rotate():
+    rng = np.random.RandomState(0)
+    X = rng.randn(1000, 3)
+    q = Quaternion(random_quaternions(1)[0])
+    assert np.allclose(q.rotate(X), np.dot(X, q.R.T))
+    assert np.allclose(q.rotate_rev(q.rotate(X)), X)
+    assert np.allclose(q.rotate(X[0]), np.dot(q.R, X[0]))
+
+    # Elementwise ([N x 4] with [N x 3]), and per point set ([M x 4] with [M x N x 3])
+    qs = random_quaternions(4)
+    Xs = rng.randn(4, 100, 3)
+    assert np.allclose(quat_rotate(qs, Xs[:,0]), [Quaternion(qk).rotate(Xk) for qk, Xk in zip(qs, Xs[:,0])])
+    Ys = quat_rotate(qs, Xs)
+    for qk, Xk, Yk in zip(qs, Xs, Ys):
+        assert np.allclose(Quaternion(qk).rotate(Xk), Yk)
+    assert np.allclose(quat_rotate_rev(qs, Ys), Xs)
+
+def test_quaternion_array():
+    qs = [Quaternion(q) for q in random_quaternions(100)]
+    qa = QuaternionArray.from_list(qs)
+    assert_equal(len(qa), 100)
+    rpy = qa.to_rpy()
+    theta, axis = qa.to_angle_axis()
+    for k in range(len(qs)):
+        assert np.allclose(rpy[k], qs[k].to_rpy())
+        assert np.allclose(qa.R[k], qs[k].R)
+        theta_k, axis_k = qs[k].to_angle_axis()
+        assert np.allclose(theta[k], theta_k) and np.allclose(axis[k], axis_k)
+        assert np.allclose(qa[k].q, qs[k].q)
+    assert np.allclose(np.fabs(QuaternionArray.from_rpy(*rpy.T).dot(qa)), 1)
+    assert np.allclose(np.fabs(QuaternionArray.from_matrix(qa.R).dot(qa)), 1)
+    assert np.allclose(np.fabs(QuaternionArray.from_angle_axis(theta, axis).dot(qa)), 1)
+    assert np.allclose((qa * qa.inverse()).q, [0, 0, 0, 1])
+    assert np.allclose((qa * qs[0])[3].q, (qs[3] * qs[0]).q)
+    assert np.allclose(qa.slerp(qa[::-1], 0.).q, qa.q)
+
+@attr('slow')
+def test_quat_rotate_benchmark():
+    X = np.random.randn(100000, 3)
+    q = Quaternion(random_quaternions(1)[0])
+    st = time.time()
+    Y1 = np.vstack([q.rotate(v) for v in X[:1000]])
+    dt1 = (time.time() - st) * len(X) / 1000
+    st = time.time()
+    Y2 = q.rotate(X)
+    dt2 = time.time() - st
+    assert np.allclose(Y1, Y2[:1000])
+    print('rotate 100k points: per-point {:4.3f} s (est.), batched {:4.3f} s'.format(dt1, dt2))
+
+@attr('slow')
+def test_quaternion_array_benchmark():
+    qa = QuaternionArray(random_quaternions(1000))
+    st = time.time()
+    R1 = np.stack([Quaternion(qk).R for qk in qa.q])
+    dt1 = time.time() - st
+    st = time.time()
+    R2 = qa.to_matrix()
+    dt2 = time.time() - st
+    assert np.allclose(R1, R2)
+    print('1k quaternions to matrices: per-object {:4.3f} s, batched {:4.3f} s'.format(dt1, dt2))
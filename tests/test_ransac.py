@@ -0,0 +1,74 @@
+import numpy as np
+from nose.tools import assert_equal, assert_raises
+from nose.plugins.attrib import attr
+
+from pybot.geometry.rigid_transform import RigidTransform
+from pybot.vision.camera_utils import Camera, CameraIntrinsic, project_many
+from pybot.vision.ransac import p3p, find_fundamental, find_essential, solve_pnp
+
+def make_matches(N=1000, outlier_ratio=0.3, seed=0):
+    """ Noisy two-view matches with outliers (as from BaseKLT.matches()) """
+    rng = np.random.RandomState(seed)
+    intrinsic = CameraIntrinsic.simulate()
+    R, t = RigidTransform.from_rpyxyz(0.02, 0.05, -0.01, 0.3, 0.05, 0.02).to_Rt()
+    cam1 = Camera(intrinsic.K, np.eye(3), np.zeros(3), shape=intrinsic.shape)
+    cam2 = Camera(intrinsic.K, R, t, shape=intrinsic.shape)
+    X = np.c_[rng.uniform(-3, 3, (N, 2)), rng.uniform(4, 10, N)]
+    pts, _, _ = project_many([cam1, cam2], X, min_depth=None, check_bounds=False)
+    pts += rng.randn(*pts.shape) * 0.3
+    outliers = rng.rand(N) < outlier_ratio
+    pts[1, outliers] = rng.uniform(0, 640, (outliers.sum(), 2))
+    return intrinsic.K, X, pts, outliers
+
+def check_inliers(res, outliers):
+    assert (res.inliers & ~outliers).sum() > 0.9 * (~outliers).sum()
+    assert (res.inliers & outliers).sum() < 0.05 * outliers.sum()
+
+def test_p3p():
+    rng = np.random.RandomState(0)
+    H = 500
+    X = np.concatenate([rng.uniform(-2, 2, (H, 3, 2)), rng.uniform(3, 8, (H, 3, 1))], axis=2)
+    Rg = np.stack([RigidTransform.from_rpyxyz(*np.r_[rng.randn(3) * 0.2, 0, 0, 0]).R for _ in range(H)])
+    tg = rng.randn(H, 3) * 0.5
+    Xc = np.einsum('hij,hnj->hni', Rg, X) + tg[:,None]
+    R, t, hyp = p3p(X, Xc[...,:2] / Xc[...,2:])
+
+    # Every sample yields at most 4 solutions, one of which is the true pose
+    assert np.all(np.bincount(hyp, minlength=H) <= 4)
+    err = np.linalg.norm(R - Rg[hyp], axis=(1,2)) + np.linalg.norm(t - tg[hyp], axis=1)
+    best = np.full(H, np.inf)
+    np.minimum.at(best, hyp, err)
+    assert np.mean(best < 1e-6) > 0.99
+
+def test_find_fundamental():
+    K, _, pts, outliers = make_matches()
+    for method in ['8point', '7point']:
+        res = find_fundamental(pts[0], pts[1], method=method, seed=0)
+        check_inliers(res, outliers)
+        assert_equal(res.model.shape, (3, 3))
+    with assert_raises(ValueError):
+        find_fundamental(pts[0], pts[1], method='6point')
+
+def test_find_essential():
+    K, _, pts, outliers = make_matches()
+    check_inliers(find_essential(pts[0], pts[1], K, seed=0), outliers)
+
+    # Seeded sampling is deterministic
+    a, b = find_essential(pts[0], pts[1], K, seed=1), find_essential(pts[0], pts[1], K, seed=1)
+    assert np.array_equal(a.inliers, b.inliers)
+
+def test_solve_pnp():
+    K, X, pts, outliers = make_matches()
+    check_inliers(solve_pnp(X, pts[1], K, seed=0), outliers)
+
+@attr('slow')
+def test_ransac_benchmark():
+    K, X, pts, _ = make_matches(N=5000)
+    for name, func in [('F 8point', lambda: find_fundamental(pts[0], pts[1], method='8point', seed=0)),
+                       ('F 7point', lambda: find_fundamental(pts[0], pts[1], method='7point', seed=0)),
+                       ('E 5point', lambda: find_essential(pts[0], pts[1], K, seed=0)),
+                       ('PnP P3P', lambda: solve_pnp(X, pts[1], K, seed=0))]:
+        res = func()
+        print('{:}: {:} inliers, {:} iters, {:} hypotheses, {:}'.format(
+            name, res.inliers.sum(), res.iters, res.hypotheses,
+            ', '.join('{:}={:.2f} ms'.format(k, v) for k, v in res.timings.items())))
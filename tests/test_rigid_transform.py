@@ -0,0 +1,144 @@
+import time
+import cPickle
+import numpy as np
+from nose.tools import assert_equal, assert_raises
+from nose.plugins.attrib import attr
+
+import pybot.geometry.transformations as tf
+from pybot.geometry.quaternion import Quaternion
+from pybot.geometry.rigid_transform import RigidTransform, RigidTransformArray, Pose
+
+def random_transforms(N, seed=0):
+    rng = np.random.RandomState(seed)
+    q = rng.randn(N, 4)
+    q /= np.linalg.norm(q, axis=1)[:,None]
+    return [RigidTransform(qk, tk) for qk, tk in zip(q, rng.randn(N, 3))]
+
+def test_rigid_transform_against_tf():
+    poses = random_transforms(50)
+    for a, b in zip(poses[:-1], poses[1:]):
+        assert tf.is_same_transform((a * b).matrix, np.dot(a.matrix, b.matrix))
+        assert tf.is_same_transform(a.inverse().matrix, np.linalg.inv(a.matrix))
+        assert tf.is_same_transform(((b * a) * a.inverse()).matrix, b.matrix)
+        assert tf.is_same_transform(RigidTransform.from_matrix(a.matrix).matrix, a.matrix)
+
+def test_rigid_transform_points():
+    X = np.random.RandomState(0).randn(100, 3)
+    p = random_transforms(1)[0]
+    Xh = np.hstack([X, np.ones((len(X), 1))])
+    assert np.allclose(p * X, np.dot(Xh, p.matrix.T)[:,:3])
+    assert np.allclose(p * X[0], np.dot(p.matrix, Xh[0])[:3])
+    assert np.allclose(p.rotate_vec(X), np.dot(X, p.R.T))
+
+def test_rigid_transform_cache():
+    p = random_transforms(1)[0]
+    R, T = p.R, p.matrix
+    assert p.R is R and p.matrix is T
+    with assert_raises(ValueError):
+        R[0,0] = 1
+    with assert_raises(ValueError):
+        p.tvec[0] = 1
+    with assert_raises(ValueError):
+        p.quat.q[0] = 1
+    with assert_raises(AttributeError):
+        p.quat.q = np.array([0, 0, 0, 1.])
+
+    # to_Rt returns writable copies
+    R, t = p.to_Rt()
+    R[0,0], t[0] = 1, 1
+    assert not np.allclose(p.tvec[0], 1) and not np.allclose(p.R[0,0], 1)
+
+    # Re-assigning quat or tvec invalidates the cached matrices
+    p.tvec = [1, 2, 3]
+    assert np.allclose(p.matrix[:3,3], [1, 2, 3])
+    p.quat = Quaternion.identity()
+    assert np.allclose(p.R, np.eye(3)) and np.allclose(p.matrix[:3,:3], np.eye(3))
+
+def test_rigid_transform_pickle():
+    p = Pose.from_rigid_transform(7, random_transforms(1)[0])
+    p.matrix
+    q = cPickle.loads(cPickle.dumps(p, protocol=cPickle.HIGHEST_PROTOCOL))
+    assert_equal(q.id, 7)
+    assert np.allclose(q.matrix, p.matrix) and np.allclose(q.R, p.R)
+    with assert_raises(ValueError):
+        q.quat.q[0] = 1
+
+    # State pickled before quat, tvec (and Quaternion.q) were properties
+    quat = Quaternion.__new__(Quaternion)
+    quat.__setstate__(dict(q=p.quat.q.copy()))
+    r = RigidTransform.__new__(RigidTransform)
+    r.__setstate__(dict(quat=quat, tvec=p.tvec.copy()))
+    assert np.allclose(r.matrix, p.matrix)
+
+def test_rigid_transform_array():
+    poses = random_transforms(200)
+    M = np.stack([p.matrix for p in poses])
+    A = RigidTransformArray.from_list(poses)
+    assert_equal(len(A), len(poses))
+    assert np.allclose(A.to_matrix(), M)
+    assert np.allclose(RigidTransformArray.from_matrix(M).to_matrix(), M)
+    assert np.allclose(A.inverse().to_matrix(), np.linalg.inv(M))
+    assert np.allclose((A * A[::-1]).to_matrix(), np.einsum('nij,njk->nik', M, M[::-1]))
+    assert np.allclose((A * poses[3]).to_matrix(), np.einsum('nij,jk->nik', M, M[3]))
+    assert np.allclose((poses[3] * A).to_matrix(), np.einsum('ij,njk->nik', M[3], M))
+    assert np.allclose(A[7].matrix, M[7]) and isinstance(A[7], RigidTransform)
+    assert_equal(len(A[10:20]), 10)
+    assert all(np.allclose(a.matrix, p.matrix) for a, p in zip(A.to_list(), poses))
+
+    X = np.random.RandomState(1).randn(10, 3)
+    Y = A[:5] * X
+    for k in range(5):
+        assert np.allclose(Y[k], poses[k] * X)
+
+def test_rigid_transform_array_cumulative():
+    poses = random_transforms(50)
+    C = RigidTransformArray.from_list(poses).cumulative_oplus().to_matrix()
+    acc = np.eye(4)
+    for k, p in enumerate(poses):
+        acc = np.dot(acc, p.matrix)
+        assert np.allclose(C[k], acc)
+
+def test_rigid_transform_array_degenerate_rotations():
+    T = np.tile(np.eye(4), (4, 1, 1))
+    T[:3,:3,:3] = [np.diag([1, -1, -1]), np.diag([-1, 1, -1]), np.diag([-1, -1, 1])]
+    assert np.allclose(RigidTransformArray.from_matrix(T).to_matrix(), T)
+
+def test_rigid_transform_array_interpolate():
+    poses = random_transforms(20)
+    A = RigidTransformArray.from_list(poses)
+    for w in [0., 0.25, 1.]:
+        B = A[:-1].interpolate(A[1:], w)
+        for k in range(len(B)):
+            assert np.allclose(B[k].matrix, poses[k].interpolate(poses[k+1], w).matrix)
+
+def test_rigid_transform_array_se3():
+    A = RigidTransformArray.from_list(random_transforms(20))
+    assert np.allclose(RigidTransformArray.from_se3(A.to_se3()).to_matrix(), A.to_matrix())
+
+@attr('slow')
+def test_rigid_transform_benchmark():
+    X = np.random.randn(1000000, 3)
+    p = random_transforms(1)[0]
+
+    st = time.time()
+    Xh = np.hstack([X, np.ones((len(X), 1))]).T
+    Y1 = (np.dot(p.to_matrix(), Xh).T)[:,:3]
+    dt1 = time.time() - st
+    st = time.time()
+    Y2 = p * X
+    dt2 = time.time() - st
+    assert np.allclose(Y1, Y2)
+    print('Transform 1M points: homogenous {:4.1f} ms, cached R,t {:4.1f} ms'.format(dt1 * 1e3, dt2 * 1e3))
+
+@attr('slow')
+def test_rigid_transform_array_benchmark():
+    poses = random_transforms(10000)
+    st = time.time()
+    M1 = np.stack([pk.to_matrix() for pk in poses])
+    dt1 = time.time() - st
+    A = RigidTransformArray.from_list(poses)
+    st = time.time()
+    M2 = A.to_matrix()
+    dt2 = time.time() - st
+    assert np.allclose(M1, M2)
+    print('10k poses to matrices: per-object {:4.1f} ms, batched {:4.1f} ms'.format(dt1 * 1e3, dt2 * 1e3))
@@ -0,0 +1,151 @@
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+import cv2
+from nose.tools import assert_equal, assert_raises
+from nose.plugins.attrib import attr
+
+from pybot.vision.camera_utils import Camera, CameraIntrinsic, CameraExtrinsic
+from pybot.vision.stereo_utils import TiledStereo, CalibratedStereo, sparse_stereo_match, \
+    rectification_maps, _rectification_maps
+
+tmpdir = None
+
+def setup_module():
+    global tmpdir
+    tmpdir = tempfile.mkdtemp()
+
+def teardown_module():
+    shutil.rmtree(tmpdir)
+
+def make_pair(H=120, W=320, seed=0):
+    """ Rectified pair with a disparity ramp (20 -> 60) across rows """
+    rng = np.random.RandomState(seed)
+    tex = cv2.GaussianBlur(np.uint8(rng.rand(H, W + 200) * 255), (3, 3), 0)
+    left = tex[:, 100:100+W].copy()
+    right = np.zeros_like(left)
+    gt = np.zeros((H, W), np.float32)
+    for y in range(H):
+        gt[y] = int(20 + 40.0 * y / H)
+        right[y] = tex[y, 100 + int(gt[y,0]):100 + int(gt[y,0]) + W]
+    return left, right, gt
+
+class BlockMatcher(object):
+    """ Brute-force SAD block matcher (winner-take-all), used as a TiledStereo matcher """
+    default_params = dict(minDisparity=0, numDisparities=64, blockSize=5)
+
+    def __init__(self, params=default_params):
+        self.params = params
+
+    def compute(self, left, right):
+        d0, D, b = self.params['minDisparity'], self.params['numDisparities'], self.params['blockSize']
+        left, right = np.float32(left), np.float32(right)
+        cost = np.full((D,) + left.shape, np.inf, np.float32)
+        for k, d in enumerate(range(d0, d0 + D)):
+            diff = np.full(left.shape, 255, np.float32)
+            diff[:,d:] = np.abs(left[:,d:] - right[:,:left.shape[1]-d])
+            cost[k] = cv2.boxFilter(diff, -1, (b, b), normalize=False, borderType=cv2.BORDER_REPLICATE)
+        return np.float32(d0 + np.argmin(cost, axis=0))
+
+def test_sparse_stereo_match():
+    left, right, gt = make_pair()
+    rng = np.random.RandomState(1)
+    pts = np.float32(rng.rand(500, 2) * [left.shape[1]-1, left.shape[0]-1])
+    xy = np.round(pts).astype(int)
+    g = gt[xy[:,1], xy[:,0]]
+    for subpixel in [False, True]:
+        xyd, valid = sparse_stereo_match(left, right, pts, subpixel=subpixel)
+        assert_equal(xyd.shape, (500, 3))
+        assert np.allclose(xyd[:,:2], pts)
+        assert np.isnan(xyd[~valid,2]).all()
+
+        # Points whose true match lies inside the right image are matched
+        # (to within a pixel, the patch straddles rows of the disparity ramp)
+        inside = (xy[:,0] >= 70) & (xy[:,1] >= 3) & (xy[:,1] < left.shape[0] - 3)
+        assert valid[inside].mean() > 0.95
+        m = valid & inside
+        assert np.all(np.abs(xyd[m,2] - g[m]) <= 1)
+
+    # Chunking does not change the result
+    a = sparse_stereo_match(left, right, pts, chunk_size=7)[0]
+    b = sparse_stereo_match(left, right, pts)[0]
+    assert np.allclose(a, b, equal_nan=True)
+
+    with assert_raises(ValueError):
+        sparse_stereo_match(left, right, pts, patch_size=6)
+
+def test_tiled_stereo():
+    left, right, _ = make_pair()
+    single = BlockMatcher().compute(left, right)
+    for bands in [1, 3, 4]:
+        stereo = TiledStereo(BlockMatcher, bands=bands, overlap=8)
+        tiled = stereo.compute(left, right)
+        assert_equal(tiled.shape, single.shape)
+        assert np.array_equal(tiled, single)
+
+        # The pool is released on close, and re-created on demand
+        stereo.close()
+        assert stereo.pool_ is None
+        assert np.array_equal(stereo.compute(left, right), single)
+        stereo.close()
+
+    # Coarse-to-fine restricts the per-band search range
+    c2f = TiledStereo(BlockMatcher, bands=4, coarse_to_fine=True)
+    disp = c2f.compute(left, right)
+    c2f.close()
+    inside = np.arange(left.shape[1]) >= 70
+    assert np.mean(disp[:,inside] == single[:,inside]) > 0.95
+
+def test_rectification_maps():
+    intrinsic = CameraIntrinsic.from_calib_params(300., 300., 160., 120., k1=-0.1, k2=0.02,
+                                                  shape=(240, 320))
+    l = Camera.from_intrinsics(intrinsic)
+    r = Camera.from_intrinsics_extrinsics(intrinsic, CameraExtrinsic(np.eye(3), np.float64([-0.12, 0, 0])))
+    cache_dir = os.path.join(tmpdir, 'rectify')
+
+    # Maps are only cached in memory by default
+    environ = dict(os.environ)
+    os.environ['HOME'] = os.path.join(tmpdir, 'home')
+    try:
+        CalibratedStereo(l, r).close()
+        assert not os.path.exists(os.environ['HOME'])
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+
+    _rectification_maps.clear()
+    stereo = CalibratedStereo(l, r, cache_dir=cache_dir)
+    assert_equal(len(os.listdir(cache_dir)), 2)
+    assert rectification_maps(l, cache_dir=cache_dir, nearest=True) is stereo.maps[0]
+
+    # Maps are reloaded from disk
+    _rectification_maps.clear()
+    maps = rectification_maps(l, cache_dir=cache_dir, nearest=True)
+    assert np.array_equal(maps[0], stereo.maps[0][0])
+
+    im = np.uint8(np.random.RandomState(0).rand(240, 320, 3) * 255)
+    mx, my = cv2.initUndistortRectifyMap(l.K, l.D, l.R, l.P, (320, 240), cv2.CV_32FC1)
+    ref = cv2.remap(im, mx, my, cv2.INTER_NEAREST)
+    out = stereo.rectify(im, im)
+    assert (out[0] != ref).any(axis=2).mean() < 0.01
+    stereo.close()
+    assert stereo.pool_ is None
+
+    # Bilinear (fixed-point) maps
+    stereo = CalibratedStereo(l, r, cache_dir=None, interpolation=cv2.INTER_LINEAR)
+    ref = cv2.remap(im, mx, my, cv2.INTER_LINEAR)
+    assert np.abs(stereo.rectify(im, im)[0].astype(np.int32) - ref).mean() < 1
+
+    assert_equal(CalibratedStereo(l, r, scale=0.5, cache_dir=None).rectify(im[::2,::2], im[::2,::2])[0].shape,
+                 (120, 160, 3))
+
+@attr('slow')
+def test_sparse_stereo_benchmark():
+    left, right, _ = make_pair(H=376, W=1241)
+    pts = np.float32(np.random.rand(1000, 2) * [1240, 375])
+    st = time.time()
+    for _ in range(10):
+        sparse_stereo_match(left, right, pts)
+    print('sparse_stereo_match 1000 pts: {:.1f} ms'.format((time.time() - st) * 100))
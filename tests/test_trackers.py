@@ -0,0 +1,189 @@
+import time
+import numpy as np
+import cv2
+from nose.tools import assert_equal, assert_raises
+from nose.plugins.attrib import attr
+
+from pybot.vision.trackers import TrackManager, GridIndex, LKTracker, BaseKLT, \
+    MultiStreamTracker, StreamError
+
+def textured_image(H=240, W=320, seed=0):
+    rng = np.random.RandomState(seed)
+    return cv2.GaussianBlur(np.uint8(rng.rand(H, W) * 255), (7,7), 2)
+
+def test_track_manager():
+    deleted = []
+    tm = TrackManager(maxlen=3, on_delete_cb=lambda tracks: deleted.append(
+        {tid: t.items.copy() for tid, t in tracks.items()}))
+    tm.add(np.float32([[0,0],[1,1],[np.nan,0]]))
+    ids = tm.ids
+    assert_equal(list(ids), [0, 1])
+    for k in range(1, 5):
+        tm.add(np.float32([[0,k],[1,k+1]]), ids=ids)
+    assert_equal(list(tm.lengths), [5, 5])
+    assert np.allclose(tm.tracks[0].items, [[0,2],[0,3],[0,4]])
+    assert np.allclose(tm.flow, [[0,1],[0,1]])
+
+    # Tracks that are not propagated are deleted (with their history)
+    tm.add(np.float32([[1,9],[5,5]]), ids=[1, 7])
+    assert_equal(sorted(tm.ids), [1, 7])
+    assert_equal(list(deleted[-1].keys()), [0])
+    assert np.allclose(deleted[-1][0], [[0,2],[0,3],[0,4]])
+
+    # New tracks get fresh ids
+    tm.add(np.float32([[2,2]]))
+    assert_equal(list(tm.ids), [8])
+
+def test_track_manager_observations():
+    tm = TrackManager(maxlen=4)
+    tm.add(np.float32([[0,0],[1,1]]))
+    tm.add(np.float32([[2,2],[3,3]]), ids=[0,1])
+    tm.add(np.float32([[4,4],[9,9]]), ids=[1,5])
+    ids, pts, valid = tm.observations(3)
+    assert_equal(list(ids), [1, 5])
+    assert_equal(valid.astype(int).tolist(), [[1,0],[1,0],[1,1]])
+    assert np.allclose(pts[valid][:,0], [1, 3, 4, 9])
+    assert np.isnan(pts[~valid]).all()
+    with assert_raises(ValueError):
+        tm.observations(5)
+
+def test_klt_matches():
+    tm = TrackManager(maxlen=3)
+    klt = BaseKLT.__new__(BaseKLT)
+    klt.tm_ = tm
+
+    def reference(index1, index2):
+        # Deque-backed tracks: both history indices are strictly within the track
+        return sorted(tid for tid, t in tm.tracks.items() if len(t) > abs(index1) and len(t) > abs(index2))
+
+    rng = np.random.RandomState(0)
+    tm.add(np.float32(rng.rand(10, 2)))
+    for k in range(4):
+        ids = tm.ids[:10-k]
+        tm.add(np.float32(rng.rand(len(ids) + 2, 2)), ids=np.r_[ids, 100 + 2*k, 101 + 2*k])
+        for index1, index2 in [(-2, -1), (-3, -1), (-2, -3)]:
+            tids, p1, p2 = klt.matches(index1, index2)
+            assert_equal(sorted(tids), reference(index1, index2))
+            for tid, a, b in zip(tids, p1, p2):
+                items = tm.tracks[tid].items
+                assert np.allclose(a, items[index1]) and np.allclose(b, items[index2])
+
+def test_grid_index():
+    rng = np.random.RandomState(0)
+    grid = GridIndex((480, 640), cell_size=18)
+    ids = np.arange(3000)
+    for k in range(3):
+        pts = np.float32(rng.rand(3000, 2) * [660, 500] - 10)
+        keep = rng.rand(3000) > 0.1
+        grid.update(ids[keep], pts[keep])
+
+        # Incremental counts match a full recount
+        cells = grid.cells(pts[keep])
+        ref = np.bincount(cells[cells >= 0], minlength=np.prod(grid.grid))
+        assert np.array_equal(grid.occupancy().ravel(), ref)
+
+        bboxes = np.float32([[10,10,100,200], [-50,-50,30,30], [600,400,700,500], 
+                             [700,0,800,10], [0,0,639,479]])
+        assert np.array_equal(grid.inside(bboxes), grid.inside(bboxes, pts=grid.pts))
+
+def test_lk_tracker_workers():
+    im0 = textured_image()
+    im1 = np.roll(np.roll(im0, 2, axis=1), 1, axis=0)
+    p0 = np.float32(np.random.RandomState(0).rand(1500, 2) * [300, 220] + 10)
+
+    ref = LKTracker(fb_check=True, workers=1).track(im0, im1, p0)
+    assert np.allclose(np.nanmedian(ref - p0, axis=0), [2, 1], atol=0.1)
+    for workers in [2, 4]:
+        tracker = LKTracker(fb_check=True, workers=workers, min_chunk=256)
+        assert np.allclose(tracker.track(im0, im1, p0), ref, equal_nan=True)
+        assert tracker.pool_ is not None
+
+        # The pool is released on close, and re-created on demand
+        tracker.close()
+        assert tracker.pool_ is None
+        assert np.allclose(tracker.track(im0, im1, p0), ref, equal_nan=True)
+        tracker.close()
+    assert_equal(len(LKTracker().track(im0, im1, np.zeros((0, 2)))), 0)
+
+class _LKStream(object):
+    """ Minimal tracker that follows a fixed set of points """
+    def __init__(self, pts):
+        self.tracker_ = LKTracker(fb_check=True)
+        self.ids_, self.pts_ = np.arange(len(pts)), pts
+        self.prev_ = None
+
+    def process(self, im):
+        if self.prev_ is not None:
+            self.pts_ = self.tracker_.track(self.prev_, im, self.pts_)
+        self.prev_ = im
+        return self.ids_, self.pts_
+
+class _EchoStream(object):
+    def __init__(self, fail_at=None):
+        self.fail_at = fail_at
+
+    def process(self, im, bboxes=None):
+        time.sleep(0.005)
+        if im == self.fail_at:
+            raise ValueError('failed at {:}'.format(im))
+        return im, bboxes
+
+def test_multi_stream_tracker():
+    rng = np.random.RandomState(0)
+    base = textured_image(H=280, W=360)
+    frames = [base[k:k+240, k:k+320].copy() for k in range(10)]
+    p0 = np.float32(rng.rand(500, 2) * [220, 140] + 50)
+
+    serial = [_LKStream(p0.copy()) for _ in range(3)]
+    for im in frames:
+        for s in serial:
+            s.process(im)
+
+    mst = MultiStreamTracker([_LKStream(p0.copy()) for _ in range(3)], drop=False)
+    for t, im in enumerate(frames):
+        mst.submit(t, [im] * 3)
+    out = mst.results(block=True)
+    mst.close()
+    assert_equal([t for t, _ in out], list(range(len(frames))))
+    for s, (ids, pts) in zip(serial, out[-1][1]):
+        assert np.allclose(s.pts_, pts, equal_nan=True)
+    assert all(stats.submitted == len(frames) for stats in mst.stats)
+
+def test_multi_stream_tracker_errors():
+    mst = MultiStreamTracker([_EchoStream(), _EchoStream(), _EchoStream(fail_at=2)], drop=False)
+    for t in range(5):
+        mst.submit(t, [t, t, t], kwargs=[None, dict(bboxes=t), None])
+
+    # Timestamps before the failure are returned, the failure raises next
+    assert_equal(mst.results(block=True), [(0, [(0, None), (0, 0), (0, None)]), 
+                                 (1, [(1, None), (1, 1), (1, None)])])
+    with assert_raises(StreamError) as cm:
+        mst.results()
+    assert_equal((cm.exception.t, cm.exception.stream), (2, 2))
+    assert isinstance(cm.exception.error, ValueError)
+    assert_equal([t for t, _ in mst.results(block=True)], [3, 4])
+
+    # Synchronous processing, and skipped (None) frames
+    assert_equal(mst.process(5, [5, None, 5]), [(5, None), None, (5, None)])
+    with assert_raises(ValueError):
+        mst.submit(5, [5, 5, 5])
+    with assert_raises(ValueError):
+        mst.submit(6, [6, 6])
+    mst.close()
+
+@attr('slow')
+def test_lk_tracker_benchmark():
+    rng = np.random.RandomState(0)
+    for (W, H) in [(640,480), (1241,376)]:
+        im0 = textured_image(H=H, W=W)
+        im1 = np.roll(np.roll(im0, 2, axis=1), 1, axis=0)
+        p0 = np.float32(rng.rand(1500, 2) * [W-1, H-1])
+        for workers in [1, 2, 4]:
+            tracker = LKTracker(fb_check=True, workers=workers)
+            tracker.track(im0, im1, p0)
+            st = time.time()
+            for _ in range(20):
+                tracker.track(im0, im1, p0)
+            print('{:}x{:} {:} pts, workers={:}: {:5.2f} ms'.format(
+                W, H, len(p0), workers, (time.time() - st) * 1e3 / 20))
+            tracker.close()
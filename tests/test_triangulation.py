@@ -0,0 +1,61 @@
+import time
+import numpy as np
+from nose.plugins.attrib import attr
+
+from pybot.geometry.rigid_transform import RigidTransform
+from pybot.vision.camera_utils import Camera, CameraIntrinsic, project_many, triangulate_points
+from pybot.vision.triangulation import normalize_points, triangulate_dlt, triangulate_tracks
+
+def make_scene(K=5, N=10000, seed=0):
+    rng = np.random.RandomState(seed)
+    intrinsic = CameraIntrinsic.from_calib_params(500., 500., 319.5, 239.5,
+                                                  k1=-0.1, k2=0.01, shape=np.int32([480,640]))
+    cameras = []
+    for k in range(K):
+        R, t = RigidTransform.from_rpyxyz(0, 0.02 * k, 0, -0.2 * k, 0, 0).to_Rt()
+        cameras.append(Camera(intrinsic.K, R, t, D=intrinsic.D, shape=intrinsic.shape))
+    X = np.c_[rng.uniform(-3, 3, (N, 2)), rng.uniform(4, 10, N)]
+    return intrinsic, cameras, X
+
+def test_triangulate_dlt_against_cv2():
+    intrinsic, cameras, X = make_scene(K=2, N=100)
+    cameras = [Camera(intrinsic.K, c.R, c.tvec, shape=intrinsic.shape) for c in cameras]
+    pts, _, _ = project_many(cameras, X, min_depth=None, check_bounds=False)
+    Xd = triangulate_dlt(np.stack([c.R for c in cameras]),
+                         np.stack([np.array(c.tvec, dtype=np.float64).ravel() for c in cameras]),
+                         normalize_points(cameras, pts), np.ones((2, 100), dtype=np.bool))
+    Xcv = triangulate_points(cameras[0], pts[0], cameras[1], pts[1])
+    assert np.allclose(Xd, Xcv, atol=1e-4) and np.allclose(Xd, X, atol=1e-4)
+
+def test_triangulate_tracks():
+    intrinsic, cameras, X = make_scene()
+    rng = np.random.RandomState(1)
+    pts, _, _ = project_many(cameras, X, min_depth=None, check_bounds=False)
+    valid = rng.rand(*pts.shape[:2]) > 0.2
+
+    # Noise-free observations are recovered (up to the iterative undistortion)
+    res = triangulate_tracks(cameras, pts, valid)
+    ok = valid.sum(axis=0) >= 2
+    assert np.array_equal(res.inliers, ok)
+    assert np.allclose(res.X[ok], X[ok], atol=1e-4)
+    assert np.all(res.error[ok] < 1e-2)
+
+    # Noisy observations
+    res = triangulate_tracks(cameras, pts + rng.randn(*pts.shape) * 0.5, valid)
+    assert res.inliers.sum() > 0.9 * ok.sum()
+    assert np.median(np.linalg.norm(res.X[res.inliers] - X[res.inliers], axis=1)) < 0.1
+
+    # Intrinsic with per-view poses
+    poses = [RigidTransform.from_Rt(c.R, c.tvec) for c in cameras]
+    res2 = triangulate_tracks(intrinsic, pts, valid, poses=poses)
+    assert np.allclose(res2.X[ok], X[ok], atol=1e-4)
+
+@attr('slow')
+def test_triangulate_tracks_benchmark():
+    _, cameras, X = make_scene()
+    pts, _, _ = project_many(cameras, X, min_depth=None, check_bounds=False)
+    valid = np.ones(pts.shape[:2], dtype=np.bool)
+    st = time.time()
+    triangulate_tracks(cameras, pts, valid)
+    print('triangulate_tracks {:} tracks x {:} views: {:.2f} ms'.format(
+        len(X), len(cameras), (time.time() - st) * 1e3))